@@ -1,3 +1,6 @@
 from setuptools import setup, find_packages
 
-setup(name="frontend", packages=find_packages('src'), package_dir={'': 'src'})
+setup(name="frontend",
+      packages=find_packages('src'),
+      package_dir={'': 'src'},
+      extras_require={'numpy': ['numpy']})
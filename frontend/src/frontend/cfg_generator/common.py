@@ -1,21 +1,93 @@
 """Common classes for generating benchmarks."""
+from __future__ import annotations
 
+import collections
+import concurrent.futures
+import copy
 import random
-from typing import Any, List, Dict, Callable, Optional
+import re
+from typing import (Any, List, Dict, Callable, Deque, Optional, Sequence,
+                    TypeVar)
 from frontend.proto import cfg_pb2
+from frontend.proto import cfg_stream
 
 
-class IDGenerator(object):
-    """Returns an unused integer as a unique ID."""
-    next_id = 0
+class IDAllocator(object):
+    """Returns unused integers as unique IDs.
 
-    @staticmethod
-    def next() -> int:
+    Each generator owns an allocator, so the IDs it assigns do not depend on
+    other generators in the process. An allocator can reserve a disjoint
+    range of IDs for another allocator, for example one used by a worker
+    process, and the IDs of both never collide.
+
+        Typical usage example:
+
+        ids = IDAllocator()
+        worker_ids = ids.reserve(1000)
+        ids.next()  # 1001
+        worker_ids.next()  # 1
+    """
+
+    def __init__(self, first_id: int = 1, end: Optional[int] = None) -> None:
+        """Constructs an allocator of the IDs in [first_id, end).
+
+        Args:
+            first_id: The first ID returned.
+            end: One past the last ID that may be returned. None means the
+              range is unbounded.
+        """
+        self._next_id: int = first_id
+        self._end: Optional[int] = end
+
+    def next(self) -> int:
         """Get the next ID."""
-        IDGenerator.next_id += 1
-        return IDGenerator.next_id
+        if self._end is not None and self._next_id >= self._end:
+            raise RuntimeError(f'ID range ending at {self._end} is exhausted')
+        next_id = self._next_id
+        self._next_id += 1
+        return next_id
+
+    def reserve(self, size: int) -> IDAllocator:
+        """Reserve the next size IDs and return an allocator for them."""
+        if size < 0:
+            raise ValueError(f'cannot reserve {size} IDs')
+        first_id = self._next_id
+        end = first_id + size
+        if self._end is not None and end > self._end:
+            raise RuntimeError(
+                f'cannot reserve {size} IDs, range ends at {self._end}')
+        self._next_id = end
+        return IDAllocator(first_id, end)
 
 
+def write_cfg(cfg: cfg_pb2.CFG, path: str) -> None:
+    """Write a CFG to a file whose suffix selects the format.
+
+    Args:
+        cfg: CFG to write.
+        path: Output file ending in .pbtxt, .pb or .pbstream. A .pbstream file
+          written from one message holds a single fragment.
+    """
+    if path.endswith('.pbtxt'):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(str(cfg))
+    elif path.endswith('.pb'):
+        with open(path, 'wb') as f:
+            f.write(cfg.SerializeToString())
+    elif path.endswith(cfg_stream.STREAM_SUFFIX):
+        with open(path, 'wb') as f:
+            cfg_stream.CFGStreamWriter(f).write(cfg)
+    else:
+        raise ValueError('Unknown output file extension %s' % path)
+
+
+# Number of shards of work per job when generating in parallel. More shards
+# than jobs balance the load when some shards are slower than others.
+SHARDS_PER_JOB = 4
+# Most functions built by a single shard, so that the part of a large CFG
+# held in memory while generating in parallel does not grow with its size.
+MAX_FUNCTIONS_PER_SHARD = 1024
+
 # A type hint alias for function selector functions like pop_random_element.
 FunctionSelector = Callable[[List[Any]], Any]
 
@@ -28,28 +100,127 @@ def pop_random_element(somelist: List[Any]) -> Any:
     return somelist.pop(idx)
 
 
+def random_permutation(size: int, use_numpy: bool = False) -> List[int]:
+    """Return the integers [0, size) in a random order.
+
+    Args:
+        size: Number of integers to permute.
+        use_numpy: Shuffle with NumPy, which is much faster for millions of
+          elements. Its generator is seeded from the random module, so the
+          result is still reproducible with random.seed, although it differs
+          from the pure Python permutation.
+    """
+    if use_numpy:
+        try:
+            # pylint: disable-next=import-outside-toplevel
+            import numpy  # type: ignore[import]
+        except ImportError as e:
+            raise ImportError('use_numpy requires numpy to be installed') from e
+        rng = numpy.random.default_rng(random.getrandbits(64))
+        return rng.permutation(size).tolist()
+    permutation = list(range(size))
+    random.shuffle(permutation)
+    return permutation
+
+
+# Multipliers of the suffixes of sizes given to parse_size. Suffixes are
+# binary, whether written KB or KiB.
+_SIZE_SUFFIXES = {
+    '': 1,
+    'B': 1,
+    'K': 1 << 10,
+    'KB': 1 << 10,
+    'KIB': 1 << 10,
+    'M': 1 << 20,
+    'MB': 1 << 20,
+    'MIB': 1 << 20,
+    'G': 1 << 30,
+    'GB': 1 << 30,
+    'GIB': 1 << 30,
+}
+_SIZE_RE = re.compile(r'\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*')
+
+# Size in bytes of a nop instruction on AArch64. Other targets are assumed to
+# be x86, where the nop is one byte.
+AARCH64_NOP_SIZE = 4
+
+
+def parse_size(text: str) -> int:
+    """Parse a number of bytes such as 4096, 256KiB or 1.5MiB."""
+    match = _SIZE_RE.fullmatch(text)
+    if match is None or match.group(2).upper() not in _SIZE_SUFFIXES:
+        raise ValueError(f'Invalid size: {text}')
+    return int(float(match.group(1)) * _SIZE_SUFFIXES[match.group(2).upper()])
+
+
+def padding_instructions(size: int) -> str:
+    """C code adding size bytes of nops to a function."""
+    if size <= 0:
+        return ''
+    aarch64_nops = size // AARCH64_NOP_SIZE
+    return ('#if defined(__aarch64__)\n'
+            f'asm volatile(".rept {aarch64_nops}\\n\\tnop\\n\\t.endr");\n'
+            '#else\n'
+            f'asm volatile(".rept {size}\\n\\tnop\\n\\t.endr");\n'
+            '#endif\n')
+
+
+def padding_for_footprint(target_footprint: int, num_functions: int,
+                          function_size: int) -> int:
+    """Padding of every function for a benchmark to reach a code footprint.
+
+    Args:
+        target_footprint: Bytes of code executed by the benchmark.
+        num_functions: Number of functions executed by the benchmark.
+        function_size: Bytes of code of a function without padding.
+    """
+    return max(0, target_footprint // num_functions - function_size)
+
+
+_GeneratorT = TypeVar('_GeneratorT', bound='BaseGenerator')
+
+
 class BaseGenerator(object):
     """Common functionality for generating benchmarks."""
 
-    def __init__(self) -> None:
+    def __init__(self,
+                 id_allocator: Optional[IDAllocator] = None,
+                 jobs: int = 1) -> None:
+        """Constructs a generator.
+
+        Args:
+            id_allocator: Allocator of code block, code block body and
+              function IDs. By default the generator gets its own allocator
+              starting from 1.
+            jobs: Number of processes building functions. With more than one,
+              the numbering of IDs depends on the number of jobs, but is
+              still reproducible.
+        """
+        self._id_allocator: IDAllocator = (id_allocator if id_allocator
+                                           is not None else IDAllocator())
+        self._jobs: int = jobs
+        # Functions and code block bodies built by worker processes.
+        self._merged_cfg: cfg_pb2.CFG = cfg_pb2.CFG()
         # Map from code block body ID to the CodeBlockBody proto.
         self._code_block_bodies: Dict[int, cfg_pb2.CodeBlockBody] = {}
         # Map from code block ID to the CodeBlock proto.
         self._code_blocks: Dict[int, cfg_pb2.CodeBlock] = {}
         # Map from function ID to the function proto.
         self._functions: Dict[int, cfg_pb2.Function] = {}
+        # When streaming, completed functions are written here and dropped.
+        self._stream: Optional[cfg_stream.CFGStreamWriter] = None
 
     def function_name(self, function_id: int) -> str:
         return 'function_%d' % function_id
 
     def _add_code_block_body(self, code: str = '') -> cfg_pb2.CodeBlockBody:
-        next_id = IDGenerator.next()
+        next_id = self._id_allocator.next()
         self._code_block_bodies[next_id] = cfg_pb2.CodeBlockBody(
             id=next_id, instructions=code)
         return self._code_block_bodies[next_id]
 
     def _add_code_block(self) -> cfg_pb2.CodeBlock:
-        next_id = IDGenerator.next()
+        next_id = self._id_allocator.next()
         self._code_blocks[next_id] = cfg_pb2.CodeBlock(id=next_id)
         return self._code_blocks[next_id]
 
@@ -67,10 +238,112 @@ class BaseGenerator(object):
         func.signature.code_block_body_id = sig_body.id
         return func
 
+    def generate_cfg(self) -> cfg_pb2.CFG:
+        raise NotImplementedError
+
+    def stream_cfg(self, writer: cfg_stream.CFGStreamWriter) -> None:
+        """Generate the CFG, writing each function as soon as it is complete.
+
+        Completed functions and the code block bodies created so far are
+        written as one fragment and dropped, so memory use does not grow with
+        the size of the CFG.
+        """
+        self._stream = writer
+        try:
+            writer.write(self.generate_cfg())
+        finally:
+            self._stream = None
+
+    def _function_completed(self, function_id: int) -> None:
+        """Write a finished function to the stream, if streaming."""
+        if self._stream is None:
+            return
+        fragment = cfg_pb2.CFG()
+        fragment.code_block_bodies.extend(self._code_block_bodies.values())
+        fragment.functions.append(self._functions.pop(function_id))
+        self._stream.write(fragment)
+        self._code_block_bodies.clear()
+        self._code_blocks.clear()
+
+    def _split_into_shards(self, items: Sequence[Any]) -> List[Sequence[Any]]:
+        """Split items into contiguous shards, several per job.
+
+        Shards hold at most MAX_FUNCTIONS_PER_SHARD items, so large CFGs are
+        split into more shards rather than larger ones.
+        """
+        num_shards = self._jobs * SHARDS_PER_JOB
+        shard_size = min(max(1, -(-len(items) // num_shards)),
+                         MAX_FUNCTIONS_PER_SHARD)
+        return [
+            items[start:start + shard_size]
+            for start in range(0, len(items), shard_size)
+        ]
+
+    def _build_shards_in_parallel(self, shards: Sequence[Any],
+                                  ids_per_shard: Sequence[int]) -> None:
+        """Build every shard with _build_shard in a pool of processes.
+
+        Each shard is built by a copy of this generator using its own
+        reserved range of IDs. The resulting fragments are merged in shard
+        order, or written to the stream when streaming. At most two shards
+        per job are submitted but not yet merged or written, so finished
+        fragments do not pile up while an earlier shard is still running.
+
+        Args:
+            shards: Work items passed to _build_shard.
+            ids_per_shard: Upper bound of the number of IDs allocated while
+              building each shard.
+        """
+        if self._stream is not None and self._code_block_bodies:
+            # Shared bodies must be in the stream before the shards using them.
+            fragment = cfg_pb2.CFG()
+            fragment.code_block_bodies.extend(self._code_block_bodies.values())
+            self._stream.write(fragment)
+            self._code_block_bodies.clear()
+        with concurrent.futures.ProcessPoolExecutor(
+                self._jobs,
+                initializer=_init_shard_worker,
+                initargs=(self._copy_for_shard_worker(),)) as executor:
+            max_pending = 2 * self._jobs
+            pending: Deque[concurrent.futures.Future] = collections.deque()
+            for shard, num_ids in zip(shards, ids_per_shard):
+                if len(pending) >= max_pending:
+                    self._add_shard_fragment(pending.popleft().result())
+                pending.append(
+                    executor.submit(_build_shard_worker, shard,
+                                    self._id_allocator.reserve(num_ids)))
+            while pending:
+                self._add_shard_fragment(pending.popleft().result())
+
+    def _add_shard_fragment(self, data: bytes) -> None:
+        if self._stream is not None:
+            self._stream.write_serialized(data)
+        else:
+            self._merged_cfg.MergeFromString(data)
+
+    def _copy_for_shard_worker(self: _GeneratorT) -> _GeneratorT:
+        """Copy the state that workers need to build shards."""
+        # pylint: disable=protected-access
+        worker = copy.copy(self)
+        worker._code_block_bodies = {}
+        worker._code_blocks = {}
+        worker._functions = {}
+        worker._stream = None
+        worker._merged_cfg = cfg_pb2.CFG()
+        worker._jobs = 1
+        return worker
+
+    def _build_shard(self, shard: Any) -> None:
+        """Build the functions of one shard in a worker process."""
+        raise NotImplementedError
+
     def _generate_cfg(self, functions: Dict[int, cfg_pb2.Function],
                       code_block_bodies: Dict[int, cfg_pb2.CodeBlockBody],
                       entry_func_id: int) -> cfg_pb2.CFG:
-        cfg_proto = cfg_pb2.CFG()
+        # Functions built by workers come first, as they were split off from
+        # the start of the work.
+        cfg_proto = self._merged_cfg
+        self._merged_cfg = cfg_pb2.CFG()
         for func in functions.values():
             cfg_proto.functions.append(func)
         for cb in code_block_bodies.values():
@@ -108,3 +381,28 @@ class BaseGenerator(object):
         prefetch_block = self._add_code_block()
         prefetch_block.code_block_body_id = prefetch_inst.id
         return prefetch_block
+
+
+# The generator building shards in this worker process.
+_shard_worker_generator: Optional[BaseGenerator] = None
+
+
+def _init_shard_worker(generator: BaseGenerator) -> None:
+    global _shard_worker_generator  # pylint: disable=global-statement
+    _shard_worker_generator = generator
+
+
+def _build_shard_worker(shard: Any, id_allocator: IDAllocator) -> bytes:
+    """Build a shard and return its functions and bodies as a fragment."""
+    generator = _shard_worker_generator
+    assert generator is not None, 'shard worker is not initialized'
+    # pylint: disable=protected-access
+    generator._id_allocator = id_allocator
+    generator._build_shard(shard)
+    fragment = cfg_pb2.CFG()
+    fragment.functions.extend(generator._functions.values())
+    fragment.code_block_bodies.extend(generator._code_block_bodies.values())
+    generator._functions.clear()
+    generator._code_block_bodies.clear()
+    generator._code_blocks.clear()
+    return fragment.SerializeToString()
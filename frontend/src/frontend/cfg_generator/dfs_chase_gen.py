@@ -6,7 +6,7 @@ reach the leaf.
 """
 
 from __future__ import annotations
-from typing import List, Optional, Dict
+from typing import List, Optional, Sequence, Tuple
 from frontend.proto import cfg_pb2
 from frontend.cfg_generator import common
 
@@ -33,14 +33,41 @@ def register_args(parser):
                            action='store_true',
                            help='Insert code prefetches into the '
                            'callchains. Not available on all platforms.')
+    subparser.add_argument('--target_footprint',
+                           default=None,
+                           type=common.parse_size,
+                           help='Code footprint of the function tree, such as '
+                           '256KiB or 8MiB. Sets --depth and pads functions '
+                           'to reach it.')
+    subparser.add_argument('--function_body_size',
+                           default=0,
+                           type=common.parse_size,
+                           help='Bytes of nops added to every function. With '
+                           '--target_footprint, the least padding used.')
+
+
+# Upper bound of the IDs allocated for one function: its signature body, five
+# code blocks to conditionally call its callees, and a code block and body to
+# prefetch each callee.
+MAX_IDS_PER_FUNCTION = 10
+
+# Approximate bytes of code of a function without padding, averaged over the
+# leaves and the other half of the tree, measured at -O0 on x86-64.
+ESTIMATED_FUNCTION_SIZE = 106
 
 
 class DFSChaseGenerator(common.BaseGenerator):
     """Generates a DFS instruction pointer chase benchmark."""
 
-    def __init__(self, depth: int, use_indirect_calls: bool,
+    def __init__(self,
+                 depth: int,
+                 use_indirect_calls: bool,
                  left_path_probability: float,
-                 insert_code_prefetches: bool) -> None:
+                 insert_code_prefetches: bool,
+                 *,
+                 id_allocator: Optional[common.IDAllocator] = None,
+                 jobs: int = 1,
+                 function_body_size: int = 0) -> None:
         """Constructs a DFS pointer chase generator.
 
         Args:
@@ -48,16 +75,18 @@ class DFSChaseGenerator(common.BaseGenerator):
             use_indirect_calls: Use indirect calls to traverse the tree. If
                 false, the CFG will create conditional branches + direct calls.
             left_path_probability: The probability of taking the left path.
+            id_allocator: Allocator of the IDs used by this generator.
+            jobs: Number of processes building functions.
+            function_body_size: Bytes of nops added to every function.
         """
-        super().__init__()
+        super().__init__(id_allocator, jobs)
 
         self._depth: int = depth
-        # Map from function id to its left/right callee.
-        self._function_tree: Dict[int, List[int]] = {}
-        # A list of functions that do not call other functions.
-        self._leaf_functions: List[int] = []
-        # ID of the function at the root of the function tree.
+        # Functions of the tree have consecutive IDs in breadth-first order,
+        # starting from the root, so the callees of a function follow from
+        # its ID and the tree is never stored.
         self._root_func: int = 0
+        self._num_functions: int = 2**depth - 1
         self._insert_code_prefetches: bool = insert_code_prefetches
         self._left_path_probability: float = left_path_probability
         self._use_indirect_calls: bool = use_indirect_calls
@@ -65,11 +94,12 @@ class DFSChaseGenerator(common.BaseGenerator):
             'int x = 1;\n'
             'int y = x*x + 3;\n'
             'int z = y*x + 12345;\n'
-            'int w = z*z + x - y;\n')
+            'int w = z*z + x - y;\n' +
+            common.padding_instructions(function_body_size))
 
     def _add_code_block_with_branch(
             self,
-            branch_type: cfg_pb2.Branch.BranchTypeValue,
+            branch_type: cfg_pb2.Branch.BranchType.ValueType,
             target: Optional[int] = None,
             probability: Optional[float] = None) -> cfg_pb2.CodeBlock:
         """Add an empty code block with the specified terminator branch."""
@@ -180,51 +210,101 @@ class DFSChaseGenerator(common.BaseGenerator):
         codeblock.terminator_branch.type = cfg_pb2.Branch.BranchType.RETURN
         return codeblock
 
-    def _generate_function_tree(self) -> None:
-        next_id = common.IDGenerator.next()
-        self._root_func = next_id
-        queue = [next_id]
-        for _ in range(0, self._depth - 1):
-            children: List[int] = []
-            for func in queue:
-                self._function_tree[func] = [
-                    common.IDGenerator.next(),
-                    common.IDGenerator.next()
-                ]
-                children.extend(self._function_tree[func])
-            queue = children
-            # The callees of the second-to-last level in the tree are leaves.
-            self._leaf_functions = children
+    def _allocate_function_ids(self) -> None:
+        self._root_func = self._id_allocator.next()
+        self._id_allocator.reserve(self._num_functions - 1)
+
+    def _callees(self, function_id: int) -> Optional[List[int]]:
+        """The left and right callees of a function, or None for leaves."""
+        # As in a binary heap, the children of the node at index i are at
+        # indices 2i+1 and 2i+2.
+        left = 2 * (function_id - self._root_func) + 1
+        if left >= self._num_functions:
+            return None
+        return [self._root_func + left, self._root_func + left + 1]
+
+    def _functions_in_bfs_order(self) -> range:
+        return range(self._root_func, self._root_func + self._num_functions)
 
     def _generate_functions(self) -> None:
-        self._add_function_with_id(self._root_func)
-        for caller, callees in self._function_tree.items():
-            for callee in callees:
-                self._add_function_with_id(callee)
-            if self._use_indirect_calls:
-                self._functions[caller].instructions.extend(
-                    self._generate_indirect_call_code_blocks(
-                        callees, self._left_path_probability))
-            else:
-                self._functions[caller].instructions.extend(
-                    self._generate_conditional_branch_code_blocks(
-                        callees, self._left_path_probability))
-
-        for leaf in self._leaf_functions:
-            self._functions[leaf].instructions.append(
+        # Functions are generated in breadth-first order, and each one is
+        # complete as soon as it is generated.
+        if self._jobs > 1:
+            # Shards are ranges of function IDs, so they take no memory.
+            shards = self._split_into_shards(self._functions_in_bfs_order())
+            self._build_shards_in_parallel(
+                shards, [len(shard) * MAX_IDS_PER_FUNCTION for shard in shards])
+            return
+        for function_id in self._functions_in_bfs_order():
+            self._generate_function(function_id)
+
+    def _build_shard(self, shard: Sequence[int]) -> None:
+        for function_id in shard:
+            self._generate_function(function_id)
+
+    def _generate_function(self, function_id: int) -> None:
+        function = self._add_function_with_id(function_id)
+        callees = self._callees(function_id)
+        if callees is None:
+            function.instructions.append(
                 self._generate_leaf_function_code_blocks())
+        elif self._use_indirect_calls:
+            function.instructions.extend(
+                self._generate_indirect_call_code_blocks(
+                    callees, self._left_path_probability))
+        else:
+            function.instructions.extend(
+                self._generate_conditional_branch_code_blocks(
+                    callees, self._left_path_probability))
+        self._function_completed(function_id)
 
     def generate_cfg(self) -> cfg_pb2.CFG:
-        self._generate_function_tree()
+        self._allocate_function_ids()
         self._generate_functions()
         return self._generate_cfg(self._functions, self._code_block_bodies,
                                   self._root_func)
 
 
+def solve_for_footprint(target_footprint: int,
+                        function_body_size: int) -> Tuple[int, int]:
+    """Size the function tree to reach a code footprint.
+
+    Over many traversals every function of the tree is executed, so the
+    footprint is the size of all of them. The depth is the largest whose tree
+    fits in the footprint, and the padding makes up the difference.
+
+    Args:
+        target_footprint: Bytes of code executed by the benchmark.
+        function_body_size: Least bytes of padding of every function.
+
+    Returns:
+        The depth of the tree, and the padding of every function.
+    """
+    function_size = ESTIMATED_FUNCTION_SIZE + function_body_size
+    depth = max(1, (target_footprint // function_size + 1).bit_length() - 1)
+    padding = common.padding_for_footprint(target_footprint, 2**depth - 1,
+                                           ESTIMATED_FUNCTION_SIZE)
+    return depth, max(padding, function_body_size)
+
+
+def create_generator(args) -> DFSChaseGenerator:
+    """Create a generator of a DFS tree of callchains."""
+    print('Generating DFS instruction pointer chase benchmark...')
+    depth = args.depth
+    function_body_size = args.function_body_size
+    if args.target_footprint is not None:
+        depth, function_body_size = solve_for_footprint(args.target_footprint,
+                                                        function_body_size)
+        print(f'Using depth {depth} with functions padded by '
+              f'{function_body_size} bytes.')
+    return DFSChaseGenerator(depth,
+                             args.use_indirect_calls,
+                             args.branch_probability,
+                             args.insert_code_prefetches,
+                             jobs=args.jobs,
+                             function_body_size=function_body_size)
+
+
 def generate_cfg(args):
     """Generate a CFG of arbitrary callchains."""
-    print('Generating DFS instruction pointer chase benchmark...')
-    generator = DFSChaseGenerator(args.depth, args.use_indirect_calls,
-                                  args.branch_probability,
-                                  args.insert_code_prefetches)
-    return generator.generate_cfg()
+    return create_generator(args).generate_cfg()
@@ -6,43 +6,76 @@ Usage:
 Example: to generate an instruction pointer chase:
   python3 generate_benchmark.py inst_pointer_chase_gen \
       --depth=10 --num_callchains=10 /tmp/ichase.pb
+
+Output files ending in .pbstream are written incrementally as a stream of
+CFG fragments, which keeps memory use flat for very large CFGs.
 """
 
 import argparse
+from typing import List, Optional, Tuple
+
+from frontend.cfg_generator import registry
+
+
+def _selected_cfg_type(argv: Optional[List[str]]) -> Tuple[Optional[str], bool]:
+    """Find the CFG type before the full command line parser is built.
 
-from frontend.cfg_generator import inst_pointer_chase_gen as ichase_gen
-from frontend.cfg_generator import dfs_chase_gen
+    Returns:
+        The CFG type, and whether help was requested.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('--jobs')
+    parser.add_argument('cfg_type', nargs='?')
+    args, _ = parser.parse_known_args(argv)
+    return args.cfg_type, args.help
 
 
-def main():
+def main(argv: Optional[List[str]] = None) -> None:
     parser = argparse.ArgumentParser('Control flow graph generator.')
     subparsers = parser.add_subparsers(
         title='CFG type',
         description='Individual options per CFG type',
         dest='cfg_type')
-    ichase_gen.register_args(subparsers)
-    dfs_chase_gen.register_args(subparsers)
+    # Only the selected generator is imported. The others are listed by name,
+    # and installed plugins are only looked up when they may be needed.
+    cfg_type, help_requested = _selected_cfg_type(argv)
+    include_plugins = (help_requested or
+                       cfg_type not in registry.GENERATOR_MODULES)
+    module = None
+    for name in registry.generator_names(include_plugins):
+        if name == cfg_type:
+            module = registry.load_generator_module(name)
+            module.register_args(subparsers)
+        else:
+            subparsers.add_parser(name)
+    parser.add_argument('--jobs',
+                        default=1,
+                        type=int,
+                        help='Number of processes used to build functions.')
     parser.add_argument('output_filename',
                         default='/tmp/cfg.pbtxt',
-                        help='Output textproto file location.')
-    args = parser.parse_args()
-
-    if args.cfg_type == ichase_gen.MODULE_NAME:
-        cfg = ichase_gen.generate_cfg(args)
-    elif args.cfg_type == dfs_chase_gen.MODULE_NAME:
-        cfg = dfs_chase_gen.generate_cfg(args)
-    else:
+                        help='Output file location. The suffix selects the '
+                        'format: .pbtxt, .pb or .pbstream.')
+    args = parser.parse_args(argv)
+    if module is None:
         raise ValueError('Invalid CFG type: %s' % args.cfg_type)
 
-    if args.output_filename.endswith('.pbtxt'):
-        with open(args.output_filename, 'w') as f:
-            f.write(str(cfg))
-    elif args.output_filename.endswith('.pb'):
+    # Imported here, so that --help does not load the protobuf runtime.
+    # pylint: disable=import-outside-toplevel
+    from frontend.cfg_generator import common
+    from frontend.proto import cfg_stream
+
+    if not hasattr(module, 'create_generator'):
+        cfg = module.generate_cfg(args)
+    elif args.output_filename.endswith(cfg_stream.STREAM_SUFFIX):
         with open(args.output_filename, 'wb') as f:
-            f.write(cfg.SerializeToString())
+            module.create_generator(args).stream_cfg(
+                cfg_stream.CFGStreamWriter(f))
+        return
     else:
-        raise ValueError('Unknown output file extension %s' %
-                         args.output_filename)
+        cfg = module.create_generator(args).generate_cfg()
+    common.write_cfg(cfg, args.output_filename)
 
 
 if __name__ == '__main__':
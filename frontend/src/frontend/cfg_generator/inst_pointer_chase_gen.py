@@ -6,7 +6,8 @@ function. The function call sequence is designed to look arbitrary. Once this
 callchain completes and unwinds, the function moves on to the next callchain.
 """
 
-from typing import List, Optional, Dict
+from __future__ import annotations
+from typing import List, Optional, Dict, Iterable, Sequence, Tuple
 from frontend.proto import cfg_pb2
 from frontend.cfg_generator import common
 
@@ -28,63 +29,134 @@ def register_args(parser):
                            action='store_true',
                            help='Insert code prefetches into the '
                            'callchains. Not available on all platforms.')
+    subparser.add_argument('--use_numpy',
+                           default=False,
+                           action='store_true',
+                           help='Shuffle functions with NumPy, which is '
+                           'faster for millions of functions. Requires numpy.')
+    subparser.add_argument('--target_footprint',
+                           default=None,
+                           type=common.parse_size,
+                           help='Code footprint of the callchains, such as '
+                           '256KiB or 8MiB. Sets --num_callchains and pads '
+                           'functions to reach it.')
+    subparser.add_argument('--function_body_size',
+                           default=0,
+                           type=common.parse_size,
+                           help='Bytes of nops added to every function. With '
+                           '--target_footprint, the least padding used.')
 
 
 # Indicates in the caller-to-callee mapping that a function does not call any
 # other function.
 NO_CALLEE = -1
 
+# Upper bound of the IDs allocated for one function: its signature body, main
+# body and call code blocks, and a code prefetch block and body.
+MAX_IDS_PER_FUNCTION = 5
+
+# Approximate bytes of code of a function without padding, measured at -O0 on
+# x86-64.
+ESTIMATED_FUNCTION_SIZE = 74
+
 
 class InstPointerChaseGenerator(common.BaseGenerator):
-    """Generates an instruction pointer chase benchmark."""
-
-    def __init__(
-            self,
-            depth: int,
-            num_callchains: int,
-            insert_code_prefetches: bool,
-            function_selector: Optional[common.FunctionSelector] = None
-    ) -> None:
-        super().__init__()
+    """Generates an instruction pointer chase benchmark.
+
+    By default, functions are assigned to callchains by slicing one random
+    permutation of all functions, which takes linear time. A function_selector
+    picks and removes functions one at a time from the list of unused ones
+    instead, and use_numpy shuffles the permutation with NumPy.
+    """
+
+    def __init__(self,
+                 depth: int,
+                 num_callchains: int,
+                 insert_code_prefetches: bool,
+                 function_selector: Optional[common.FunctionSelector] = None,
+                 use_numpy: bool = False,
+                 *,
+                 id_allocator: Optional[common.IDAllocator] = None,
+                 jobs: int = 1,
+                 function_body_size: int = 0) -> None:
+        super().__init__(id_allocator, jobs)
         self._depth: int = depth
         self._num_callchains: int = num_callchains
         self._insert_code_prefetches: bool = insert_code_prefetches
         self._caller2callee: Dict[int, int] = {}
         self._callchain_entry_functions: List[int] = []
         self._entry_function_id: int = 0
-        if function_selector is None:
-            self._function_selector: common.FunctionSelector = \
-                common.pop_random_element
-        else:
-            self._function_selector = function_selector
+        self._function_selector: Optional[common.FunctionSelector] = \
+            function_selector
+        self._use_numpy: bool = use_numpy
         self._function_body: cfg_pb2.CodeBlockBody = self._add_code_block_body(
             'int x = 1;\n'
             'int y = x*x + 3;\n'
             'int z = y*x + 12345;\n'
-            'int w = z*z + x - y;\n')
+            'int w = z*z + x - y;\n' +
+            common.padding_instructions(function_body_size))
 
     def _generate_callchain_mappings(self) -> None:
         num_functions = self._num_callchains * self._depth
+        if self._function_selector is None:
+            self._generate_callchain_mappings_from_permutation(num_functions)
+        else:
+            self._generate_callchain_mappings_from_selector(
+                num_functions, self._function_selector)
+
+        assert len(self._caller2callee) == num_functions, (
+            'There should be exactly one caller2callee mapping for every '
+            'function.')
+
+    def _generate_callchain_mappings_from_permutation(
+            self, num_functions: int) -> None:
+        permutation = common.random_permutation(num_functions, self._use_numpy)
+        for start in range(0, num_functions, self._depth):
+            # Generate a pointer chase. The final function will just return.
+            callchain = permutation[start:start + self._depth]
+            self._callchain_entry_functions.append(callchain[0])
+            self._caller2callee.update(zip(callchain, callchain[1:]))
+            self._caller2callee[callchain[-1]] = NO_CALLEE
+
+    def _generate_callchain_mappings_from_selector(
+            self, num_functions: int,
+            function_selector: common.FunctionSelector) -> None:
         function_list = list(range(0, num_functions))
         for _ in range(0, self._num_callchains):
             # Generate a pointer chase. The final function will just return.
-            caller = self._function_selector(function_list)
+            caller = function_selector(function_list)
             self._callchain_entry_functions.append(caller)
             for _ in range(0, self._depth - 1):
-                callee = self._function_selector(function_list)
+                callee = function_selector(function_list)
                 self._caller2callee[caller] = callee
                 caller = callee
             # The final function in the chain does not call.
             self._caller2callee[caller] = NO_CALLEE
 
-        assert len(self._caller2callee) == num_functions, (
-            'There should be exactly one caller2callee mapping for every '
-            'function.')
-
     def _generate_callchain_functions(self) -> None:
+        if self._jobs > 1:
+            # Every function only needs its own callee to be built.
+            shards = self._split_into_shards(list(self._caller2callee.items()))
+            self._build_shards_in_parallel(
+                shards, [len(shard) * MAX_IDS_PER_FUNCTION for shard in shards])
+        else:
+            self._generate_functions_for(self._caller2callee.items())
+
+    def _copy_for_shard_worker(self) -> InstPointerChaseGenerator:
+        # pylint: disable=protected-access
+        worker = super()._copy_for_shard_worker()
+        worker._caller2callee = {}
+        worker._callchain_entry_functions = []
+        return worker
+
+    def _build_shard(self, shard: Sequence[Tuple[int, int]]) -> None:
+        self._generate_functions_for(shard)
+
+    def _generate_functions_for(
+            self, caller2callee: Iterable[Tuple[int, int]]) -> None:
         # First, generate codeblocks. Each function has two: the main body, with
         # a fallthrough branch, and the call, with a return terminator branch.
-        for caller, callee in self._caller2callee.items():
+        for caller, callee in caller2callee:
             function = self._add_function_with_id(caller)
             if self._insert_code_prefetches and callee != NO_CALLEE:
                 function.instructions.append(
@@ -106,18 +178,17 @@ class InstPointerChaseGenerator(common.BaseGenerator):
                 # The end of a function in C will implicitly return, no need to
                 # create another CodeBlock.
                 function.instructions.append(call_block)
+            self._function_completed(caller)
 
     def _generate_entry_function(self) -> None:
-        entry_func = self._add_function_with_id(common.IDGenerator.next())
+        entry_func = self._add_function_with_id(self._id_allocator.next())
         for callchain_start in self._callchain_entry_functions:
-            # Get the first CodeBlock of the called function.
-            called_func = self._functions[callchain_start]
-            # Create a CodeBlock that just calls this function (the start of a
-            # callchain), no additional CodeBlockBody required.
+            # Create a CodeBlock that just calls the start of a callchain, no
+            # additional CodeBlockBody required.
             code_block = self._add_code_block()
             code_block.terminator_branch.type = \
                 cfg_pb2.Branch.BranchType.DIRECT_CALL
-            code_block.terminator_branch.targets.append(called_func.id)
+            code_block.terminator_branch.targets.append(callchain_start)
             code_block.terminator_branch.taken_probability.append(1)
             entry_func.instructions.append(code_block)
         self._entry_function_id = entry_func.id
@@ -130,9 +201,49 @@ class InstPointerChaseGenerator(common.BaseGenerator):
                                   self._entry_function_id)
 
 
+def solve_for_footprint(target_footprint: int, depth: int,
+                        function_body_size: int) -> Tuple[int, int]:
+    """Size callchains of a given depth to reach a code footprint.
+
+    Every function is executed, so the footprint is the size of all of them.
+    The number of callchains is the largest that fits in the footprint, and
+    the padding makes up the difference.
+
+    Args:
+        target_footprint: Bytes of code executed by the benchmark.
+        depth: Depth of each callchain.
+        function_body_size: Least bytes of padding of every function.
+
+    Returns:
+        The number of callchains, and the padding of every function making
+        them reach the footprint.
+    """
+    function_size = ESTIMATED_FUNCTION_SIZE + function_body_size
+    num_callchains = max(1, target_footprint // (function_size * depth))
+    padding = common.padding_for_footprint(target_footprint,
+                                           num_callchains * depth,
+                                           ESTIMATED_FUNCTION_SIZE)
+    return num_callchains, max(padding, function_body_size)
+
+
+def create_generator(args) -> InstPointerChaseGenerator:
+    """Create a generator of arbitrary callchains."""
+    print('Generating instruction pointer chase benchmark...')
+    num_callchains = args.num_callchains
+    function_body_size = args.function_body_size
+    if args.target_footprint is not None:
+        num_callchains, function_body_size = solve_for_footprint(
+            args.target_footprint, args.depth, function_body_size)
+        print(f'Using {num_callchains} callchains of {args.depth} functions '
+              f'padded by {function_body_size} bytes.')
+    return InstPointerChaseGenerator(args.depth,
+                                     num_callchains,
+                                     args.insert_code_prefetches,
+                                     use_numpy=args.use_numpy,
+                                     jobs=args.jobs,
+                                     function_body_size=function_body_size)
+
+
 def generate_cfg(args):
     """Generate a CFG of arbitrary callchains."""
-    print('Generating instruction pointer chase benchmark...')
-    generator = InstPointerChaseGenerator(args.depth, args.num_callchains,
-                                          args.insert_code_prefetches)
-    return generator.generate_cfg()
+    return create_generator(args).generate_cfg()
@@ -0,0 +1,85 @@
+"""Registry of the CFG generators available to generate_benchmark.
+
+Generators are looked up by CFG type name and imported only when selected, so
+listing or running one generator does not pay for importing the others.
+Besides the generators shipped here, any installed package can register its
+own under the 'frontend.cfg_generators' entry point group, mapping a CFG type
+name to a module:
+
+    setup(...,
+          entry_points={
+              'frontend.cfg_generators': [
+                  'my_chase_gen = my_package.my_chase_gen',
+              ],
+          })
+
+A generator module provides:
+    register_args(subparsers): Add a subparser named after the CFG type.
+    create_generator(args): Return a common.BaseGenerator for the parsed
+      arguments. Modules may provide generate_cfg(args) returning a CFG
+      instead, in which case streamed output is not available.
+"""
+import importlib
+from types import ModuleType
+from typing import Dict, List
+
+ENTRY_POINT_GROUP = 'frontend.cfg_generators'
+
+# Generators shipped with the frontend, from CFG type name to module name.
+GENERATOR_MODULES: Dict[str, str] = {
+    'inst_pointer_chase_gen': 'frontend.cfg_generator.inst_pointer_chase_gen',
+    'dfs_chase_gen': 'frontend.cfg_generator.dfs_chase_gen',
+}
+
+
+def _entry_point_modules() -> Dict[str, str]:
+    # Scanning installed packages is slow, so it is only done when a name is
+    # not a shipped generator.
+    # pylint: disable=import-outside-toplevel
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Before Python 3.8, entry points come from the importlib_metadata
+        # backport.
+        import importlib_metadata as metadata  # type: ignore
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        group = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        # Before Python 3.10, entry points are grouped in a dict.
+        group = entry_points.get(ENTRY_POINT_GROUP, [])  # type: ignore
+    # Values may name an attribute, as in 'module:attr', of which only the
+    # module is imported.
+    return {
+        entry_point.name: entry_point.value.split(':')[0].strip()
+        for entry_point in group
+    }
+
+
+def generator_names(include_plugins: bool = True) -> List[str]:
+    """Names of the available CFG types.
+
+    Args:
+        include_plugins: Also list generators of installed packages, which
+          requires scanning their entry points.
+    """
+    if not include_plugins:
+        return list(GENERATOR_MODULES)
+    return list({**GENERATOR_MODULES, **_entry_point_modules()})
+
+
+def load_generator_module(name: str) -> ModuleType:
+    """Import the module of a CFG type.
+
+    Generators shipped with the frontend are found without scanning installed
+    packages for entry points.
+
+    Raises:
+        ValueError: No generator is registered under the name.
+    """
+    module_name = GENERATOR_MODULES.get(name)
+    if module_name is None:
+        module_name = _entry_point_modules().get(name)
+    if module_name is None:
+        raise ValueError(f'Invalid CFG type: {name}')
+    return importlib.import_module(module_name)
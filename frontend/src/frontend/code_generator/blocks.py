@@ -6,16 +6,28 @@ of life features and/or bookkeeping.
 
 Only one calling class should instantiate and interact with classes in the
 module.
+
+A callgraph can hold millions of these objects, so they use __slots__ instead
+of a per-instance __dict__, and branches keep their targets and probabilities
+in flat tuples rather than one object per target.
 """
 from __future__ import annotations
 import math
 import random
 import re
 from enum import Enum
-from typing import List, Optional, Iterable, Union, Dict, NamedTuple, Set, Callable
+from typing import (List, Optional, Iterable, Union, Dict, NamedTuple, Set,
+                    Callable, ClassVar, Mapping, Sequence, Tuple)
 from frontend.proto import cfg_pb2
 
 CACHELINE_SIZE = 64
+# Matches the return type and name of a function signature.
+CALL_SIGNATURE_RE = re.compile(r'\w+\s+(\w+)')
+# Length of the target sequences drawn for branches without an exact one.
+DEFAULT_TARGET_SEQUENCE_LENGTH = 16
+# Most branches have one of a few probability distributions, which are shared
+# between branches up to this many distinct ones.
+MAX_SHARED_PROBABILITIES = 4096
 
 
 class BranchType(Enum):
@@ -36,6 +48,8 @@ class BranchTargetAndProbability(NamedTuple):
 
 
 class BranchFilter:
+    """Matches branches of the given types."""
+    __slots__ = ('branch_types',)
 
     def __init__(self, branch_type: Union[BranchType,
                                           Iterable[BranchType]]) -> None:
@@ -49,26 +63,80 @@ class BranchFilter:
 
 class Branch:
     """Represents a branch instruction, aka an edge in the callgraph."""
-    seed: int
+    __slots__ = ('branch_type', '_targets', '_probabilities', 'target_sequence')
+    seed: ClassVar[int] = 0
 
     def __init__(self,
                  branch_type: str,
                  targets: Optional[List[int]] = None,
-                 taken_probability: Optional[List[float]] = None) -> None:
+                 taken_probability: Optional[List[float]] = None,
+                 target_sequence: Optional[List[int]] = None) -> None:
         self.branch_type: BranchType = BranchType(branch_type)
         if not targets:
             targets = []
+        # Exact sequence of indices into targets to follow, repeated forever.
+        # For conditional branches, the index one past the last target means
+        # the branch is not taken.
+        self.target_sequence: Optional[List[int]] = (list(target_sequence) if
+                                                     target_sequence else None)
+        if self.target_sequence is not None:
+            self._validate_target_sequence(len(targets))
         if not taken_probability:
-            taken_probability = []
-        self.targets: List[BranchTargetAndProbability] = [
-            BranchTargetAndProbability(target, prob)
-            for target, prob in zip(targets, taken_probability)
-        ]
+            taken_probability = self._probabilities_of_sequence(len(targets))
+        pairs = list(zip(targets, taken_probability))
+        target_ids = tuple(target for target, _ in pairs)
+        self._targets: Tuple[Optional[int], ...] = target_ids
+        self._probabilities: Tuple[float, ...] = _shared_probabilities(
+            [probability for _, probability in pairs])
         self.validate_probabilities(taken_probability)
+        if (self.target_sequence is not None and
+                len(targets) in self.target_sequence and
+                len(self._targets) == len(targets)):
+            # The sequence is not taken at times, although the probabilities
+            # of the targets add up to 1.
+            self._add_target(None, 0.0)
+
+    @property
+    def targets(self) -> List[BranchTargetAndProbability]:
+        """Targets and their probabilities, built on every access."""
+        return [
+            BranchTargetAndProbability(target, probability)
+            for target, probability in zip(self._targets, self._probabilities)
+        ]
+
+    @property
+    def num_targets(self) -> int:
+        return len(self._targets)
+
+    def _add_target(self, target: Optional[int], probability: float) -> None:
+        self._targets += (target,)
+        self._probabilities = _shared_probabilities(self._probabilities +
+                                                    (probability,))
 
     def __str__(self) -> str:
         return f'Branch(type: {self.branch_type}, targets: {self.targets})'
 
+    def _validate_target_sequence(self, num_targets: int) -> None:
+        assert self.target_sequence is not None
+        max_index = num_targets
+        if self.branch_type in (BranchType.CONDITIONAL_DIRECT,
+                                BranchType.CONDITIONAL_INDIRECT):
+            max_index += 1
+        for index in self.target_sequence:
+            if not 0 <= index < max_index:
+                raise ValueError(f'Target sequence index {index} is out of '
+                                 f'range for {num_targets} targets')
+
+    def _probabilities_of_sequence(self, num_targets: int) -> List[float]:
+        """How often the target sequence goes to each target."""
+        if not self.target_sequence:
+            return []
+        counts = [0] * num_targets
+        for index in self.target_sequence:
+            if index < num_targets:
+                counts[index] += 1
+        return [count / len(self.target_sequence) for count in counts]
+
     def validate_probabilities(self, taken_probability: List[float]) -> None:
         if self.branch_type in (BranchType.FALLTHROUGH, BranchType.UNKNOWN,
                                 BranchType.RETURN):
@@ -78,8 +146,7 @@ class Branch:
             if self.branch_type in (BranchType.CONDITIONAL_DIRECT,
                                     BranchType.CONDITIONAL_INDIRECT):
                 # The rest of the probability is a fallthrough branch
-                self.targets.append(
-                    BranchTargetAndProbability(None, 1.0 - total))
+                self._add_target(None, 1.0 - total)
             else:
                 raise ValueError(
                     'Sum of probabilities in branch is not 1.0 (Got {})\n{}'.
@@ -87,50 +154,98 @@ class Branch:
 
     @classmethod
     def from_proto(cls, proto_branch) -> Branch:
-        return cls(branch_type=proto_branch.type,
-                   targets=proto_branch.targets,
-                   taken_probability=proto_branch.taken_probability)
+        if proto_branch.targets:
+            return cls(branch_type=proto_branch.type,
+                       targets=proto_branch.targets,
+                       taken_probability=proto_branch.taken_probability,
+                       target_sequence=proto_branch.target_sequence)
+        # Branches without targets, like returns, fallthroughs and function
+        # signatures, are the most common and never change, so one instance
+        # per type is shared.
+        branch = _BRANCHES_WITHOUT_TARGETS.get(proto_branch.type)
+        if branch is None:
+            branch = cls(branch_type=proto_branch.type)
+            _BRANCHES_WITHOUT_TARGETS[proto_branch.type] = branch
+        return branch
 
     @classmethod
     def set_seed(cls, seed) -> None:
         cls.seed = seed
         random.seed(cls.seed)
 
+    @classmethod
+    def random_for(cls, key: int) -> random.Random:
+        """Random number generator of the branch with the given key.
+
+        It depends only on the seed and the key, usually the name of the code
+        block the branch terminates, so editing one branch does not change
+        the patterns drawn for any other.
+        """
+        return random.Random(f'{cls.seed}:{key}')
+
     @staticmethod
     def filter(
             branch_filter: Union[BranchType, Iterable[BranchType]]) -> Callable:
         return BranchFilter(branch_filter)
 
     def get_targets(self) -> List[Optional[int]]:
-        return [branch_target.target for branch_target in self.targets]
+        return list(self._targets)
 
-    def next_valid_target(self) -> int:
-        index = self._get_next_target_index()
+    def next_valid_target(self, rng: Optional[random.Random] = None) -> int:
+        index = self._get_next_target_index(rng)
         target = self.get_target_from_index(index)
         if target is None:
             raise ValueError('Valid target not found')
         return target
 
-    def _get_next_target_index(self) -> int:
-        random_value = random.random()
+    def _get_next_target_index(self, rng: Optional[random.Random]) -> int:
+        random_value = rng.random() if rng is not None else random.random()
         seen_values = 0.0
-        for index, branch_target in enumerate(self.targets):
-            seen_values += branch_target.probability
+        for index, probability in enumerate(self._probabilities):
+            seen_values += probability
             if random_value < seen_values:
                 return index
         raise RuntimeError('This should never happen')
 
     def get_target_from_index(self, index: int) -> Optional[int]:
-        return self.targets[index].target
-
-    def next_target_sequence(self, length: int = 16) -> List[int]:
+        return self._targets[index]
+
+    def next_target_sequence(self,
+                             length: int = DEFAULT_TARGET_SEQUENCE_LENGTH,
+                             rng: Optional[random.Random] = None) -> List[int]:
+        """Indices of the targets to take, in order.
+
+        Returns the exact target sequence of the branch if it has one, and
+        otherwise draws a sequence of the given length from its probabilities,
+        using rng or else the global random number generator.
+        """
+        if self.target_sequence is not None:
+            return self.target_sequence
+        if length <= 0:
+            raise ValueError(
+                f'Target sequence length must be positive, got {length}')
         paths = []
         for _ in range(length):
-            index = self._get_next_target_index()
+            index = self._get_next_target_index(rng)
             paths.append(index)
         return paths
 
 
+# Shared branches without targets, by branch type.
+_BRANCHES_WITHOUT_TARGETS: Dict[int, Branch] = {}
+_SHARED_PROBABILITIES: Dict[Tuple[float, ...], Tuple[float, ...]] = {}
+
+
+def _shared_probabilities(probabilities: Sequence[float]) -> Tuple[float, ...]:
+    probabilities = tuple(probabilities)
+    shared = _SHARED_PROBABILITIES.get(probabilities)
+    if shared is not None:
+        return shared
+    if len(_SHARED_PROBABILITIES) < MAX_SHARED_PROBABILITIES:
+        _SHARED_PROBABILITIES[probabilities] = probabilities
+    return probabilities
+
+
 class TargetType(Enum):
     UNKNOWN = cfg_pb2.CodePrefetchInst.UNKNOWN
     FUNCTION = cfg_pb2.CodePrefetchInst.FUNCTION
@@ -139,8 +254,10 @@ class TargetType(Enum):
 
 class CodePrefetchInst:
     """Prefetch instruction indication."""
+    __slots__ = ('type', 'target_name', 'degree')
 
-    def __init__(self, target_type: cfg_pb2.CodePrefetchInst.TargetTypeValue,
+    def __init__(self,
+                 target_type: cfg_pb2.CodePrefetchInst.TargetType.ValueType,
                  target_name: int, degree: int) -> None:
         self.type: TargetType = TargetType(target_type)
         self.target_name: int = target_name
@@ -161,6 +278,7 @@ class CodePrefetchInst:
 
 class CodeBlockBody:
     """Contains instructions or a prefetch hint."""
+    __slots__ = ('name', 'instructions', 'prefetch_inst')
 
     def __init__(self,
                  name: int,
@@ -195,6 +313,8 @@ class CodeBlockBody:
 
 class CodeBlock:
     """Represents a set of instructions, terminated by a branch instruction."""
+    __slots__ = ('name', 'code_block_body', 'terminator_branch',
+                 'unroll_factor')
 
     def __init__(self,
                  name: int,
@@ -214,7 +334,7 @@ class CodeBlock:
 
     @classmethod
     def from_proto(cls, proto_cb,
-                   code_block_bodies: Dict[int, CodeBlockBody]) -> CodeBlock:
+                   code_block_bodies: Mapping[int, CodeBlockBody]) -> CodeBlock:
         branch = Branch.from_proto(proto_cb.terminator_branch)
         code_block_body = code_block_bodies[proto_cb.code_block_body_id]
         return cls(name=proto_cb.id,
@@ -228,6 +348,7 @@ class CodeBlock:
 
 class Function:
     """Represents a function in C code."""
+    __slots__ = ('name', 'signature', 'code_blocks')
 
     def __init__(self,
                  name: int,
@@ -243,7 +364,7 @@ class Function:
 
     @classmethod
     def from_proto(cls, proto_func,
-                   code_block_bodies: Dict[int, CodeBlockBody]) -> Function:
+                   code_block_bodies: Mapping[int, CodeBlockBody]) -> Function:
         code_blocks = []
         for instruction in proto_func.instructions:
             codeblk = CodeBlock.from_proto(instruction, code_block_bodies)
@@ -260,7 +381,7 @@ class Function:
         e.g.
             void signature_10 -> signature_10
         '''
-        match = re.search(r'\w+\s+(\w+)', self.get_signature_header())
+        match = CALL_SIGNATURE_RE.search(self.get_signature_header())
         if not match:
             raise RuntimeError('Malformed function signature format: '
                                f'{self.get_signature_header()}')
@@ -0,0 +1,90 @@
+"""Named compiler and linker configurations for generated benchmarks.
+
+A build profile describes how the generated sources are compiled and linked,
+so the same CFG can be built into layouts resembling unoptimized or optimized
+production binaries.
+
+    Typical usage example:
+
+    profile = build_profiles.get_profile('O2-layout')
+    sg = SourceGenerator('/tmp/generated/', callgraph, build_profile=profile)
+"""
+from __future__ import annotations
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+class BuildProfile(NamedTuple):
+    """Compiler and linker settings used by generated build files.
+
+    Attributes:
+        name: Name of the profile.
+        compiler: Compiler to build with. None keeps the build system default,
+          which honours the CC environment variable.
+        optimization: Optimization level flag.
+        function_sections: Place every function in its own section.
+        align_functions: Alignment of functions in bytes, if set.
+        no_inline: Prevent the compiler from inlining generated functions.
+        extra_cflags: Additional compiler flags.
+        ldflags: Additional flags used when linking.
+        linker_ordering_file: Path of a symbol ordering file passed to the
+          linker. Symbol ordering files are an lld feature, so setting this
+          also links with lld.
+    """
+    name: str
+    compiler: Optional[str] = None
+    optimization: str = '-O0'
+    function_sections: bool = False
+    align_functions: Optional[int] = None
+    no_inline: bool = False
+    extra_cflags: Tuple[str, ...] = ()
+    ldflags: Tuple[str, ...] = ()
+    linker_ordering_file: Optional[str] = None
+
+    def get_cflags(self) -> List[str]:
+        cflags = [self.optimization]
+        if self.function_sections:
+            cflags.append('-ffunction-sections')
+        if self.align_functions is not None:
+            cflags.append(f'-falign-functions={self.align_functions}')
+        if self.no_inline:
+            cflags.append('-fno-inline')
+        cflags.extend(self.extra_cflags)
+        return cflags
+
+    def get_ldflags(self) -> List[str]:
+        ldflags = list(self.ldflags)
+        if self.linker_ordering_file is not None:
+            ldflags.append('-fuse-ld=lld')
+            ldflags.append(
+                f'-Wl,--symbol-ordering-file={self.linker_ordering_file}')
+        return ldflags
+
+
+DEFAULT_PROFILE = 'default'
+
+PROFILES: Dict[str, BuildProfile] = {
+    profile.name: profile for profile in (
+        # Unoptimized build, matching the historical generated Makefile.
+        BuildProfile(DEFAULT_PROFILE),
+        BuildProfile('O2', optimization='-O2'),
+        # Optimized build whose layout is controlled per function: every
+        # function is kept, placed in its own section and cache line aligned.
+        BuildProfile('O2-layout',
+                     optimization='-O2',
+                     function_sections=True,
+                     align_functions=64,
+                     no_inline=True),
+        BuildProfile('O3-layout',
+                     optimization='-O3',
+                     function_sections=True,
+                     align_functions=64,
+                     no_inline=True),
+    )
+}
+
+
+def get_profile(name: str) -> BuildProfile:
+    if name not in PROFILES:
+        raise ValueError(f'Unknown build profile: {name}. '
+                         f'Valid profiles: {", ".join(PROFILES)}')
+    return PROFILES[name]
@@ -2,8 +2,13 @@
 """Generate source files from provided callgraph."""
 
 import argparse
+import sys
+from frontend.code_generator import blocks
+from frontend.code_generator import build_profiles
+from frontend.code_generator import layout
 from frontend.code_generator import source_generator
 from frontend.code_generator import user_callgraph
+from frontend.code_generator import validator
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -15,7 +20,125 @@ if __name__ == '__main__':
                         default=None,
                         type=int,
                         help='number of c files to write to')
+    parser.add_argument('--jobs',
+                        default=1,
+                        type=int,
+                        help='number of processes used to render c files')
+    parser.add_argument('--incremental',
+                        default=False,
+                        action='store_true',
+                        help='only rewrite files whose content changed')
+    parser.add_argument('--minimal-headers',
+                        default=False,
+                        action='store_true',
+                        help='declare only the functions each c file uses '
+                        'instead of including one global header')
+    parser.add_argument('--partition-strategy',
+                        default=source_generator.PARTITION_BY_COUNT,
+                        choices=source_generator.PARTITION_STRATEGIES,
+                        help='how functions are split across --num-files c '
+                        'files')
+    parser.add_argument('--ninja',
+                        default=False,
+                        action='store_true',
+                        help='also write a build.ninja file')
+    parser.add_argument('--build-profile',
+                        default=build_profiles.DEFAULT_PROFILE,
+                        choices=build_profiles.PROFILES.keys(),
+                        help='compiler and linker settings of the generated '
+                        'build files')
+    parser.add_argument('--compiler',
+                        default=None,
+                        type=str,
+                        help='compiler overriding the build profile')
+    parser.add_argument('--linker-ordering-file',
+                        default=None,
+                        type=str,
+                        help='symbol ordering file passed to the linker, '
+                        'which requires lld')
+    parser.add_argument('--symbol-ordering',
+                        default=None,
+                        choices=layout.ORDER_POLICIES,
+                        help='link functions in the order given by this '
+                        'policy, which requires lld')
+    parser.add_argument('--layout-seed',
+                        default=0,
+                        type=int,
+                        help='seed of the random symbol ordering')
+    parser.add_argument('--lazy',
+                        default=False,
+                        action='store_true',
+                        help='build functions from the cfg only when they '
+                        'are written, keeping memory use bounded')
+    parser.add_argument('--validate',
+                        default=False,
+                        action='store_true',
+                        help='check the cfg for problems first, and stop '
+                        'before writing any file if it has errors')
+    parser.add_argument('--target-sequence-length',
+                        default=blocks.DEFAULT_TARGET_SEQUENCE_LENGTH,
+                        type=int,
+                        help='length of the generated branch patterns, '
+                        'preferably a power of two')
+    parser.add_argument('--branch-pattern',
+                        default=user_callgraph.PATTERN_STORED,
+                        choices=user_callgraph.BRANCH_PATTERNS,
+                        help='read branch patterns from arrays, or compute '
+                        'them from a hashed counter without data accesses')
+    parser.add_argument('--pattern-period',
+                        default=None,
+                        type=int,
+                        help='power of two after which hashed branch patterns '
+                        'repeat, by default 2^32')
+    parser.add_argument('--unroll-mode',
+                        default=user_callgraph.UNROLL_REPEAT,
+                        choices=user_callgraph.UNROLL_MODES,
+                        help='repeat the body of code blocks with an unroll '
+                        'factor in straight-line code, or in a loop')
+    parser.add_argument('--seed',
+                        default=0,
+                        type=int,
+                        help='seed for generated branch patterns')
     args = parser.parse_args()
-    callgraph = user_callgraph.Callgraph.from_proto(args.callgraph)
-    sg = source_generator.SourceGenerator(args.output_dir, callgraph)
-    sg.write_files(args.num_files)
+    if args.target_sequence_length <= 0:
+        parser.error('--target-sequence-length must be positive')
+    if args.pattern_period is not None:
+        if args.branch_pattern != user_callgraph.PATTERN_HASH:
+            parser.error('--pattern-period requires --branch-pattern hash')
+        try:
+            user_callgraph.check_pattern_period(args.pattern_period)
+        except ValueError as e:
+            parser.error(str(e))
+    if (args.symbol_ordering is not None and
+            args.linker_ordering_file is not None):
+        parser.error('--symbol-ordering cannot be combined with '
+                     '--linker-ordering-file')
+    if args.validate:
+        report = validator.validate_file(args.callgraph)
+        sys.stderr.write(report.format())
+        if not report.ok:
+            sys.exit(1)
+    blocks.Branch.set_seed(args.seed)
+    build_profile = build_profiles.get_profile(args.build_profile)
+    if args.compiler is not None:
+        build_profile = build_profile._replace(compiler=args.compiler)
+    if args.linker_ordering_file is not None:
+        build_profile = build_profile._replace(
+            linker_ordering_file=args.linker_ordering_file)
+    callgraph = user_callgraph.Callgraph.from_proto(args.callgraph,
+                                                    lazy=args.lazy)
+    callgraph.target_sequence_length = args.target_sequence_length
+    callgraph.branch_pattern = args.branch_pattern
+    callgraph.pattern_period = args.pattern_period
+    callgraph.unroll_mode = args.unroll_mode
+    sg = source_generator.SourceGenerator(
+        args.output_dir,
+        callgraph,
+        incremental=args.incremental,
+        minimal_headers=args.minimal_headers,
+        partition_strategy=args.partition_strategy,
+        ninja=args.ninja,
+        build_profile=build_profile,
+        symbol_ordering=args.symbol_ordering,
+        layout_seed=args.layout_seed)
+    sg.write_files(args.num_files, args.jobs)
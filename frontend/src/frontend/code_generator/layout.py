@@ -0,0 +1,89 @@
+"""Policies deciding the address order of functions in the benchmark binary.
+
+Functions are compiled into their own sections and the linker places them in
+the order given by a symbol ordering file, which makes code layout an explicit
+and reproducible experiment parameter.
+
+    Typical usage example:
+
+    order = layout.order_functions(callgraph, layout.ORDER_HOT_COLD)
+    with open('symbols.order', 'w') as f:
+        f.write(layout.format_symbol_ordering(callgraph, order))
+"""
+import random
+from typing import List, Set
+from frontend.code_generator import blocks
+from frontend.code_generator import user_callgraph
+
+# Functions in the order they appear in the CFG.
+ORDER_CFG = 'cfg'
+# Functions in depth-first call order starting from the entry point.
+ORDER_CALL = 'call'
+# Functions shuffled with a seeded random number generator.
+ORDER_RANDOM = 'random'
+# Frequently called functions first, never called functions last.
+ORDER_HOT_COLD = 'hot_cold'
+ORDER_POLICIES = (ORDER_CFG, ORDER_CALL, ORDER_RANDOM, ORDER_HOT_COLD)
+
+
+def order_functions(callgraph: user_callgraph.Callgraph,
+                    policy: str,
+                    seed: int = 0) -> List[int]:
+    """Order every function of the callgraph according to a policy.
+
+    Args:
+        callgraph: Callgraph whose functions are ordered.
+        policy: One of ORDER_POLICIES.
+        seed: Seed of the random order. It uses its own random number
+          generator, so branch patterns are not affected.
+
+    Returns:
+        A list of function names.
+    """
+    if policy == ORDER_CFG:
+        return list(callgraph.functions)
+    if policy == ORDER_CALL:
+        return _call_order(callgraph)
+    if policy == ORDER_RANDOM:
+        order = list(callgraph.functions)
+        random.Random(seed).shuffle(order)
+        return order
+    if policy == ORDER_HOT_COLD:
+        frequencies = callgraph.function_frequencies()
+        # sorted is stable, so functions of equal heat stay in call order.
+        return sorted(_call_order(callgraph),
+                      key=lambda function_name: -frequencies[function_name])
+    raise ValueError(f'Unknown symbol ordering policy: {policy}')
+
+
+def _call_order(callgraph: user_callgraph.Callgraph) -> List[int]:
+    call_filter = blocks.Branch.filter(
+        [blocks.BranchType.DIRECT_CALL, blocks.BranchType.INDIRECT_CALL])
+    order: List[int] = []
+    visited: Set[int] = set()
+    roots = [callgraph.entry_point] + list(callgraph.functions)
+    for root in roots:
+        to_visit = [root]
+        while to_visit:
+            function_name = to_visit.pop()
+            if (function_name in visited or
+                    function_name not in callgraph.functions):
+                continue
+            visited.add(function_name)
+            order.append(function_name)
+            targets = callgraph.get_function(function_name).get_branch_targets(
+                call_filter)
+            # Reversed so that the first callee is visited first.
+            to_visit.extend(
+                target for target in reversed(targets) if target is not None)
+    return order
+
+
+def format_symbol_ordering(callgraph: user_callgraph.Callgraph,
+                           function_names: List[int]) -> str:
+    """Format a linker symbol ordering file, one symbol per line."""
+    symbols = [
+        callgraph.function_call_signature_for(function_name)
+        for function_name in function_names
+    ]
+    return '\n'.join(symbols) + '\n'
@@ -1,10 +1,34 @@
 """Generate and write source files which compile into a benchmark. """
+from __future__ import annotations
+import copy
+import hashlib
+import heapq
+import json
 import os
 import re
 import math
+from concurrent import futures
 from collections import deque, defaultdict
+from frontend.code_generator import blocks
+from frontend.code_generator import build_profiles
+from frontend.code_generator import layout
 from frontend.code_generator import user_callgraph
-from typing import Set, Dict, Collection, Deque
+from typing import (Set, Dict, Collection, Deque, Iterable, Optional, TextIO,
+                    List, Tuple)
+
+# Number of rendered bytes buffered before a function file is flushed to disk.
+DEFAULT_WRITE_BUFFER_SIZE = 1 << 20
+# Name of the file, relative to the output directory, holding the content
+# hashes of generated files in incremental mode.
+MANIFEST_FILE = '.frontend_manifest.json'
+# Name of the linker symbol ordering file written when a layout is requested.
+SYMBOL_ORDERING_FILE = 'symbols.order'
+# Strategies FileFunctionMapper can use to split functions across files.
+PARTITION_BY_COUNT = 'count'
+PARTITION_BY_COST = 'cost'
+PARTITION_BY_LOCALITY = 'locality'
+PARTITION_STRATEGIES = (PARTITION_BY_COUNT, PARTITION_BY_COST,
+                        PARTITION_BY_LOCALITY)
 
 
 class SourceGenerator:
@@ -19,35 +43,115 @@ class SourceGenerator:
     def __init__(self,
                  output_directory: str,
                  callgraph: user_callgraph.Callgraph,
+                 *,
                  header_file: str = 'headers.h',
                  main_file: str = 'main.c',
-                 benchmark_name: str = 'benchmark') -> None:
+                 benchmark_name: str = 'benchmark',
+                 write_buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+                 incremental: bool = False,
+                 minimal_headers: bool = False,
+                 partition_strategy: str = PARTITION_BY_COUNT,
+                 ninja: bool = False,
+                 build_profile: Optional[build_profiles.BuildProfile] = None,
+                 symbol_ordering: Optional[str] = None,
+                 layout_seed: int = 0) -> None:
         self.output_dir: str = output_directory
         self.callgraph: user_callgraph.Callgraph = callgraph
         self.header_file: str = header_file
         self.main_file: str = main_file
         self.benchmark_name: str = benchmark_name
-
-    def write_files(self, num_files: int = None) -> None:
+        self.write_buffer_size: int = write_buffer_size
+        # In incremental mode, files whose content hash matches the manifest
+        # of the previous run are left untouched.
+        self.incremental: bool = incremental
+        self._previous_digests: Dict[str, str] = {}
+        self._digests: Dict[str, str] = {}
+        # Declare only the functions each file defines or references, inline
+        # at the top of the file, instead of including the global header.
+        self.minimal_headers: bool = minimal_headers
+        self.partition_strategy: str = partition_strategy
+        # Also emit a build.ninja file next to the Makefile.
+        self.ninja: bool = ninja
+        self.build_profile: build_profiles.BuildProfile = (
+            build_profile if build_profile is not None else
+            build_profiles.get_profile(build_profiles.DEFAULT_PROFILE))
+        # Policy from layout.ORDER_POLICIES deciding the address order of
+        # functions. Setting it compiles every function into its own section
+        # and links them in the order written to SYMBOL_ORDERING_FILE.
+        self.symbol_ordering: Optional[str] = symbol_ordering
+        self.layout_seed: int = layout_seed
+        if symbol_ordering is not None:
+            if symbol_ordering not in layout.ORDER_POLICIES:
+                raise ValueError(
+                    f'Unknown symbol ordering policy: {symbol_ordering}')
+            if self.build_profile.linker_ordering_file is not None:
+                raise ValueError(
+                    'A symbol ordering policy cannot be combined with the '
+                    'linker ordering file '
+                    f'{self.build_profile.linker_ordering_file}')
+            self.build_profile = self.build_profile._replace(
+                function_sections=True,
+                linker_ordering_file=SYMBOL_ORDERING_FILE)
+
+    def write_files(self,
+                    num_files: Optional[int] = None,
+                    jobs: int = 1) -> None:
         '''Create all source files
 
         Args:
             num_files: Number of C files to write functions to. Value of None
               let's the program decide
+            jobs: Number of worker processes used to render function files.
         '''
+        if self.incremental:
+            self._previous_digests = self._read_manifest()
+            self._digests = {}
         self.write_main()
         self.write_headers()
-        function_files = self.write_functions(num_files)
+        function_files = self.write_functions(num_files, jobs)
+        if self.symbol_ordering is not None:
+            self.write_symbol_ordering(self.symbol_ordering)
         self.write_makefile(function_files)
+        if self.ninja:
+            self.write_ninja_file(function_files)
+        if self.incremental:
+            self._remove_stale_files()
+            self._write_manifest()
+
+    def _read_manifest(self) -> Dict[str, str]:
+        manifest_path = self.append_path_to_output_dir(MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return {}
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)['files']
+
+    def _write_manifest(self) -> None:
+        manifest_path = self.append_path_to_output_dir(MANIFEST_FILE)
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({'files': self._digests}, f, indent=2, sort_keys=True)
+
+    def _remove_stale_files(self) -> None:
+        for path in self._previous_digests.keys() - self._digests.keys():
+            path = self.append_path_to_output_dir(path)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _open_output_file(self, path: str) -> _OutputFile:
+        return _OutputFile(self.append_path_to_output_dir(path),
+                           self._previous_digests.get(path), self.incremental)
+
+    def _write_output_file(self, path: str, content: str) -> None:
+        with self._open_output_file(path) as f:
+            f.write(content)
+        self._digests[path] = f.digest
 
     def write_main(self) -> None:
         template = self._build_main_template()
-        main_path = self.append_path_to_output_dir(self.main_file)
-        with open(main_path, 'w') as f:
-            f.write(template)
+        self._write_output_file(self.main_file, template)
 
     def _build_main_template(self) -> str:
-        header = self.get_header_import_string()
+        header = self.get_declarations_string(
+            [], called_functions=[self.callgraph.entry_point])
         vars_def = self.callgraph.format_vars_definition()
         function_call = self.callgraph.function_call_signature_for(
             self.callgraph.entry_point)
@@ -71,6 +175,35 @@ class SourceGenerator:
     def get_header_import_string(self) -> str:
         return f'#include "{self.header_file}"'
 
+    def get_declarations_string(
+        self,
+        defined_functions: Iterable[int],
+        called_functions: Iterable[int] = ()
+    ) -> str:
+        '''Declarations needed by a file defining or calling functions.
+
+        Args:
+            defined_functions: Functions defined in the file.
+            called_functions: Additional functions called in the file outside
+              of the defined functions.
+
+        Returns:
+            The global header import, or with minimal_headers the global
+            variable declarations followed by prototypes for the defined
+            functions and every function the file calls or prefetches.
+        '''
+        if not self.minimal_headers:
+            return self.get_header_import_string()
+        declared = list(defined_functions)
+        referenced: Set[int] = set(called_functions)
+        for function_name in declared:
+            referenced |= self.callgraph.referenced_functions_for_function(
+                function_name)
+        declared.extend(sorted(referenced - set(declared)))
+        declarations = (self.callgraph.format_vars_declaration() +
+                        self.callgraph.format_headers(declared))
+        return declarations.rstrip('\n')
+
     def _build_arg_template(self, variable) -> str:
         template = (
             'int c;\n'
@@ -90,12 +223,14 @@ class SourceGenerator:
         return os.path.join(self.output_dir, path)
 
     def write_headers(self) -> None:
-        header_path = self.append_path_to_output_dir(self.header_file)
-        with open(header_path, 'w') as f:
-            f.write(self.callgraph.format_vars_declaration())
-            f.write(self.callgraph.format_headers())
-
-    def write_functions(self, num_files: int = None) -> Collection[str]:
+        self._write_output_file(
+            self.header_file,
+            self.callgraph.format_vars_declaration() +
+            self.callgraph.format_headers())
+
+    def write_functions(self,
+                        num_files: Optional[int] = None,
+                        jobs: int = 1) -> Collection[str]:
         ''' Creates files containing function definitions.
 
         Files are expected to start with headers followed by functions
@@ -106,17 +241,97 @@ class SourceGenerator:
 
             function_2() {...}
             function_3() {...}
+
+        Args:
+            num_files: ideal number of files to split functions across
+            jobs: Number of worker processes used to render files. With more
+              than one job, every file is rendered from a slice of the
+              callgraph. Branch patterns are drawn per code block, so the
+              output does not depend on the number of jobs.
         '''
-        grouper = FileFunctionMapper(self.callgraph)
+        grouper = FileFunctionMapper(self.callgraph, self.partition_strategy)
         file_to_function_name_mapping = \
             grouper.create_file_to_functions_mapping( num_files)
-        for function_file, functions in file_to_function_name_mapping.items():
-            self.write_header_import_to_new_file(function_file)
-            for function_name in functions:
-                self.write_function_to_existing_file(function_name,
-                                                     function_file)
+        if jobs > 1:
+            self._write_function_files_in_parallel(
+                file_to_function_name_mapping, jobs)
+        else:
+            for function_file, functions in \
+                    file_to_function_name_mapping.items():
+                self._digests[function_file] = self.write_function_file(
+                    function_file, functions)
         return file_to_function_name_mapping.keys()
 
+    def _write_function_files_in_parallel(self,
+                                          file_to_function_name_mapping: Dict[
+                                              str, List[int]],
+                                          jobs: int) -> None:
+        # Bound the number of in-flight slices so only a few files' worth of
+        # callgraph is pickled at any time.
+        max_pending = 2 * jobs
+        pending: Dict[futures.Future, str] = {}
+        with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for function_file, functions in \
+                    file_to_function_name_mapping.items():
+                if len(pending) >= max_pending:
+                    done, _ = futures.wait(pending,
+                                           return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        self._digests[pending.pop(future)] = future.result()
+                worker_generator = self._copy_for_function_file(
+                    function_file, functions)
+                future = executor.submit(_write_function_file_worker,
+                                         worker_generator, function_file,
+                                         list(functions), blocks.Branch.seed)
+                pending[future] = function_file
+            for future in futures.as_completed(pending):
+                self._digests[pending[future]] = future.result()
+
+    def _copy_for_function_file(self, function_file: str,
+                                functions: Collection[int]) -> SourceGenerator:
+        """Create a generator able to write a single function file."""
+        # pylint: disable=protected-access
+        result = copy.copy(self)
+        result.callgraph = self.callgraph.slice(functions)
+        result._digests = {}
+        result._previous_digests = {}
+        if function_file in self._previous_digests:
+            result._previous_digests[function_file] = \
+                self._previous_digests[function_file]
+        return result
+
+    def write_function_file(self, path: str, functions: Iterable[int]) -> str:
+        '''Render functions into a new file, opening it only once.
+
+        Rendered functions are buffered in memory and flushed whenever the
+        buffer grows past write_buffer_size bytes, so memory use stays bounded
+        for very large files. The output is identical to calling
+        write_header_import_to_new_file followed by
+        write_function_to_existing_file for every function.
+
+        Returns:
+            The content hash of the file.
+        '''
+        if not self.incremental and os.path.exists(
+                self.append_path_to_output_dir(path)):
+            raise RuntimeError(
+                f'{self.append_path_to_output_dir(path)} already exists')
+        functions = list(functions)
+        header = self.get_declarations_string(functions)
+        buffer = [f'{header}\n\n']
+        buffered_size = len(buffer[0])
+        with self._open_output_file(path) as f:
+            for function_name in functions:
+                string = self.callgraph.format_function(function_name) + '\n'
+                buffer.append(string)
+                buffered_size += len(string)
+                if buffered_size >= self.write_buffer_size:
+                    f.write(''.join(buffer))
+                    buffer = []
+                    buffered_size = 0
+            f.write(''.join(buffer))
+        return f.digest
+
     def write_header_import_to_new_file(self, path) -> None:
         path = self.append_path_to_output_dir(path)
         if os.path.exists(path):
@@ -132,27 +347,74 @@ class SourceGenerator:
         with open(path, 'a') as f:
             f.write(string + '\n')
 
+    def write_symbol_ordering(self, policy: str) -> None:
+        order = layout.order_functions(self.callgraph, policy, self.layout_seed)
+        self._write_output_file(
+            SYMBOL_ORDERING_FILE,
+            layout.format_symbol_ordering(self.callgraph, order))
+
     def write_makefile(self, function_files: Collection[str]) -> None:
-        makefile_path = self.append_path_to_output_dir('Makefile')
-        with open(makefile_path, 'w') as f:
+        with self._open_output_file('Makefile') as f:
             dependencies = self.get_object_files_to_c_files_mapping(
                 function_files)
+            compiler = ''
+            if self.build_profile.compiler is not None:
+                compiler = f'CC = {self.build_profile.compiler}\n\n'
             prefetch_ifdef = ('ifdef ENABLE_PREFETCH\n'
                               '\tDENABLE_PREFETCH = -DENABLE_CODE_PREFETCH\n'
                               'endif\n\n')
-            cflags = ['$(DENABLE_PREFETCH)', '-O0']
+            cflags = ['$(DENABLE_PREFETCH)'] + self.build_profile.get_cflags()
             cflags_str = ' '.join(cflags)
+            link_flags_str = ' '.join(cflags + self.build_profile.get_ldflags())
             obj_files = ' '.join(dependencies.keys())
-            string = (
-                f'{prefetch_ifdef}'
-                f'{self.benchmark_name}: {obj_files}\n'
-                f'\t$(CC) -o {self.benchmark_name} {obj_files} {cflags_str}\n'
-                '\n')
+            string = (f'{compiler}'
+                      f'{prefetch_ifdef}'
+                      f'{self.benchmark_name}: {obj_files}\n'
+                      f'\t$(CC) -o {self.benchmark_name} {obj_files} '
+                      f'{link_flags_str}\n'
+                      '\n')
             for obj_file, c_file in dependencies.items():
                 string += f'{obj_file}: {c_file}\n'
                 string += f'\t$(CC) -c -o {obj_file} {c_file} {cflags_str}\n\n'
             string += f'clean:\n\trm *.o {self.benchmark_name}\n'
             f.write(string)
+        self._digests['Makefile'] = f.digest
+
+    def write_ninja_file(self, function_files: Collection[str]) -> None:
+        '''Write a build.ninja file equivalent to the Makefile.
+
+        Like make, the compiler can be overridden with the CC environment
+        variable, unless the build profile names one, and code prefetches are
+        enabled with ENABLE_PREFETCH=yes. Both are expanded by the shell
+        running each command.
+        '''
+        dependencies = self.get_object_files_to_c_files_mapping(function_files)
+        obj_files = ' '.join(dependencies.keys())
+        compiler = self.build_profile.compiler
+        if compiler is None:
+            compiler = '$${CC:-cc}'
+        cflags = ' '.join(self.build_profile.get_cflags())
+        ldflags = ' '.join(self.build_profile.get_ldflags())
+        lines = [
+            f'cc = {compiler}',
+            'prefetch_flags = $${ENABLE_PREFETCH:+-DENABLE_CODE_PREFETCH}',
+            f'cflags = $prefetch_flags {cflags}',
+            f'ldflags = {ldflags}'.rstrip(),
+            '',
+            'rule cc',
+            '  command = $cc -c -o $out $in $cflags',
+            '  description = CC $out',
+            '',
+            'rule link',
+            '  command = $cc -o $out $in $cflags $ldflags',
+            '  description = LINK $out',
+            '',
+        ]
+        for obj_file, c_file in dependencies.items():
+            lines.append(f'build {obj_file}: cc {c_file}')
+        lines.append(f'build {self.benchmark_name}: link {obj_files}')
+        lines.append(f'default {self.benchmark_name}')
+        self._write_output_file('build.ninja', '\n'.join(lines) + '\n')
 
     def get_object_files_to_c_files_mapping(
             self, c_files: Collection[str]) -> Dict[str, str]:
@@ -164,39 +426,131 @@ class SourceGenerator:
         return result
 
 
+def _write_function_file_worker(source_generator: SourceGenerator, path: str,
+                                functions: Collection[int], seed: int) -> str:
+    # Workers started without fork do not inherit the seed of the patterns.
+    blocks.Branch.set_seed(seed)
+    return source_generator.write_function_file(path, functions)
+
+
+class _OutputFile:
+    """A generated file that tracks the hash of everything written to it.
+
+    In incremental mode, content is written to a temporary file which only
+    replaces the destination if its hash differs from the previous digest,
+    so unchanged files keep their modification times. A destination matching
+    the previous digest is hashed again first, so files edited by hand since
+    the last run are still regenerated.
+    """
+
+    def __init__(self, path: str, previous_digest: Optional[str],
+                 incremental: bool) -> None:
+        self.path: str = path
+        self.previous_digest: Optional[str] = previous_digest
+        self.incremental: bool = incremental
+        self.write_path: str = f'{path}.tmp' if incremental else path
+        self._hash = hashlib.sha256()
+        self._file: TextIO
+
+    @property
+    def digest(self) -> str:
+        return self._hash.hexdigest()
+
+    def __enter__(self) -> _OutputFile:
+        self._file = open(self.write_path, 'w', encoding='utf-8')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._file.close()
+        if not self.incremental:
+            return
+        unchanged = (self.digest == self.previous_digest and
+                     os.path.exists(self.path) and
+                     _file_digest(self.path) == self.digest)
+        if exc_type is not None or unchanged:
+            os.remove(self.write_path)
+        else:
+            os.replace(self.write_path, self.path)
+
+    def write(self, string: str) -> None:
+        self._file.write(string)
+        self._hash.update(string.encode())
+
+
+def _file_digest(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DEFAULT_WRITE_BUFFER_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
 class FileFunctionMapper:
     """Maps filenames to groups of functions.
 
     Filenames are not created or written to.
+
+    When a number of files is requested, groups of functions that call each
+    other are split either by function count, or by estimated compile cost so
+    that every file takes roughly as long to build. The locality strategy
+    instead clusters functions by how often they call or prefetch each other,
+    so hot caller/callee pairs share a translation unit.
     """
 
-    def __init__(self, callgraph):
-        self.function_files = set()
+    def __init__(self, callgraph, strategy: str = PARTITION_BY_COUNT):
+        if strategy not in PARTITION_STRATEGIES:
+            raise ValueError(f'Unknown partition strategy: {strategy}')
+        self.function_files: Set[str] = set()
         self.callgraph = callgraph
+        self.strategy = strategy
 
     def create_file_to_functions_mapping(self,
-                                         num_files: int = None
-                                        ) -> Dict[str, Set[int]]:
-        ''' Create a file name to set of functions mapping
+                                         num_files: Optional[int] = None
+                                        ) -> Dict[str, List[int]]:
+        ''' Create a file name to list of functions mapping
+
+        Functions are listed in the order they are written to their file. The
+        cost and locality strategies list callers before their callees, while
+        the count strategy keeps the set order it has always written.
 
         Args:
             num_files: ideal number of files to split functions across
         '''
-        result = self._group_functions_by_control_flow()
+        if self.strategy == PARTITION_BY_LOCALITY:
+            return self._cluster_functions_by_affinity(num_files)
+        if self.strategy == PARTITION_BY_COST:
+            result = self._group_functions_by_control_flow(in_call_order=True)
+            if num_files:
+                result = self._pack_function_groups_by_cost(num_files, result)
+            return result
+        # Count groups are sets, as they have always been, so that existing
+        # benchmarks keep the same code layout.
+        groups: Dict[str, Set[int]] = {
+            function_file: set(functions) for function_file, functions in
+            self._group_functions_by_control_flow(in_call_order=False).items()
+        }
         if num_files:
-            result = self._split_function_groups(num_files, result)
-        return result
-
-    def _group_functions_by_control_flow(self) -> Dict[str, Set[int]]:
+            groups = self._split_function_groups(num_files, groups)
+        return {
+            function_file: list(functions)
+            for function_file, functions in groups.items()
+        }
+
+    def _group_functions_by_control_flow(
+            self, in_call_order: bool) -> Dict[str, List[int]]:
         ''' Group functions that call each other and assign them a file name
 
+        Args:
+            in_call_order: Whether to visit callees in the order they are
+              called, rather than last callee first.
+
         Returns:
-            A dict mapping file names to a set of function names
+            A dict mapping file names to function names, in visiting order
         '''
 
         visited_functions = set()
         function_to_file_mapping = {}
-        file_to_function_mapping: Dict[str, Set[int]] = defaultdict(set)
+        file_to_function_mapping: Dict[str, List[int]] = defaultdict(list)
         to_visit = deque(self.callgraph.functions.keys())
         while to_visit:
             function_name = to_visit.popleft()
@@ -207,13 +561,19 @@ class FileFunctionMapper:
                 function_to_file_mapping[
                     function_name] = self._next_function_file()
             function_file = function_to_file_mapping[function_name]
-            file_to_function_mapping[function_file].add(function_name)
+            file_to_function_mapping[function_file].append(function_name)
+            callees = []
             for target in self.callgraph.direct_call_targets_for_function(
                     function_name):
                 if (target in self.callgraph.functions and
                         target not in visited_functions):
                     function_to_file_mapping[target] = function_file
-                    to_visit.appendleft(target)
+                    callees.append(target)
+            if in_call_order:
+                # Visit callees next, in the order they are called.
+                to_visit.extendleft(reversed(callees))
+            else:
+                to_visit.extendleft(callees)
         return file_to_function_mapping
 
     def _next_function_file(self):
@@ -238,18 +598,139 @@ class FileFunctionMapper:
             functions = functions_groups.popleft()
             if current_function_count + len(functions) <= functions_per_split:
                 current_function_count += len(functions)
-                for function_name in functions:
-                    result[current_function_file].add(function_name)
+                result[current_function_file].update(functions)
             else:
                 functions_list = list(functions)
                 first_functions_list = functions_list[:functions_per_split]
                 second_functions_list = functions_list[functions_per_split:]
-                for function_name in first_functions_list:
-                    result[current_function_file].add(function_name)
+                result[current_function_file].update(first_functions_list)
                 current_function_file = self._next_function_file()
                 current_function_count = 0
                 functions_groups.appendleft(second_functions_list)
         return result
 
+    def _pack_function_groups_by_cost(
+            self, splits: int,
+            file_to_function_mapping: Dict[str,
+                                           List[int]]) -> Dict[str, List[int]]:
+        ''' Bin-pack function groups into files of equal estimated cost
+
+        Groups which fit in a file are kept whole. Larger groups are cut into
+        consecutive pieces of about one file's worth of cost, wherever the
+        middle of a function crosses a multiple of that cost, so rounding
+        errors do not pile up in the last piece. Pieces are then placed, most
+        expensive first, into the currently cheapest file.
+        '''
+        costs = self._estimate_function_costs()
+        capacity = math.ceil(sum(costs.values()) / splits)
+        pieces: List[Tuple[int, List[int]]] = []
+        for functions in file_to_function_mapping.values():
+            piece: List[int] = []
+            piece_cost = 0
+            piece_index = 0
+            group_cost = 0
+            for function_name in functions:
+                cost = costs[function_name]
+                index = (2 * group_cost + cost) // (2 * capacity)
+                if piece and index != piece_index:
+                    pieces.append((piece_cost, piece))
+                    piece = []
+                    piece_cost = 0
+                piece_index = index
+                piece.append(function_name)
+                piece_cost += cost
+                group_cost += cost
+            if piece:
+                pieces.append((piece_cost, piece))
+        return self._pack_pieces(splits, pieces)
+
+    def _estimate_function_costs(self) -> Dict[int, int]:
+        return {
+            function_name: self.callgraph.estimate_function_cost(function_name)
+            for function_name in self.callgraph.functions
+        }
+
+    def _pack_pieces(
+            self, splits: int,
+            pieces: List[Tuple[int, List[int]]]) -> Dict[str, List[int]]:
+        ''' Place (cost, functions) pieces into files of equal total cost '''
+        pieces = sorted(pieces, key=lambda piece: (-piece[0], piece[1][0]))
+        self._clear_function_files()
+        file_costs = [(0, self._next_function_file()) for _ in range(splits)]
+        heapq.heapify(file_costs)
+        result: Dict[str, List[int]] = defaultdict(list)
+        for piece_cost, piece in pieces:
+            file_cost, function_file = heapq.heappop(file_costs)
+            result[function_file].extend(piece)
+            heapq.heappush(file_costs, (file_cost + piece_cost, function_file))
+        return result
+
+    def _cluster_functions_by_affinity(
+            self, num_files: Optional[int]) -> Dict[str, List[int]]:
+        ''' Greedily cluster functions along their heaviest edges
+
+        Edges between functions are weighted by Callgraph.affinity_weights.
+        Starting from singleton clusters, edges are visited from heaviest to
+        lightest and the two clusters they join are merged, unless the merged
+        cluster would exceed one file's share of the estimated cost. Clusters
+        are then packed into num_files files by cost. Without num_files, every
+        cluster gets its own file.
+
+        As in Pettis-Hansen code layout, each cluster is a chain of functions
+        and merged chains are oriented so the ends joined by the edge meet.
+        Hot caller/callee pairs are thus written next to each other.
+        '''
+        costs = self._estimate_function_costs()
+        capacity = (math.ceil(sum(costs.values()) /
+                              num_files) if num_files else math.inf)
+        edges: Dict[Tuple[int, int], float] = defaultdict(float)
+        for caller, weights in self.callgraph.affinity_weights().items():
+            for callee, weight in weights.items():
+                if callee in costs and callee != caller and weight > 0:
+                    edges[(min(caller, callee), max(caller, callee))] += weight
+
+        parent = {function_name: function_name for function_name in costs}
+        cluster_costs = dict(costs)
+        chains = {function_name: [function_name] for function_name in costs}
+
+        def find(function_name: int) -> int:
+            while parent[function_name] != function_name:
+                parent[function_name] = parent[parent[function_name]]
+                function_name = parent[function_name]
+            return function_name
+
+        for (first, second), _ in sorted(edges.items(),
+                                         key=lambda edge: (-edge[1], edge[0])):
+            first_root, second_root = find(first), find(second)
+            if first_root == second_root:
+                continue
+            merged_cost = cluster_costs[first_root] + cluster_costs[second_root]
+            if merged_cost > capacity:
+                continue
+            parent[second_root] = first_root
+            cluster_costs[first_root] = merged_cost
+            first_chain = chains[first_root]
+            second_chain = chains.pop(second_root)
+            if first_chain[0] == first:
+                first_chain.reverse()
+            if second_chain[-1] == second:
+                second_chain.reverse()
+            first_chain.extend(second_chain)
+
+        clusters: Dict[int, List[int]] = {}
+        for function_name in self.callgraph.functions:
+            root = find(function_name)
+            if root not in clusters:
+                clusters[root] = chains[root]
+        if num_files:
+            return self._pack_pieces(num_files,
+                                     [(cluster_costs[root], functions)
+                                      for root, functions in clusters.items()])
+        self._clear_function_files()
+        return {
+            self._next_function_file(): functions
+            for functions in clusters.values()
+        }
+
     def _clear_function_files(self):
         self.function_files = set()
@@ -1,11 +1,125 @@
 """In-memory representation of a callgraph.
 """
 from __future__ import annotations
-from typing import Dict, Optional, Collection, Callable, List
+import functools
+import heapq
+import itertools
+import sys
+from collections import OrderedDict, defaultdict
+from typing import (Any, Dict, Optional, Collection, Callable, Iterator, List,
+                    Iterable, Mapping, Set, Tuple, TypeVar)
 from frontend.code_generator import blocks
 from frontend.proto import cfg_pb2
+from frontend.proto import cfg_stream
 from google.protobuf import text_format  # type: ignore[attr-defined]
 
+# Rough number of characters emitted for a terminator branch of each type,
+# excluding per-target costs, which are added separately.
+ESTIMATED_BRANCH_SIZE: Dict[blocks.BranchType, int] = {
+    blocks.BranchType.UNKNOWN: 0,
+    blocks.BranchType.FALLTHROUGH: 0,
+    blocks.BranchType.RETURN: 8,
+    blocks.BranchType.DIRECT: 16,
+    blocks.BranchType.DIRECT_CALL: 16,
+    blocks.BranchType.CONDITIONAL_DIRECT: 96,
+    blocks.BranchType.INDIRECT: 96,
+    blocks.BranchType.CONDITIONAL_INDIRECT: 96,
+    blocks.BranchType.INDIRECT_CALL: 160,
+}
+ESTIMATED_BRANCH_TARGET_SIZE = 24
+ESTIMATED_PREFETCH_SIZE = 96
+ESTIMATED_PREFETCH_DEGREE_SIZE = 32
+# Weight of a code prefetch relative to a call to the same function, when
+# measuring how strongly two functions are tied together.
+PREFETCH_CALL_WEIGHT = 0.25
+# Number of functions, and of code block bodies, a lazy callgraph keeps built.
+DEFAULT_LAZY_CACHE_SIZE = 4096
+# Branch patterns read from arrays stored next to each branch.
+PATTERN_STORED = 'stored'
+# Branch patterns computed in registers from a hash of a per-branch counter.
+PATTERN_HASH = 'hash'
+BRANCH_PATTERNS = (PATTERN_STORED, PATTERN_HASH)
+# Code blocks with an unroll factor repeat their body in straight-line code.
+UNROLL_REPEAT = 'repeat'
+# Code blocks with an unroll factor run their body in a loop.
+UNROLL_LOOP = 'loop'
+UNROLL_MODES = (UNROLL_REPEAT, UNROLL_LOOP)
+# Resolution of the probabilities of hashed branch patterns.
+_HASH_PATTERN_BITS = 16
+# Hashed patterns count in unsigned int, so they repeat at least this often.
+_MAX_PATTERN_PERIOD = 1 << 32
+
+_T = TypeVar('_T')
+# Formats a branch of a callgraph, given a unique suffix for local names.
+_BranchFormatter = Callable[['Callgraph', blocks.Branch, int], str]
+
+
+def check_pattern_period(period: int) -> None:
+    """Raise ValueError unless period is a valid period of hashed patterns."""
+    if not 1 <= period <= _MAX_PATTERN_PERIOD or period & (period - 1):
+        raise ValueError('Pattern period must be a power of two between 1 and '
+                         f'2^32, got {period}')
+
+
+class _LazyMapping(Mapping[int, _T]):
+    """Builds values from their protos on first access.
+
+    Only the most recently used values are kept, so memory use is bounded by
+    the cache size rather than by the number of protos.
+    """
+
+    def __init__(self, protos: Dict[int, Any], build: Callable[[Any], _T],
+                 cache_size: int) -> None:
+        self._protos: Dict[int, Any] = protos
+        self._build: Callable[[Any], _T] = build
+        self._cache_size: int = cache_size
+        self._cache: OrderedDict[int, _T] = OrderedDict()
+
+    def __getitem__(self, key: int) -> _T:
+        value = self._cache.get(key)
+        if value is not None:
+            self._cache.move_to_end(key)
+            return value
+        value = self._build(self._protos[key])
+        self._cache[key] = value
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._protos
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._protos)
+
+    def __len__(self) -> int:
+        return len(self._protos)
+
+
+class _LazyCodeBlocks(Mapping[int, blocks.CodeBlock]):
+    """Finds code blocks in the functions of a lazy callgraph."""
+
+    def __init__(self, function_of_code_block: Dict[int, int],
+                 functions: Mapping[int, blocks.Function]) -> None:
+        self._function_of_code_block: Dict[int, int] = function_of_code_block
+        self._functions: Mapping[int, blocks.Function] = functions
+
+    def __getitem__(self, key: int) -> blocks.CodeBlock:
+        function = self._functions[self._function_of_code_block[key]]
+        for code_block in function.code_blocks:
+            if code_block.name == key:
+                return code_block
+        raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._function_of_code_block
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._function_of_code_block)
+
+    def __len__(self) -> int:
+        return len(self._function_of_code_block)
+
 
 class Callgraph:
     """Representation of a protobuf callgraph
@@ -21,44 +135,168 @@ class Callgraph:
 
     def __init__(
         self,
-        functions: Dict[int, blocks.Function],
+        functions: Mapping[int, blocks.Function],
         entry_point: int,
         global_vars_decl: blocks.CodeBlock,
         global_vars_def: blocks.CodeBlock,
+        *,
+        code_blocks: Optional[Mapping[int, blocks.CodeBlock]] = None,
+        cache_size: Optional[int] = None,
     ) -> None:
         self.entry_point: int = entry_point
         self.global_vars_decl: blocks.CodeBlock = global_vars_decl
         self.global_vars_def: blocks.CodeBlock = global_vars_def
-        self.code_blocks: Dict[int, blocks.CodeBlock] = {}
-        self.functions: Dict[int, blocks.Function] = functions
-        for function in self.functions.values():
-            for cb in function.code_blocks:
-                self.code_blocks[cb.name] = cb
+        self.functions: Mapping[int, blocks.Function] = functions
+        # Length of the target sequences drawn for branches that do not
+        # specify an exact one. Longer sequences hide the pattern from branch
+        # predictors with longer histories.
+        self.target_sequence_length: int = (
+            blocks.DEFAULT_TARGET_SEQUENCE_LENGTH)
+        # How branches with several targets pick the next one, from
+        # BRANCH_PATTERNS. Hashed patterns cost no data memory but their
+        # outcomes only match the branch probabilities on average.
+        self.branch_pattern: str = PATTERN_STORED
+        self._pattern_period: Optional[int] = None
+        # How code blocks with an unroll factor repeat their body, from
+        # UNROLL_MODES.
+        self.unroll_mode: str = UNROLL_REPEAT
+        # Call signatures and labels are requested for every call, prefetch
+        # and jump, so each one is built once and interned. Lazy callgraphs
+        # keep only the cache_size most recently used ones.
+        self._cache_size: Optional[int] = cache_size
+        self._call_signatures: OrderedDict[int, str] = OrderedDict()
+        self._labels: OrderedDict[int, str] = OrderedDict()
+        if code_blocks is not None:
+            self.code_blocks: Mapping[int, blocks.CodeBlock] = code_blocks
+            return
+        self.code_blocks = {
+            cb.name: cb for function in self.functions.values()
+            for cb in function.code_blocks
+        }
+
+    @property
+    def pattern_period(self) -> Optional[int]:
+        """Number of steps after which hashed patterns repeat.
+
+        A power of two up to 2^32, or None to repeat only when the 32-bit
+        counter wraps around.
+        """
+        return self._pattern_period
+
+    @pattern_period.setter
+    def pattern_period(self, period: Optional[int]) -> None:
+        if period is not None:
+            check_pattern_period(period)
+        self._pattern_period = period
+
+    @classmethod
+    def from_proto(cls,
+                   path: str,
+                   lazy: bool = False,
+                   cache_size: int = DEFAULT_LAZY_CACHE_SIZE) -> Callgraph:
+        """Load a callgraph from a .pb, .pbtxt or .pbstream file.
+
+        Args:
+            path: Path of the CFG.
+            lazy: Keep the parsed protos and build functions only when they
+              are accessed. Only the cache_size most recently used functions
+              stay built, so memory use does not grow with the number of
+              functions formatted.
+            cache_size: Number of functions a lazy callgraph keeps built.
+        """
+        if path.endswith(cfg_stream.STREAM_SUFFIX):
+            with open(path, 'rb') as f:
+                return cls._from_cfg_fragments(cfg_stream.read_cfg_fragments(f),
+                                               lazy, cache_size)
+        return cls.from_cfg(cls.load_cfg(path), lazy, cache_size)
+
+    @classmethod
+    def from_cfg(cls,
+                 cfg: cfg_pb2.CFG,
+                 lazy: bool = False,
+                 cache_size: int = DEFAULT_LAZY_CACHE_SIZE) -> Callgraph:
+        """Build a callgraph from an in-memory CFG message."""
+        return cls._from_cfg_fragments([cfg], lazy, cache_size)
 
     @classmethod
-    def from_proto(cls, path: str) -> Callgraph:
-        cfg = cls._load_cfg_from_file(path)
-        code_block_bodies = {}
+    def _from_cfg_fragments(
+            cls,
+            fragments: Iterable[cfg_pb2.CFG],
+            lazy: bool = False,
+            cache_size: int = DEFAULT_LAZY_CACHE_SIZE) -> Callgraph:
+        """Build a callgraph from CFG fragments, one fragment at a time.
+
+        Fields set by later fragments override earlier ones, as when merging
+        the fragments into one CFG message.
+        """
+        eager_bodies: Dict[int, blocks.CodeBlockBody] = {
+            0: blocks.CodeBlockBody(name=0, instructions=''),
+        }
+        eager_functions: Dict[int, blocks.Function] = {}
+        proto_bodies: Dict[int, cfg_pb2.CodeBlockBody] = {
+            0: cfg_pb2.CodeBlockBody(id=0, instructions=''),
+        }
+        proto_functions: Dict[int, cfg_pb2.Function] = {}
+        function_of_code_block: Dict[int, int] = {}
+        entry_point = 0
+        vars_decl_proto = cfg_pb2.CodeBlock()
+        vars_def_proto = cfg_pb2.CodeBlock()
+        for cfg in fragments:
+            if lazy:
+                for proto_cbb in cfg.code_block_bodies:
+                    proto_bodies[proto_cbb.id] = proto_cbb
+                for proto_func in cfg.functions:
+                    proto_functions[proto_func.id] = proto_func
+                    for proto_cb in proto_func.instructions:
+                        function_of_code_block[proto_cb.id] = proto_func.id
+            else:
+                cls._add_cfg_fragment(cfg, eager_bodies, eager_functions)
+            if cfg.entry_point_function:
+                entry_point = cfg.entry_point_function
+            if cfg.HasField('global_vars_decl'):
+                vars_decl_proto = cfg.global_vars_decl
+            if cfg.HasField('global_vars_def'):
+                vars_def_proto = cfg.global_vars_def
+        code_block_bodies: Mapping[int, blocks.CodeBlockBody] = eager_bodies
+        functions: Mapping[int, blocks.Function] = eager_functions
+        code_blocks: Optional[Mapping[int, blocks.CodeBlock]] = None
+        callgraph_cache_size: Optional[int] = None
+        if lazy:
+            lazy_bodies = _LazyMapping(proto_bodies,
+                                       blocks.CodeBlockBody.from_proto,
+                                       cache_size)
+            code_block_bodies = lazy_bodies
+            functions = _LazyMapping(
+                proto_functions,
+                functools.partial(blocks.Function.from_proto,
+                                  code_block_bodies=lazy_bodies), cache_size)
+            code_blocks = _LazyCodeBlocks(function_of_code_block, functions)
+            callgraph_cache_size = cache_size
+        vars_decl = blocks.CodeBlock.from_proto(vars_decl_proto,
+                                                code_block_bodies)
+        vars_def = blocks.CodeBlock.from_proto(vars_def_proto,
+                                               code_block_bodies)
+        return cls(functions=functions,
+                   entry_point=entry_point,
+                   global_vars_decl=vars_decl,
+                   global_vars_def=vars_def,
+                   code_blocks=code_blocks,
+                   cache_size=callgraph_cache_size)
+
+    @staticmethod
+    def _add_cfg_fragment(cfg: cfg_pb2.CFG,
+                          code_block_bodies: Dict[int, blocks.CodeBlockBody],
+                          functions: Dict[int, blocks.Function]) -> None:
         for proto_cbb in cfg.code_block_bodies:
             cbb = blocks.CodeBlockBody.from_proto(proto_cbb)
             code_block_bodies[cbb.name] = cbb
-        if 0 not in code_block_bodies:
-            code_block_bodies[0] = blocks.CodeBlockBody(name=0, instructions='')
-        functions = {}
         for proto_func in cfg.functions:
             func = blocks.Function.from_proto(proto_func, code_block_bodies)
             functions[func.name] = func
-        vars_decl = blocks.CodeBlock.from_proto(cfg.global_vars_decl,
-                                                code_block_bodies)
-        vars_def = blocks.CodeBlock.from_proto(cfg.global_vars_def,
-                                               code_block_bodies)
-        return cls(functions=functions,
-                   entry_point=cfg.entry_point_function,
-                   global_vars_decl=vars_decl,
-                   global_vars_def=vars_def)
 
     @staticmethod
-    def _load_cfg_from_file(path: str) -> cfg_pb2.CFG:
+    def load_cfg(path: str) -> cfg_pb2.CFG:
+        """Read a CFG message from a .pb or .pbtxt file."""
         cfg = cfg_pb2.CFG()
         with open(path, 'rb') as f:
             if path.endswith('pb'):
@@ -89,8 +327,8 @@ class Callgraph:
             target_symbol = self.function_call_signature_for(
                 code_prefetch.target_name)
         elif code_prefetch.type == blocks.TargetType.CODE_BLOCK:
-            target_symbol = '&' + self.format_code_block_label(
-                self.code_blocks[code_prefetch.target_name])
+            target_symbol = '&' + self.code_block_label_for(
+                code_prefetch.target_name)
         prefetch_string = self._create_prefetch_aarch64_string(
             code_prefetch.degree, target_symbol)
         result = ('#ifdef ENABLE_CODE_PREFETCH\n'
@@ -110,8 +348,23 @@ class Callgraph:
         result = ('asm (\n' f'{prefetch_str}' f'::"r"(&{target_symbol}): );\n')
         return result
 
+    def _interned(self, cache: OrderedDict[int, str], key: int,
+                  build: Callable[[], str]) -> str:
+        value = cache.get(key)
+        if value is not None:
+            if self._cache_size is not None:
+                cache.move_to_end(key)
+            return value
+        value = sys.intern(build())
+        cache[key] = value
+        if self._cache_size is not None and len(cache) > self._cache_size:
+            cache.popitem(last=False)
+        return value
+
     def function_call_signature_for(self, function_name: int) -> str:
-        return self.get_function(function_name).get_call_signature()
+        return self._interned(
+            self._call_signatures, function_name,
+            lambda: self.get_function(function_name).get_call_signature())
 
     def get_function(self, function_name: int) -> blocks.Function:
         return self.functions[function_name]
@@ -119,9 +372,20 @@ class Callgraph:
     def format_vars_declaration(self) -> str:
         return self.format_code_block_body(self.global_vars_decl)
 
-    def format_headers(self) -> str:
+    def format_headers(self,
+                       function_names: Optional[Iterable[int]] = None) -> str:
+        """Format function prototypes.
+
+        Args:
+            function_names: Functions to declare. Value of None declares every
+              function in the callgraph.
+        """
+        if function_names is None:
+            functions: Iterable[blocks.Function] = self.functions.values()
+        else:
+            functions = [self.get_function(name) for name in function_names]
         headers = []
-        for function in self.functions.values():
+        for function in functions:
             headers.append(f'{function.get_signature_header()}();')
         out = '\n'.join(headers)
         out += '\n'
@@ -133,6 +397,282 @@ class Callgraph:
         return function.get_branch_targets(
             blocks.Branch.filter(blocks.BranchType.DIRECT_CALL))
 
+    def referenced_functions_for_function(self, function_name: int) -> Set[int]:
+        """Functions called or prefetched by the given function."""
+        function = self.get_function(function_name)
+        referenced: Set[int] = set()
+        for target in function.get_branch_targets(
+                blocks.Branch.filter([
+                    blocks.BranchType.DIRECT_CALL,
+                    blocks.BranchType.INDIRECT_CALL
+                ])):
+            if target is not None:
+                referenced.add(target)
+        for code_block in function.code_blocks:
+            prefetch_inst = code_block.code_block_body.prefetch_inst
+            if (prefetch_inst is not None and
+                    prefetch_inst.type == blocks.TargetType.FUNCTION):
+                referenced.add(prefetch_inst.target_name)
+        return referenced
+
+    def slice(self, function_names: Iterable[int]) -> Callgraph:
+        """Create a callgraph holding only what is needed to format functions.
+
+        The given functions are copied in full. Functions they call or
+        prefetch are reduced to their signatures, and code blocks they refer to
+        in other functions are kept so labels still resolve. The result is
+        much cheaper to send to another process than the whole callgraph.
+
+        Args:
+            function_names: Functions that will be formatted from the slice.
+
+        Returns:
+            A new Callgraph sharing block objects with this one.
+        """
+        functions: Dict[int, blocks.Function] = {}
+        referenced: Set[int] = set()
+        for function_name in function_names:
+            functions[function_name] = self.get_function(function_name)
+            referenced |= self.referenced_functions_for_function(function_name)
+        referenced.add(self.entry_point)
+        for function_name in referenced - functions.keys():
+            function = self.get_function(function_name)
+            functions[function_name] = blocks.Function(
+                name=function.name, signature=function.signature)
+        code_blocks = {
+            cb.name: cb for function in functions.values()
+            for cb in function.code_blocks
+        }
+        for code_block_name in self._referenced_code_blocks(functions.values()):
+            if code_block_name not in code_blocks:
+                code_blocks[code_block_name] = self.code_blocks[code_block_name]
+        result = Callgraph(functions=functions,
+                           entry_point=self.entry_point,
+                           global_vars_decl=self.global_vars_decl,
+                           global_vars_def=self.global_vars_def,
+                           code_blocks=code_blocks)
+        result.target_sequence_length = self.target_sequence_length
+        result.branch_pattern = self.branch_pattern
+        result.pattern_period = self.pattern_period
+        result.unroll_mode = self.unroll_mode
+        return result
+
+    @staticmethod
+    def _referenced_code_blocks(
+            functions: Iterable[blocks.Function]) -> Set[int]:
+        code_block_filter = blocks.Branch.filter([
+            blocks.BranchType.DIRECT, blocks.BranchType.CONDITIONAL_DIRECT,
+            blocks.BranchType.INDIRECT, blocks.BranchType.CONDITIONAL_INDIRECT
+        ])
+        referenced: Set[int] = set()
+        for function in functions:
+            for target in function.get_branch_targets(code_block_filter):
+                if target is not None:
+                    referenced.add(target)
+            for code_block in function.code_blocks:
+                prefetch_inst = code_block.code_block_body.prefetch_inst
+                if (prefetch_inst is not None and
+                        prefetch_inst.type == blocks.TargetType.CODE_BLOCK):
+                    referenced.add(prefetch_inst.target_name)
+        return referenced
+
+    def estimate_function_cost(self, function_name: int) -> int:
+        """Estimate the size of a formatted function without formatting it.
+
+        Formatting draws branch patterns and renders every code block, which
+        costs about as much as writing the function.
+
+        Returns:
+            Approximate number of characters in the formatted function.
+        """
+        function = self.get_function(function_name)
+        cost = len(function.get_signature_header())
+        for code_block in function.code_blocks:
+            cbb = code_block.code_block_body
+            body_cost = 0
+            if cbb.instructions is not None:
+                body_cost = len(cbb.instructions)
+            elif cbb.prefetch_inst is not None:
+                body_cost = (
+                    ESTIMATED_PREFETCH_SIZE +
+                    ESTIMATED_PREFETCH_DEGREE_SIZE * cbb.prefetch_inst.degree)
+            if code_block.unroll_factor > 1:
+                body_cost *= (code_block.unroll_factor
+                              if self.unroll_mode == UNROLL_REPEAT else 2)
+            cost += body_cost
+            branch = code_block.terminator_branch
+            cost += (ESTIMATED_BRANCH_SIZE[branch.branch_type] +
+                     ESTIMATED_BRANCH_TARGET_SIZE * branch.num_targets)
+        return cost
+
+    def call_weights_for_function(self, function_name: int) -> Dict[int, float]:
+        """Expected number of calls to each callee per function invocation.
+
+        Intra-function control flow is followed forward only: a block is
+        reached with the combined probability of the branches leading to it,
+        and backward branches are ignored.
+
+        Returns:
+            A dict mapping callee function names to call counts.
+        """
+        function = self.get_function(function_name)
+        reach = self._code_block_reach_probabilities(function)
+        weights: Dict[int, float] = defaultdict(float)
+        for index, code_block in enumerate(function.code_blocks):
+            branch = code_block.terminator_branch
+            if branch.branch_type not in (blocks.BranchType.DIRECT_CALL,
+                                          blocks.BranchType.INDIRECT_CALL):
+                continue
+            for target, probability in branch.targets:
+                if target is not None:
+                    weights[target] += reach[index] * probability
+        return weights
+
+    @staticmethod
+    def _code_block_reach_probabilities(
+            function: blocks.Function) -> List[float]:
+        index_of: Dict[Optional[int], int] = {
+            code_block.name: index
+            for index, code_block in enumerate(function.code_blocks)
+        }
+        reach = [0.0] * len(function.code_blocks)
+        if reach:
+            reach[0] = 1.0
+        for index, code_block in enumerate(function.code_blocks):
+            branch = code_block.terminator_branch
+            if branch.branch_type == blocks.BranchType.RETURN:
+                continue
+            successors = [(index + 1, 1.0)]
+            if branch.branch_type in (blocks.BranchType.DIRECT,
+                                      blocks.BranchType.CONDITIONAL_DIRECT,
+                                      blocks.BranchType.INDIRECT,
+                                      blocks.BranchType.CONDITIONAL_INDIRECT):
+                # A None target falls through to the next code block.
+                successors = [(index_of.get(target, index + 1), probability)
+                              for target, probability in branch.targets]
+            for successor, probability in successors:
+                if index < successor < len(reach):
+                    reach[successor] += reach[index] * probability
+        return reach
+
+    def function_frequencies(self) -> Dict[int, float]:
+        """Expected number of invocations of each function per benchmark loop.
+
+        Frequencies flow from the entry point along call_weights_for_function
+        in topological order of the call cycles, so every function is visited
+        after all callers outside its own cycle. Inside a cycle, functions are
+        visited once, most frequent first, so recursion does not inflate their
+        counts.
+        """
+        weights_for = self.call_weights_for_function
+        call_weights = {name: weights_for(name) for name in self.functions}
+        frequencies: Dict[int, float] = {name: 0.0 for name in self.functions}
+        if self.entry_point in frequencies:
+            frequencies[self.entry_point] = 1.0
+        visited: Set[int] = set()
+        order = itertools.count()
+        for cycle in self._call_cycles(call_weights):
+            members = set(cycle)
+            to_visit = [
+                (-frequencies[name], next(order), name) for name in cycle
+            ]
+            heapq.heapify(to_visit)
+            while to_visit:
+                function_name = heapq.heappop(to_visit)[2]
+                if function_name in visited:
+                    continue
+                visited.add(function_name)
+                for callee, weight in call_weights[function_name].items():
+                    if callee not in frequencies or callee in visited:
+                        continue
+                    frequencies[callee] += frequencies[function_name] * weight
+                    if callee in members:
+                        heapq.heappush(
+                            to_visit,
+                            (-frequencies[callee], next(order), callee))
+        return frequencies
+
+    @staticmethod
+    def _call_cycles(
+            call_weights: Mapping[int, Mapping[int, float]]) -> List[List[int]]:
+        """Strongly connected components of the call graph, callers first.
+
+        Uses an iterative version of Tarjan's algorithm, since call chains
+        can be much deeper than the recursion limit.
+        """
+        index: Dict[int, int] = {}
+        lowlink: Dict[int, int] = {}
+        stack: List[int] = []
+        on_stack: Set[int] = set()
+        cycles: List[List[int]] = []
+        for root in call_weights:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            to_visit = [(root, iter(call_weights[root]))]
+            while to_visit:
+                function_name, callees = to_visit[-1]
+                for callee in callees:
+                    if callee not in call_weights:
+                        continue
+                    if callee not in index:
+                        index[callee] = lowlink[callee] = len(index)
+                        stack.append(callee)
+                        on_stack.add(callee)
+                        to_visit.append((callee, iter(call_weights[callee])))
+                        break
+                    if callee in on_stack:
+                        lowlink[function_name] = min(lowlink[function_name],
+                                                     index[callee])
+                else:
+                    to_visit.pop()
+                    if to_visit:
+                        caller = to_visit[-1][0]
+                        lowlink[caller] = min(lowlink[caller],
+                                              lowlink[function_name])
+                    if lowlink[function_name] == index[function_name]:
+                        cycle = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.remove(member)
+                            cycle.append(member)
+                            if member == function_name:
+                                break
+                        cycles.append(cycle)
+        # Tarjan's algorithm finds callees before their callers.
+        cycles.reverse()
+        return cycles
+
+    def affinity_weights(self) -> Dict[int, Dict[int, float]]:
+        """How strongly each function is tied to the functions it references.
+
+        The weight of a caller/callee pair is the expected number of calls
+        between them per benchmark loop. Code prefetches add
+        PREFETCH_CALL_WEIGHT times the frequency of the prefetching function.
+
+        Returns:
+            A dict mapping function names to a dict of referenced function
+            names and weights.
+        """
+        frequencies = self.function_frequencies()
+        result: Dict[int, Dict[int, float]] = {}
+        for function_name in self.functions:
+            frequency = frequencies[function_name]
+            weights: Dict[int, float] = defaultdict(float)
+            for callee, weight in self.call_weights_for_function(
+                    function_name).items():
+                weights[callee] += frequency * weight
+            for code_block in self.get_function(function_name).code_blocks:
+                prefetch_inst = code_block.code_block_body.prefetch_inst
+                if (prefetch_inst is not None and
+                        prefetch_inst.type == blocks.TargetType.FUNCTION):
+                    weights[prefetch_inst.target_name] += (frequency *
+                                                           PREFETCH_CALL_WEIGHT)
+            result[function_name] = weights
+        return result
+
     def format_function(self, function_name: int) -> str:
         function = self.get_function(function_name)
         result = function.get_signature_header() + '() {\n'
@@ -149,41 +689,66 @@ class Callgraph:
                 f'{self.format_code_block(codeblock)}')
 
     def format_code_block_label(self, codeblock: blocks.CodeBlock) -> str:
-        return f'label{codeblock.name}'
+        return self.code_block_label_for(codeblock.name)
+
+    def code_block_label_for(self, code_block_name: int) -> str:
+        """Label of a code block in the callgraph, found by name.
+
+        Only checks that the code block exists, so lazy callgraphs do not
+        build the function holding it.
+        """
+        if code_block_name not in self.code_blocks:
+            raise KeyError(code_block_name)
+        return self._interned(self._labels, code_block_name,
+                              lambda: f'label{code_block_name}')
 
     def format_code_block(self, codeblock: blocks.CodeBlock) -> str:
         cbb_text = self.format_code_block_body(codeblock)
-        branch_text = self.format_branch(codeblock.terminator_branch)
+        if codeblock.unroll_factor > 1:
+            cbb_text = self._unroll_code_block_body(codeblock, cbb_text)
+        branch_text = self.format_branch(codeblock.terminator_branch,
+                                         codeblock.name)
         return f'{cbb_text}{branch_text}'
 
-    def format_branch(self, branch: blocks.Branch) -> str:
-        branch_formatters: Dict[blocks.BranchType, Callable] = {
-            blocks.BranchType.INDIRECT_CALL:
-                self._format_branch_indirect_call,
-            blocks.BranchType.DIRECT_CALL:
-                self._format_branch_direct_call,
-            blocks.BranchType.FALLTHROUGH:
-                self._format_branch_fallthrough,
-            blocks.BranchType.UNKNOWN:
-                self._format_branch_fallthrough,
-            blocks.BranchType.CONDITIONAL_DIRECT:
-                self._format_branch_conditional_direct,
-            blocks.BranchType.CONDITIONAL_INDIRECT:
-                self._format_branch_conditional_indirect,
-            blocks.BranchType.INDIRECT:
-                self._format_branch_indirect,
-            blocks.BranchType.DIRECT:
-                self._format_branch_direct,
-            blocks.BranchType.RETURN:
-                self._format_branch_return
-        }
-        if branch.branch_type in branch_formatters:
-            return branch_formatters[branch.branch_type](branch)
-        raise ValueError(f'Unknown branch type: {branch.branch_type}')
+    def _unroll_code_block_body(self, codeblock: blocks.CodeBlock,
+                                cbb_text: str) -> str:
+        """Repeat a code block body unroll_factor times.
+
+        The first copy is left in the scope of the function, so code blocks
+        after it can still use what it declares. Every other copy gets its
+        own scope, either repeated in straight-line code or as the body of a
+        loop.
+        """
+        copies = codeblock.unroll_factor - 1
+        if self.unroll_mode == UNROLL_LOOP:
+            uuid = codeblock.name
+            return (f'{cbb_text}'
+                    f'for (int unroll_{uuid} = 0; unroll_{uuid} < {copies}; '
+                    f'++unroll_{uuid}) ' + '{\n'
+                    f'{cbb_text}'
+                    '}\n')
+        scoped_copy = '{\n' f'{cbb_text}' '}\n'
+        return cbb_text + scoped_copy * copies
+
+    def format_branch(self, branch: blocks.Branch, uuid: int) -> str:
+        """Format the terminator branch of a code block.
+
+        Args:
+            branch: blocks.Branch instance to format.
+            uuid: Unique suffix to use for local variables and labels, usually
+              the name of the code block the branch terminates. Deriving it
+              from the CFG keeps regenerated sources byte-identical.
 
-    def _format_branch_indirect_call(self,
-                                     branch: blocks.Branch,
-                                     uuid: int = None) -> str:
+        Returns:
+            A str representing the branch in C.
+        """
+        formatter = self._BRANCH_FORMATTERS.get(branch.branch_type)
+        if formatter is None:
+            raise ValueError(f'Unknown branch type: {branch.branch_type}')
+        return formatter(self, branch, uuid)
+
+    def _format_branch_indirect_call(self, branch: blocks.Branch,
+                                     uuid: int) -> str:
         """Format an indirect call.
 
         Args:
@@ -192,52 +757,135 @@ class Callgraph:
             uuid: Unique suffix to use for local variables. Used to
               differentiate multiple branches in a single function and to avoid
               any overlapping variables provided in user defined instructions.
-              Leaving unspecified will let the program decide a unique suffix.
 
         Returns:
             A str representing an indirect call in C.
         """
-        if uuid is None:
-            uuid = id(branch)
         if len(branch.get_targets()) == 1:
             return self._format_indirect_call_singletarget(branch, uuid)
         return self._format_indirect_call_multitarget(branch, uuid)
 
     def _format_indirect_call_singletarget(self, branch: blocks.Branch,
                                            uuid: int) -> str:
-        target = branch.next_valid_target()
+        target = branch.next_valid_target(blocks.Branch.random_for(uuid))
         sig = self.function_call_signature_for(target)
         return (f'void (*frontend_{uuid})(void) = {sig};\n'
                 f'frontend_{uuid}();\n')
 
     def _format_indirect_call_multitarget(self, branch: blocks.Branch,
                                           uuid: int) -> str:
-        paths = branch.next_target_sequence()
-        max_index = len(paths)
-        paths_array_name = f'paths_{uuid}'
-        paths_array = self._create_target_sequence_array(
-            paths, paths_array_name)
+        paths_code, path = self._format_branch_pattern(branch, uuid)
         func_array = self._create_call_target_array(branch.get_targets(),
                                                     f'array_{uuid}')
-        result = (
-            f'static int index_{uuid} = 0;\n'
-            f'{paths_array}'
-            f'{func_array}'
-            f'void (*f_{uuid})(void) = '
-            f'array_{uuid}[{paths_array_name}[index_{uuid}++ % {max_index}]];\n'
-            f'f_{uuid}();\n')
+        result = (f'{paths_code}'
+                  f'{func_array}'
+                  f'void (*f_{uuid})(void) = array_{uuid}[{path}];\n'
+                  f'f_{uuid}();\n')
         return result
 
-    def _create_target_sequence_array(self, target_sequence: List[int],
-                                      array_name: str) -> str:
-        max_index = len(target_sequence)
-        target_sequence_formatted = ','.join(
-            [str(target) for target in target_sequence])
-        result = (f'static int {array_name}[{max_index}] = '
-                  '{'
-                  f'{target_sequence_formatted}'
-                  '};\n')
-        return result
+    def _format_branch_pattern(self, branch: blocks.Branch,
+                               uuid: int) -> Tuple[str, str]:
+        """Format the code choosing the next target of a branch.
+
+        Branches with an exact target sequence always store it.
+
+        Args:
+            branch: blocks.Branch with more than one outcome.
+            uuid: Unique suffix of the local variables.
+
+        Returns:
+            The code stepping through the pattern, and an expression of the
+            index of the target it chose.
+        """
+        if (self.branch_pattern == PATTERN_HASH and
+                branch.target_sequence is None):
+            return self._format_hashed_pattern(branch, uuid)
+        return self._format_target_sequence(branch, uuid)
+
+    def _format_hashed_pattern(self, branch: blocks.Branch,
+                               uuid: int) -> Tuple[str, str]:
+        """Format a pattern drawn from a hash of a counter.
+
+        The counter is offset by a salt drawn for the branch so branches
+        follow different patterns, and mixed with the 32-bit finalizer of
+        MurmurHash3. The top bits of the hash are compared with the
+        cumulative probabilities of the targets.
+        """
+        counter = f'counter_{uuid}++'
+        if (self.pattern_period is not None and
+                self.pattern_period < _MAX_PATTERN_PERIOD):
+            counter = f'({counter} & {self.pattern_period - 1}u)'
+        salt = blocks.Branch.random_for(uuid).getrandbits(32)
+        h = f'hash_{uuid}'
+        code = (f'static unsigned int counter_{uuid} = 0;\n'
+                f'unsigned int {h} = {counter} + {salt}u;\n'
+                f'{h} ^= {h} >> 16;\n'
+                f'{h} *= 0x85ebca6bu;\n'
+                f'{h} ^= {h} >> 13;\n'
+                f'{h} *= 0xc2b2ae35u;\n'
+                f'{h} ^= {h} >> 16;\n'
+                f'{h} >>= {32 - _HASH_PATTERN_BITS};\n')
+        scale = 1 << _HASH_PATTERN_BITS
+        choices = []
+        cumulative_probability = 0.0
+        for index, target in enumerate(branch.targets[:-1]):
+            cumulative_probability += target.probability
+            threshold = min(round(cumulative_probability * scale), scale)
+            choices.append(f'{h} < {threshold}u ? {index} : ')
+        path = f'({"".join(choices)}{branch.num_targets - 1})'
+        return code, path
+
+    def _format_target_sequence(self, branch: blocks.Branch,
+                                uuid: int) -> Tuple[str, str]:
+        """Format the target sequence of a branch and a step through it.
+
+        The sequence is stored in the smallest array that holds it: one bit
+        per step for branches with two outcomes, and one byte per step for up
+        to 256 outcomes. Sequences whose length is a power of two are indexed
+        with a mask instead of a division.
+
+        Args:
+            branch: blocks.Branch with more than one outcome.
+            uuid: Unique suffix of the local variables.
+
+        Returns:
+            The code declaring the sequence and moving to its next step, and
+            an expression of the index of the target of that step.
+        """
+        paths = branch.next_target_sequence(self.target_sequence_length,
+                                            blocks.Branch.random_for(uuid))
+        length = len(paths)
+        if length & (length - 1) == 0:
+            step = (f'unsigned int path_{uuid} = '
+                    f'index_{uuid}++ & {length - 1};\n')
+        else:
+            step = (f'unsigned int path_{uuid} = index_{uuid};\n'
+                    f'if (++index_{uuid} == {length}) index_{uuid} = 0;\n')
+        num_outcomes = branch.num_targets
+        if max(paths) >= num_outcomes:
+            raise ValueError(f'Target sequence of branch {uuid} has an index '
+                             f'past its {num_outcomes} targets')
+        if num_outcomes <= 2:
+            packed = [0] * ((length + 7) // 8)
+            for i, target_index in enumerate(paths):
+                packed[i // 8] |= target_index << (i % 8)
+            values = packed
+            element_type = 'unsigned char'
+            path = (f'((paths_{uuid}[path_{uuid} >> 3] >> (path_{uuid} & 7))'
+                    ' & 1)')
+        else:
+            values = paths
+            element_type = ('unsigned char'
+                            if num_outcomes <= 256 else 'unsigned int')
+            path = f'paths_{uuid}[path_{uuid}]'
+        values_formatted = ','.join([str(value) for value in values])
+        code = (f'static unsigned int index_{uuid} = 0;\n'
+                f'static const {element_type} paths_{uuid}[{len(values)}] = '
+                '{'
+                f'{values_formatted}'
+                '};\n'
+                f'{step}')
+        return code, path
 
     def _create_call_target_array(self, targets: List[Optional[int]],
                                   array_name: str) -> str:
@@ -251,67 +899,112 @@ class Callgraph:
         result += '};\n'
         return result
 
-    def _format_branch_direct_call(self, branch: blocks.Branch) -> str:
-        target = branch.next_valid_target()
+    def _format_branch_direct_call(self, branch: blocks.Branch,
+                                   uuid: int) -> str:
+        target = branch.next_valid_target(blocks.Branch.random_for(uuid))
         string = self.function_call_signature_for(target)
         return f'{string}();\n'
 
-    def _format_branch_fallthrough(self, branch: blocks.Branch) -> str:
-        del branch  # Unused.
+    def _format_branch_fallthrough(self, branch: blocks.Branch,
+                                   uuid: int) -> str:
+        del branch, uuid  # Unused.
         return ''
 
-    def _format_branch_conditional_direct(self, branch: blocks.Branch) -> str:
-        paths = branch.next_target_sequence()
-        max_index = len(paths)
-        branch_id = id(branch)
-        paths_array_name = f'paths_{branch_id}'
-        paths_array = self._create_target_sequence_array(
-            paths, paths_array_name)
+    def _format_branch_conditional_direct(self, branch: blocks.Branch,
+                                          uuid: int) -> str:
+        paths_code, path = self._format_branch_pattern(branch, uuid)
         switch_cases = self._build_switch_cases(branch)
-        result = (
-            f'static int index_{branch_id} = 0;\n'
-            f'{paths_array}'
-            f'switch ({paths_array_name}[index_{branch_id}++ % {max_index}]) '
-            '{\n'
-            f'{switch_cases}'
-            '}\n')
+        result = (f'{paths_code}'
+                  f'switch ({path}) '
+                  '{\n'
+                  f'{switch_cases}'
+                  '}\n')
         return result
 
     def _build_switch_cases(self, branch: blocks.Branch) -> str:
         result = ''
-        for i in range(len(branch.targets)):
+        for i in range(branch.num_targets):
             target = branch.get_target_from_index(i)
             new_string = f'case {i}:\n'
             if target is None:
                 # Fallthrough branch
                 new_string = f'{new_string}\tbreak;\n'
             else:
-                label = self.format_code_block_label(self.code_blocks[target])
+                label = self.code_block_label_for(target)
                 new_string = f'{new_string}\tgoto {label};\n'
             result += new_string
         return result
 
-    def _format_branch_conditional_indirect(self, branch: blocks.Branch) -> str:
-        raise ValueError(f'{branch.branch_type} is not implemented')
+    def _format_branch_conditional_indirect(self, branch: blocks.Branch,
+                                            uuid: int) -> str:
+        return self._format_indirect_jump_multitarget(branch, uuid)
 
-    def _format_branch_indirect(self, branch: blocks.Branch) -> str:
-        target = branch.next_valid_target()
-        label = self.format_code_block_label(self.code_blocks[target])
-        branch_id = id(branch)
-        fake_label = f'label{branch_id}'
+    def _format_branch_indirect(self, branch: blocks.Branch, uuid: int) -> str:
+        if branch.num_targets > 1:
+            return self._format_indirect_jump_multitarget(branch, uuid)
+        target = branch.next_valid_target(blocks.Branch.random_for(uuid))
+        label = self.code_block_label_for(target)
+        fake_label = f'label_indirect_{uuid}'
         result = (f'{fake_label}:;\n'
-                  'int label_target = 0;\nvoid* array[] = {'
+                  f'int label_target_{uuid} = 0;\n'
+                  f'void* array_{uuid}[] = ' + '{'
                   f'&&{label}'
                   f', &&{fake_label}'
                   '};\n'
-                  'goto *(array[label_target]);\n')
+                  f'goto *(array_{uuid}[label_target_{uuid}]);\n')
+        return result
+
+    def _format_indirect_jump_multitarget(self, branch: blocks.Branch,
+                                          uuid: int) -> str:
+        """Format an indirect jump through a table of code block labels.
+
+        The jump follows the pattern of the branch. The not taken path of a
+        conditional branch jumps to a label right after the jump.
+        """
+        paths_code, path = self._format_branch_pattern(branch, uuid)
+        fallthrough_label = f'label_fallthrough_{uuid}'
+        labels = []
+        for target in branch.get_targets():
+            if target is None:
+                labels.append(f'&&{fallthrough_label}')
+            else:
+                labels.append(f'&&{self.code_block_label_for(target)}')
+        result = (f'{paths_code}'
+                  f'static void* array_{uuid}[] = ' + '{'
+                  f'{", ".join(labels)}'
+                  '};\n'
+                  f'goto *array_{uuid}[{path}];\n')
+        if None in branch.get_targets():
+            result += f'{fallthrough_label}:;\n'
         return result
 
-    def _format_branch_direct(self, branch: blocks.Branch) -> str:
-        target = branch.next_valid_target()
-        label = self.format_code_block_label(self.code_blocks[target])
+    def _format_branch_direct(self, branch: blocks.Branch, uuid: int) -> str:
+        target = branch.next_valid_target(blocks.Branch.random_for(uuid))
+        label = self.code_block_label_for(target)
         return f'goto {label};\n'
 
-    def _format_branch_return(self, branch: blocks.Branch) -> str:
-        del branch  # Unused.
+    def _format_branch_return(self, branch: blocks.Branch, uuid: int) -> str:
+        del branch, uuid  # Unused.
         return 'return;\n'
+
+    # Formatters of each branch type, built once with the class.
+    _BRANCH_FORMATTERS: Dict[blocks.BranchType, _BranchFormatter] = {
+        blocks.BranchType.INDIRECT_CALL:
+            _format_branch_indirect_call,
+        blocks.BranchType.DIRECT_CALL:
+            _format_branch_direct_call,
+        blocks.BranchType.FALLTHROUGH:
+            _format_branch_fallthrough,
+        blocks.BranchType.UNKNOWN:
+            _format_branch_fallthrough,
+        blocks.BranchType.CONDITIONAL_DIRECT:
+            _format_branch_conditional_direct,
+        blocks.BranchType.CONDITIONAL_INDIRECT:
+            _format_branch_conditional_indirect,
+        blocks.BranchType.INDIRECT:
+            _format_branch_indirect,
+        blocks.BranchType.DIRECT:
+            _format_branch_direct,
+        blocks.BranchType.RETURN:
+            _format_branch_return,
+    }
@@ -0,0 +1,332 @@
+"""Checks a CFG for problems before any code is generated.
+
+Missing branch targets or code block bodies would otherwise surface one at a
+time as exceptions deep inside the code generator, possibly after many files
+were written. The validator visits every function, code block and body once
+and reports every problem it finds together.
+
+    Typical usage example:
+
+    report = validator.validate_file('/path/to/cfg.pb')
+    if not report.ok:
+        print(report.format())
+"""
+from __future__ import annotations
+import math
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from frontend.code_generator import blocks
+from frontend.code_generator import user_callgraph
+from frontend.proto import cfg_pb2
+from frontend.proto import cfg_stream
+
+ERROR = 'error'
+WARNING = 'warning'
+
+# Branch types whose targets are functions, and whose targets are code blocks.
+_CALL_TYPES = frozenset([
+    cfg_pb2.Branch.BranchType.DIRECT_CALL,
+    cfg_pb2.Branch.BranchType.INDIRECT_CALL
+])
+_JUMP_TYPES = frozenset([
+    cfg_pb2.Branch.BranchType.DIRECT, cfg_pb2.Branch.BranchType.INDIRECT,
+    cfg_pb2.Branch.BranchType.CONDITIONAL_DIRECT,
+    cfg_pb2.Branch.BranchType.CONDITIONAL_INDIRECT
+])
+# Branch types whose probabilities may leave room for an implicit fallthrough.
+_CONDITIONAL_TYPES = frozenset([
+    cfg_pb2.Branch.BranchType.CONDITIONAL_DIRECT,
+    cfg_pb2.Branch.BranchType.CONDITIONAL_INDIRECT
+])
+# Branch types that do not need targets.
+_TARGETLESS_TYPES = frozenset([
+    cfg_pb2.Branch.BranchType.UNKNOWN, cfg_pb2.Branch.BranchType.RETURN,
+    cfg_pb2.Branch.BranchType.FALLTHROUGH
+])
+# Kind of body whose instructions match blocks.CALL_SIGNATURE_RE.
+_SIGNATURE = 'signature'
+# Relative tolerance of probability sums, as used by blocks.Branch.
+_PROBABILITY_TOLERANCE = 1e-03
+# Number of unreachable functions named in a report.
+_MAX_UNREACHABLE_NAMED = 10
+
+
+class Problem(NamedTuple):
+    """A problem found in a CFG.
+
+    Attributes:
+        severity: ERROR if code generation would fail or produce a broken
+          benchmark, WARNING otherwise.
+        kind: Short name of the check that failed, e.g. 'missing-target'.
+        message: Description naming the offending IDs.
+    """
+    severity: str
+    kind: str
+    message: str
+
+    def __str__(self) -> str:
+        return f'{self.severity}: [{self.kind}] {self.message}'
+
+
+class ValidationReport(NamedTuple):
+    """Every problem found in a CFG."""
+    problems: List[Problem]
+
+    @property
+    def errors(self) -> List[Problem]:
+        return [p for p in self.problems if p.severity == ERROR]
+
+    @property
+    def warnings(self) -> List[Problem]:
+        return [p for p in self.problems if p.severity == WARNING]
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def format(self) -> str:
+        lines = [str(problem) for problem in self.problems]
+        lines.append(f'{len(self.errors)} errors, '
+                     f'{len(self.warnings)} warnings')
+        return '\n'.join(lines) + '\n'
+
+
+class _Validator:
+    """Collects IDs and references in one pass, then resolves them."""
+
+    def __init__(self) -> None:
+        self.problems: List[Problem] = []
+        self.function_ids: Set[int] = set()
+        # Map from code block ID to the ID of the function holding it. Labels
+        # are local to functions, so jumps cannot leave their function.
+        self.code_block_functions: Dict[int, int] = {}
+        # Map from body ID to the oneof field set in the body, or
+        # _SIGNATURE for instructions that can be used as a signature.
+        self.body_kinds: Dict[int, Optional[str]] = {}
+        # References resolved once every ID is known, as (target ID,
+        # description of the referrer).
+        self.function_refs: List[Tuple[int, str]] = []
+        self.code_block_refs: List[Tuple[int, str]] = []
+        # Jumps and uses of bodies, as (target ID, ID of the function of the
+        # referrer, description of the referrer).
+        self.jump_refs: List[Tuple[int, int, str]] = []
+        self.body_refs: List[Tuple[int, int, str]] = []
+        # Map from body ID to the code block prefetched by the body.
+        self.prefetched_code_blocks: Dict[int, int] = {}
+        self.signature_refs: List[Tuple[int, int]] = []
+        self.call_edges: Dict[int, List[int]] = {}
+        self.entry_point: int = 0
+
+    def error(self, kind: str, message: str) -> None:
+        self.problems.append(Problem(ERROR, kind, message))
+
+    def warning(self, kind: str, message: str) -> None:
+        self.problems.append(Problem(WARNING, kind, message))
+
+    def add_fragment(self, cfg: cfg_pb2.CFG) -> None:
+        for body in cfg.code_block_bodies:
+            self._add_body(body)
+        for function in cfg.functions:
+            self._add_function(function)
+        if cfg.entry_point_function:
+            self.entry_point = cfg.entry_point_function
+
+    def _add_body(self, body: cfg_pb2.CodeBlockBody) -> None:
+        if body.id in self.body_kinds:
+            self.error(
+                'duplicate-id', f'code block body {body.id} is defined '
+                'more than once')
+        kind: Optional[str] = body.WhichOneof('body')
+        if kind is None:
+            self.error(
+                'empty-body',
+                f'code block body {body.id} has no instructions or '
+                'code prefetch')
+        elif kind == 'code_prefetch':
+            self._add_prefetch(body)
+        elif blocks.CALL_SIGNATURE_RE.search(body.instructions):
+            kind = _SIGNATURE
+        self.body_kinds[body.id] = kind
+
+    def _add_prefetch(self, body: cfg_pb2.CodeBlockBody) -> None:
+        prefetch = body.code_prefetch
+        where = f'code prefetch in body {body.id}'
+        if prefetch.degree <= 0:
+            self.error('bad-prefetch', f'{where} has degree {prefetch.degree}')
+        if prefetch.type == cfg_pb2.CodePrefetchInst.TargetType.FUNCTION:
+            self.function_refs.append((prefetch.target_id, where))
+        elif prefetch.type == cfg_pb2.CodePrefetchInst.TargetType.CODE_BLOCK:
+            self.code_block_refs.append((prefetch.target_id, where))
+            self.prefetched_code_blocks[body.id] = prefetch.target_id
+        else:
+            self.error('bad-prefetch', f'{where} has no target type')
+
+    def _add_function(self, function: cfg_pb2.Function) -> None:
+        if function.id in self.function_ids:
+            self.error('duplicate-id',
+                       f'function {function.id} is defined more than once')
+        self.function_ids.add(function.id)
+        self.signature_refs.append(
+            (function.signature.code_block_body_id, function.id))
+        callees = self.call_edges.setdefault(function.id, [])
+        for code_block in function.instructions:
+            self._add_code_block(code_block, function.id, callees)
+
+    def _add_code_block(self, code_block: cfg_pb2.CodeBlock, function_id: int,
+                        callees: List[int]) -> None:
+        where = f'code block {code_block.id} in function {function_id}'
+        if code_block.id in self.code_block_functions:
+            self.error('duplicate-id', f'{where} reuses a code block ID')
+        self.code_block_functions[code_block.id] = function_id
+        if code_block.code_block_body_id:
+            self.body_refs.append(
+                (code_block.code_block_body_id, function_id, where))
+        self._add_branch(code_block.terminator_branch, function_id, where,
+                         callees)
+
+    def _add_branch(self, branch: cfg_pb2.Branch, function_id: int, where: str,
+                    callees: List[int]) -> None:
+        branch_type = branch.type
+        type_name = cfg_pb2.Branch.BranchType.Name(branch_type)
+        where = f'{type_name} branch of {where}'
+        targets = branch.targets
+        if branch_type in _TARGETLESS_TYPES:
+            return
+        if not targets:
+            self.error('missing-target', f'{where} has no targets')
+            return
+        if branch.target_sequence:
+            self._check_target_sequence(branch, where)
+        # Without probabilities, they follow from the target sequence.
+        if branch.taken_probability or not branch.target_sequence:
+            self._check_probabilities(branch, where)
+        if branch_type in _CALL_TYPES:
+            for target in targets:
+                self.function_refs.append((target, where))
+                callees.append(target)
+        elif branch_type in _JUMP_TYPES:
+            for target in targets:
+                self.jump_refs.append((target, function_id, where))
+
+    def _check_probabilities(self, branch: cfg_pb2.Branch, where: str) -> None:
+        probabilities = branch.taken_probability
+        if len(probabilities) != len(branch.targets):
+            self.error(
+                'bad-probability', f'{where} has {len(branch.targets)} targets '
+                f'but {len(probabilities)} probabilities')
+        if any(p < 0 or p > 1 for p in probabilities):
+            self.error('bad-probability',
+                       f'{where} has a probability outside [0, 1]')
+        total = sum(probabilities)
+        if branch.type in _CONDITIONAL_TYPES:
+            if total > 1 + _PROBABILITY_TOLERANCE:
+                self.error('bad-probability',
+                           f'{where} has probabilities summing to {total:g}')
+        elif not math.isclose(total, 1.0, rel_tol=_PROBABILITY_TOLERANCE):
+            self.error('bad-probability',
+                       f'{where} has probabilities summing to {total:g}')
+
+    def _check_target_sequence(self, branch: cfg_pb2.Branch,
+                               where: str) -> None:
+        num_indices = len(branch.targets)
+        if branch.type in _CONDITIONAL_TYPES:
+            # The index past the last target is the fallthrough.
+            num_indices += 1
+        if any(index < 0 or index >= num_indices
+               for index in branch.target_sequence):
+            self.error(
+                'bad-sequence', f'{where} has a target sequence index outside '
+                f'[0, {num_indices})')
+
+    def resolve(self) -> None:
+        """Check references and reachability once every ID is known."""
+        for target, where in self.function_refs:
+            if target not in self.function_ids:
+                self.error('missing-target',
+                           f'{where} targets missing function {target}')
+        for target, where in self.code_block_refs:
+            if target not in self.code_block_functions:
+                self.error('missing-target',
+                           f'{where} targets missing code block {target}')
+        for target, function_id, where in self.jump_refs:
+            owner = self.code_block_functions.get(target)
+            if owner is None:
+                self.error('missing-target',
+                           f'{where} targets missing code block {target}')
+            elif owner != function_id:
+                self.error(
+                    'cross-function', f'{where} jumps to code block {target} '
+                    f'of function {owner}')
+        for body_id, function_id, where in self.body_refs:
+            if body_id not in self.body_kinds:
+                self.error('missing-body',
+                           f'{where} uses missing code block body {body_id}')
+            elif body_id in self.prefetched_code_blocks:
+                self._check_prefetch_owner(body_id, function_id, where)
+        for body_id, function_id in self.signature_refs:
+            self._check_signature(body_id, function_id)
+        conflicts = self.function_ids & self.code_block_functions.keys()
+        if conflicts:
+            self.warning(
+                'shared-id', f'{len(conflicts)} IDs name both a function and a '
+                f'code block, e.g. {min(conflicts)}')
+        self._check_entry_point()
+
+    def _check_prefetch_owner(self, body_id: int, function_id: int,
+                              where: str) -> None:
+        target = self.prefetched_code_blocks[body_id]
+        owner = self.code_block_functions.get(target, function_id)
+        if owner != function_id:
+            self.error(
+                'cross-function', f'{where} prefetches code block {target} '
+                f'of function {owner}')
+
+    def _check_signature(self, body_id: int, function_id: int) -> None:
+        if body_id not in self.body_kinds:
+            self.error(
+                'missing-body', f'signature of function {function_id} uses '
+                f'missing code block body {body_id}')
+        elif self.body_kinds[body_id] != _SIGNATURE:
+            self.error(
+                'bad-signature', f'signature of function {function_id} in '
+                f'body {body_id} is not of the form "<type> <name>"')
+
+    def _check_entry_point(self) -> None:
+        if self.entry_point not in self.function_ids:
+            self.error('missing-entry',
+                       f'entry point function {self.entry_point} is missing')
+            return
+        reachable = {self.entry_point}
+        to_visit = [self.entry_point]
+        while to_visit:
+            for callee in self.call_edges.get(to_visit.pop(), ()):
+                if callee not in reachable:
+                    reachable.add(callee)
+                    to_visit.append(callee)
+        unreachable = sorted(self.function_ids - reachable)
+        if unreachable:
+            named = ', '.join(
+                str(f) for f in unreachable[:_MAX_UNREACHABLE_NAMED])
+            self.warning(
+                'unreachable', f'{len(unreachable)} functions are never called '
+                f'from the entry point: {named}')
+
+
+def _validate_fragments(fragments: Iterable[cfg_pb2.CFG]) -> ValidationReport:
+    validator = _Validator()
+    for fragment in fragments:
+        validator.add_fragment(fragment)
+    validator.resolve()
+    return ValidationReport(validator.problems)
+
+
+def validate(cfg: cfg_pb2.CFG) -> ValidationReport:
+    """Check a CFG message and report every problem found."""
+    return _validate_fragments([cfg])
+
+
+def validate_file(path: str) -> ValidationReport:
+    """Check a .pb, .pbtxt or .pbstream file and report every problem found."""
+    if path.endswith(cfg_stream.STREAM_SUFFIX):
+        with open(path, 'rb') as f:
+            return _validate_fragments(cfg_stream.read_cfg_fragments(f))
+    return validate(user_callgraph.Callgraph.load_cfg(path))
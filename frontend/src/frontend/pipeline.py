@@ -0,0 +1,50 @@
+"""Generate benchmark sources from a CFG held in memory.
+
+Running generate_benchmark and then the code generator driver serializes the
+CFG to a file and parses it back. The pipeline passes the CFG message, or the
+generator producing it, straight to the source generator, and only writes the
+CFG to disk when asked to keep it as an artifact.
+
+    Typical usage example:
+
+    generator = dfs_chase_gen.DFSChaseGenerator(10, False, 0.5, False)
+    pipeline.generate_sources(generator, '/tmp/generated/', num_files=24)
+"""
+from typing import Any, Optional, Union
+from frontend.cfg_generator import common
+from frontend.code_generator import source_generator
+from frontend.code_generator import user_callgraph
+from frontend.proto import cfg_pb2
+
+
+def generate_sources(
+        cfg: Union[cfg_pb2.CFG, common.BaseGenerator],
+        output_directory: str,
+        num_files: Optional[int] = None,
+        jobs: int = 1,
+        cfg_path: Optional[str] = None,
+        **source_generator_options: Any) -> user_callgraph.Callgraph:
+    """Write the sources and build files of a benchmark.
+
+    Args:
+        cfg: CFG of the benchmark, or a generator whose CFG is generated.
+        output_directory: Directory the sources are written to.
+        num_files: Number of C files holding the functions.
+        jobs: Number of processes rendering C files.
+        cfg_path: If set, the CFG is also written to this .pb, .pbtxt or
+          .pbstream file.
+        **source_generator_options: Keyword arguments of SourceGenerator, such
+          as build_profile or partition_strategy.
+
+    Returns:
+        The callgraph the sources were generated from.
+    """
+    if isinstance(cfg, common.BaseGenerator):
+        cfg = cfg.generate_cfg()
+    if cfg_path is not None:
+        common.write_cfg(cfg, cfg_path)
+    callgraph = user_callgraph.Callgraph.from_cfg(cfg)
+    sg = source_generator.SourceGenerator(output_directory, callgraph,
+                                          **source_generator_options)
+    sg.write_files(num_files, jobs)
+    return callgraph
@@ -0,0 +1,79 @@
+"""Read and write CFGs as streams of length-delimited CFG fragments.
+
+A stream is a sequence of records, each a varint byte length followed by a
+serialized CFG message holding some functions and code block bodies. Merging
+all fragments in order gives the complete CFG. Code block bodies are always
+written no later than the fragment of the first function using them, so a
+reader can build functions one fragment at a time without holding the whole
+message in memory.
+"""
+from typing import BinaryIO, Iterator, Optional
+from frontend.proto import cfg_pb2
+
+# File suffix identifying a streamed CFG.
+STREAM_SUFFIX = '.pbstream'
+
+
+def _encode_varint(value: int) -> bytes:
+    result = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if not value:
+            result.append(bits)
+            return bytes(result)
+        result.append(bits | 0x80)
+
+
+def _read_varint(f: BinaryIO) -> Optional[int]:
+    """Read a varint, or return None at the end of the stream."""
+    result = 0
+    shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            if shift:
+                raise ValueError('Truncated record length in CFG stream')
+            return None
+        result |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            return result
+        shift += 7
+
+
+class CFGStreamWriter:
+    """Writes CFG fragments to a binary file.
+
+        Typical usage example:
+
+        with open('/tmp/cfg.pbstream', 'wb') as f:
+            writer = CFGStreamWriter(f)
+            writer.write(fragment)
+    """
+
+    def __init__(self, f: BinaryIO) -> None:
+        self._file: BinaryIO = f
+        self.num_fragments: int = 0
+
+    def write(self, fragment: cfg_pb2.CFG) -> None:
+        self.write_serialized(fragment.SerializeToString())
+
+    def write_serialized(self, data: bytes) -> None:
+        """Write a fragment that is already serialized."""
+        self._file.write(_encode_varint(len(data)))
+        self._file.write(data)
+        self.num_fragments += 1
+
+
+def read_cfg_fragments(f: BinaryIO) -> Iterator[cfg_pb2.CFG]:
+    """Yield the CFG fragments of a stream in order."""
+    while True:
+        size = _read_varint(f)
+        if size is None:
+            return
+        data = f.read(size)
+        if len(data) != size:
+            raise ValueError('Truncated record in CFG stream')
+        fragment = cfg_pb2.CFG()
+        fragment.ParseFromString(data)
+        yield fragment
@@ -0,0 +1,82 @@
+"""Tests for common."""
+
+import unittest
+from frontend.cfg_generator import common
+
+
+class IDAllocatorTest(unittest.TestCase):
+
+    def test_next(self):
+        ids = common.IDAllocator()
+        self.assertEqual([ids.next() for _ in range(3)], [1, 2, 3])
+
+    def test_allocators_are_independent(self):
+        first = common.IDAllocator()
+        second = common.IDAllocator()
+        first.next()
+        self.assertEqual(second.next(), 1)
+
+    def test_reserve(self):
+        ids = common.IDAllocator()
+        reserved = ids.reserve(2)
+        self.assertEqual(ids.next(), 3)
+        self.assertEqual(reserved.next(), 1)
+        self.assertEqual(reserved.next(), 2)
+        with self.assertRaises(RuntimeError):
+            reserved.next()
+
+    def test_reserve_within_range(self):
+        reserved = common.IDAllocator().reserve(10)
+        nested = reserved.reserve(4)
+        self.assertEqual(nested.next(), 1)
+        self.assertEqual(reserved.next(), 5)
+        with self.assertRaises(RuntimeError):
+            reserved.reserve(6)
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_split_into_shards(self):
+        # pylint: disable=protected-access
+        generator = common.BaseGenerator(jobs=2)
+        shards = generator._split_into_shards(range(16))
+        self.assertEqual(len(shards), 2 * common.SHARDS_PER_JOB)
+        self.assertEqual([item for shard in shards for item in shard],
+                         list(range(16)))
+
+    def test_shard_size_is_bounded(self):
+        # pylint: disable=protected-access
+        generator = common.BaseGenerator(jobs=2)
+        num_items = 10 * common.MAX_FUNCTIONS_PER_SHARD
+        shards = generator._split_into_shards(range(num_items))
+        self.assertEqual(len(shards), 10)
+        self.assertLessEqual(max(len(shard) for shard in shards),
+                             common.MAX_FUNCTIONS_PER_SHARD)
+
+
+class FootprintTest(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(common.parse_size('4096'), 4096)
+        self.assertEqual(common.parse_size('256KiB'), 256 * 1024)
+        self.assertEqual(common.parse_size('8MiB'), 8 * 1024 * 1024)
+        self.assertEqual(common.parse_size('1.5 mb'), 3 * 512 * 1024)
+        with self.assertRaises(ValueError):
+            common.parse_size('8 parsecs')
+
+    def test_padding_instructions(self):
+        self.assertEqual(common.padding_instructions(0), '')
+        padding = common.padding_instructions(256)
+        self.assertIn(
+            '#if defined(__aarch64__)\n'
+            'asm volatile(".rept 64\\n\\tnop\\n\\t.endr");\n', padding)
+        self.assertIn('asm volatile(".rept 256\\n\\tnop\\n\\t.endr");\n',
+                      padding)
+
+    def test_padding_for_footprint(self):
+        self.assertEqual(common.padding_for_footprint(1000, 10, 60), 40)
+        self.assertEqual(common.padding_for_footprint(1000, 10, 200), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,12 @@
 # pylint: disable=protected-access
 
 from frontend.proto import cfg_pb2
+from frontend.proto import cfg_stream
+from frontend.cfg_generator import common
 from frontend.cfg_generator import dfs_chase_gen
+import io
 import unittest
+from unittest import mock
 
 
 class DirectCallDFSChaseGenTest(unittest.TestCase):
@@ -16,16 +20,18 @@ class DirectCallDFSChaseGenTest(unittest.TestCase):
                                                    self.branch_probability,
                                                    False)
 
-    def test_generate_function_tree(self):
-        self.gen._generate_function_tree()
-        # A full binary tree of depth N has 2^n-1 nodes. function_tree only
-        # includes functions that call others, so the leaves in the last layer
-        # of the tree are excluded. Hence the expected number of nodes is
-        # 2^(n-1) - 1.
-        self.assertEqual(len(self.gen._function_tree), 2**(self.depth - 1) - 1)
-        for children in self.gen._function_tree.values():
-            if children:
-                self.assertEqual(len(children), 2)
+    def test_callees(self):
+        self.gen._allocate_function_ids()
+        functions = list(self.gen._functions_in_bfs_order())
+        # A full binary tree of depth N has 2^n-1 nodes, of which the 2^(n-1)
+        # leaves in the last layer call no other function.
+        self.assertEqual(len(functions), 2**self.depth - 1)
+        callers = [f for f in functions if self.gen._callees(f) is not None]
+        self.assertEqual(len(callers), 2**(self.depth - 1) - 1)
+        # Every function but the root is called by exactly one caller.
+        callees = [c for f in callers for c in self.gen._callees(f)]
+        self.assertEqual(sorted(callees), functions[1:])
+        self.assertEqual(self.gen._callees(self.gen._root_func), functions[1:3])
 
     def test_generate_conditional_branch_code_blocks(self):
         callees = [2, 3]  # Function IDs.
@@ -57,11 +63,11 @@ class DirectCallDFSChaseGenTest(unittest.TestCase):
                          cfg_pb2.Branch.BranchType.RETURN)
 
     def test_generate_functions(self):
-        self.gen._generate_function_tree()
+        self.gen._allocate_function_ids()
         self.gen._generate_functions()
         self.assertEqual(len(self.gen._functions), 2**(self.depth) - 1)
         for func_id, func in self.gen._functions.items():
-            if func_id in self.gen._function_tree:
+            if self.gen._callees(func_id) is not None:
                 # Functions that call other functions have 5 call blocks.
                 self.assertEqual(len(func.instructions), 5)
             else:
@@ -81,6 +87,114 @@ class DirectCallDFSChaseGenTest(unittest.TestCase):
         expected_codeblock_bodies = len(self.gen._functions) + 1
         self.assertEqual(len(cfg.code_block_bodies), expected_codeblock_bodies)
 
+    def test_generate_cfg_reproducible(self):
+        # Generators number IDs independently of each other.
+        other = dfs_chase_gen.DFSChaseGenerator(self.depth, False,
+                                                self.branch_probability, False)
+        self.assertEqual(self.gen.generate_cfg(), other.generate_cfg())
+
+    def test_generate_cfg_in_parallel(self):
+        expected = self.gen.generate_cfg()
+        gen = dfs_chase_gen.DFSChaseGenerator(self.depth,
+                                              False,
+                                              self.branch_probability,
+                                              False,
+                                              jobs=2)
+        cfg = gen.generate_cfg()
+        self.assertEqual(cfg.entry_point_function,
+                         expected.entry_point_function)
+        self.assertEqual([func.id for func in cfg.functions],
+                         [func.id for func in expected.functions])
+        self.assertEqual(len(cfg.code_block_bodies),
+                         len(expected.code_block_bodies))
+        # Workers allocate IDs from disjoint ranges.
+        code_block_ids = [
+            block.id for func in cfg.functions for block in func.instructions
+        ]
+        self.assertEqual(len(code_block_ids), len(set(code_block_ids)))
+
+    def test_stream_cfg_in_parallel(self):
+        gen = dfs_chase_gen.DFSChaseGenerator(self.depth,
+                                              False,
+                                              self.branch_probability,
+                                              False,
+                                              jobs=2)
+        buffer = io.BytesIO()
+        gen.stream_cfg(cfg_stream.CFGStreamWriter(buffer))
+        buffer.seek(0)
+        body_ids = set()
+        num_functions = 0
+        for fragment in cfg_stream.read_cfg_fragments(buffer):
+            body_ids.update(body.id for body in fragment.code_block_bodies)
+            for func in fragment.functions:
+                num_functions += 1
+                # Bodies are streamed no later than the functions using them.
+                # Blocks without a body have body ID 0.
+                for block in func.instructions:
+                    if block.code_block_body_id:
+                        self.assertIn(block.code_block_body_id, body_ids)
+        self.assertEqual(num_functions, 2**self.depth - 1)
+
+    def test_stream_cfg_in_parallel_with_small_shards(self):
+        # More shards than the number submitted at once are still written in
+        # order.
+        gen = dfs_chase_gen.DFSChaseGenerator(5,
+                                              False,
+                                              self.branch_probability,
+                                              False,
+                                              jobs=2)
+        buffer = io.BytesIO()
+        with mock.patch.object(common, 'MAX_FUNCTIONS_PER_SHARD', 2):
+            gen.stream_cfg(cfg_stream.CFGStreamWriter(buffer))
+        buffer.seek(0)
+        function_ids = [
+            func.id
+            for fragment in cfg_stream.read_cfg_fragments(buffer)
+            for func in fragment.functions
+        ]
+        self.assertEqual(function_ids, list(gen._functions_in_bfs_order()))
+
+    def test_stream_cfg(self):
+        buffer = io.BytesIO()
+        writer = cfg_stream.CFGStreamWriter(buffer)
+        self.gen.stream_cfg(writer)
+        # One fragment per function, plus the final one with the entry point.
+        self.assertEqual(writer.num_fragments, 2**self.depth)
+        # Streamed functions are not kept in memory.
+        self.assertFalse(self.gen._functions)
+        self.assertFalse(self.gen._code_block_bodies)
+
+        buffer.seek(0)
+        cfg = cfg_pb2.CFG()
+        for fragment in cfg_stream.read_cfg_fragments(buffer):
+            cfg.MergeFrom(fragment)
+        self.assertEqual(cfg.entry_point_function, self.gen._root_func)
+        self.assertEqual(len(cfg.functions), 2**self.depth - 1)
+        self.assertEqual(len(cfg.code_block_bodies), 2**self.depth)
+
+
+class FootprintDFSChaseGenTest(unittest.TestCase):
+
+    def test_solve_for_footprint(self):
+        depth, padding = dfs_chase_gen.solve_for_footprint(256 * 1024, 0)
+        num_functions = 2**depth - 1
+        self.assertEqual(depth, 11)
+        self.assertEqual(
+            num_functions * (dfs_chase_gen.ESTIMATED_FUNCTION_SIZE + padding),
+            256 * 1024 - 256 * 1024 % num_functions)
+
+    def test_solve_for_footprint_keeps_body_size(self):
+        _, padding = dfs_chase_gen.solve_for_footprint(256 * 1024, 1000)
+        self.assertGreaterEqual(padding, 1000)
+
+    def test_function_body_size(self):
+        gen = dfs_chase_gen.DFSChaseGenerator(3,
+                                              False,
+                                              0.5,
+                                              False,
+                                              function_body_size=64)
+        self.assertIn('.rept 64', gen._function_body.instructions)
+
 
 class IndirectCallDFSChaseGenTest(unittest.TestCase):
 
@@ -2,6 +2,7 @@
 # Access to protected class members is common for unit tests.
 # pylint: disable=protected-access
 
+import random
 import unittest
 from frontend.proto import cfg_pb2
 from frontend.cfg_generator import inst_pointer_chase_gen
@@ -121,6 +122,105 @@ class InstPointerChaseGeneratorTest(unittest.TestCase):
         self.assertEqual(len(cfg.code_block_bodies), num_total_functions + 1)
 
 
+class PermutationInstPointerChaseGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.depth = 4
+        self.num_callchains = 5
+
+    def _generate_callchain_mappings(self, seed, use_numpy=False):
+        gen = inst_pointer_chase_gen.InstPointerChaseGenerator(
+            self.depth,
+            self.num_callchains,
+            False,  # insert_code_prefetches
+            use_numpy=use_numpy)
+        random.seed(seed)
+        gen._generate_callchain_mappings()
+        return gen
+
+    def _callchains(self, gen):
+        callchains = []
+        for caller in gen._callchain_entry_functions:
+            callchain = [caller]
+            while gen._caller2callee[
+                    caller] != inst_pointer_chase_gen.NO_CALLEE:
+                caller = gen._caller2callee[caller]
+                callchain.append(caller)
+            callchains.append(callchain)
+        return callchains
+
+    def _check_callchains(self, gen):
+        callchains = self._callchains(gen)
+        self.assertEqual(len(callchains), self.num_callchains)
+        functions = []
+        for callchain in callchains:
+            self.assertEqual(len(callchain), self.depth)
+            functions.extend(callchain)
+        # Every function is in exactly one callchain.
+        self.assertEqual(sorted(functions),
+                         list(range(self.depth * self.num_callchains)))
+
+    def test_generate_callchain_mappings(self):
+        self._check_callchains(self._generate_callchain_mappings(seed=1))
+
+    def test_generate_callchain_mappings_reproducible(self):
+        first = self._generate_callchain_mappings(seed=1)
+        second = self._generate_callchain_mappings(seed=1)
+        self.assertEqual(self._callchains(first), self._callchains(second))
+
+    def test_generate_cfg_in_parallel(self):
+        gen = inst_pointer_chase_gen.InstPointerChaseGenerator(
+            self.depth,
+            self.num_callchains,
+            True,  # insert_code_prefetches
+            jobs=2)
+        random.seed(1)
+        cfg = gen.generate_cfg()
+        # +1 accounts for the entry function.
+        self.assertEqual(len(cfg.functions),
+                         self.depth * self.num_callchains + 1)
+        self.assertEqual(cfg.entry_point_function, gen._entry_function_id)
+        # Functions keep the order of the callchains.
+        self.assertEqual([func.id for func in cfg.functions[:-1]],
+                         list(gen._caller2callee))
+        for func in cfg.functions[:-1]:
+            callee = gen._caller2callee[func.id]
+            if callee != inst_pointer_chase_gen.NO_CALLEE:
+                self.assertEqual(
+                    func.instructions[-1].terminator_branch.targets, [callee])
+        body_ids = [body.id for body in cfg.code_block_bodies]
+        self.assertEqual(len(body_ids), len(set(body_ids)))
+
+    def test_generate_callchain_mappings_numpy(self):
+        try:
+            # pylint: disable-next=import-outside-toplevel,unused-import
+            import numpy  # type: ignore[import]
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        first = self._generate_callchain_mappings(seed=1, use_numpy=True)
+        second = self._generate_callchain_mappings(seed=1, use_numpy=True)
+        self._check_callchains(first)
+        self.assertEqual(self._callchains(first), self._callchains(second))
+
+
+class FootprintInstPointerChaseGeneratorTest(unittest.TestCase):
+
+    def test_solve_for_footprint(self):
+        num_callchains, padding = inst_pointer_chase_gen.solve_for_footprint(
+            1024 * 1024, 20, 1024)
+        self.assertEqual(num_callchains, 47)
+        function_size = (inst_pointer_chase_gen.ESTIMATED_FUNCTION_SIZE +
+                         padding)
+        self.assertAlmostEqual(num_callchains * 20 * function_size / 1024**2,
+                               1,
+                               places=3)
+
+    def test_function_body_size(self):
+        gen = inst_pointer_chase_gen.InstPointerChaseGenerator(
+            2, 2, False, function_body_size=128)
+        self.assertIn('.rept 128', gen._function_body.instructions)
+
+
 class CodePrefetchInstPointerChaseGeneratorTest(unittest.TestCase):
 
     def setUp(self):
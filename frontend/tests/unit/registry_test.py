@@ -0,0 +1,70 @@
+"""Tests for registry and generate_benchmark."""
+# pylint: disable=protected-access
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+from frontend.proto import cfg_pb2
+from frontend.cfg_generator import dfs_chase_gen
+from frontend.cfg_generator import generate_benchmark
+from frontend.cfg_generator import registry
+
+try:
+    from importlib import metadata
+except ImportError:
+    import importlib_metadata as metadata  # type: ignore
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_generator_names(self):
+        names = registry.generator_names()
+        self.assertIn(dfs_chase_gen.MODULE_NAME, names)
+        self.assertIn('inst_pointer_chase_gen', names)
+
+    def test_load_generator_module(self):
+        module = registry.load_generator_module(dfs_chase_gen.MODULE_NAME)
+        self.assertIs(module, dfs_chase_gen)
+
+    def test_load_unknown_generator_module(self):
+        with self.assertRaises(ValueError):
+            registry.load_generator_module('no_such_gen')
+
+    def test_plugin_entry_points(self):
+        entry_points = [
+            metadata.EntryPoint('my_gen', 'my_package.my_gen:register',
+                                registry.ENTRY_POINT_GROUP)
+        ]
+        with mock.patch.object(metadata,
+                               'entry_points',
+                               return_value=mock.Mock(select=mock.Mock(
+                                   return_value=entry_points))):
+            self.assertEqual(registry._entry_point_modules(),
+                             {'my_gen': 'my_package.my_gen'})
+            self.assertIn('my_gen', registry.generator_names())
+            self.assertNotIn('my_gen',
+                             registry.generator_names(include_plugins=False))
+
+    def test_generate_benchmark_does_not_scan_plugins(self):
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.object(
+                registry, '_entry_point_modules') as entry_point_modules:
+            generate_benchmark.main([
+                dfs_chase_gen.MODULE_NAME, '--depth=2',
+                os.path.join(tmpdir, 'cfg.pb')
+            ])
+        entry_point_modules.assert_not_called()
+
+    def test_generate_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cfg.pb')
+            generate_benchmark.main(
+                [dfs_chase_gen.MODULE_NAME, '--depth=3', path])
+            cfg = cfg_pb2.CFG()
+            with open(path, 'rb') as f:
+                cfg.ParseFromString(f.read())
+        self.assertEqual(len(cfg.functions), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,11 @@
 # pylint: disable=protected-access
 import pytest
 import os
+import re
 from frontend.code_generator import user_callgraph
 from frontend.code_generator import blocks
+from frontend.proto import cfg_pb2
+from frontend.proto import cfg_stream
 
 
 @pytest.fixture
@@ -26,6 +29,76 @@ def test_callgraph_from_proto_file(resources):
     assert len(cfg.functions.keys()) > 10
 
 
+def test_callgraph_from_stream_file(resources, tmp_path):
+    path = os.path.join(resources, 'onecallchain.pbtxt')
+    cfg_proto = user_callgraph.Callgraph.load_cfg(path)
+    stream_path = str(tmp_path / 'cfg.pbstream')
+    with open(stream_path, 'wb') as f:
+        writer = cfg_stream.CFGStreamWriter(f)
+        # Bodies first, then every function in its own fragment.
+        fragment = cfg_pb2.CFG()
+        fragment.code_block_bodies.extend(cfg_proto.code_block_bodies)
+        writer.write(fragment)
+        for function in cfg_proto.functions:
+            fragment = cfg_pb2.CFG()
+            fragment.functions.append(function)
+            writer.write(fragment)
+        fragment = cfg_pb2.CFG()
+        fragment.entry_point_function = cfg_proto.entry_point_function
+        writer.write(fragment)
+
+    expected = user_callgraph.Callgraph.from_proto(path)
+    cfg = user_callgraph.Callgraph.from_proto(stream_path)
+    assert cfg.entry_point == expected.entry_point
+    assert list(cfg.functions) == list(expected.functions)
+    for function_name in expected.functions:
+        expected_function = expected.format_function(function_name)
+        assert cfg.format_function(function_name) == expected_function
+
+
+def test_lazy_callgraph_bounds_built_functions(resources):
+    path = os.path.join(resources, 'cfg.pb')
+    expected = user_callgraph.Callgraph.from_proto(path)
+    cfg = user_callgraph.Callgraph.from_proto(path, lazy=True, cache_size=2)
+    assert list(cfg.functions) == list(expected.functions)
+    assert list(cfg.code_blocks) == list(expected.code_blocks)
+    assert cfg.format_headers() == expected.format_headers()
+    assert len(cfg.functions._cache) == 2
+    function_name = next(iter(expected.functions))
+    assert function_name in cfg.functions
+    code_block_name = expected.get_function(function_name).code_blocks[0].name
+    assert cfg.code_blocks[code_block_name].name == code_block_name
+
+
+def test_lazy_callgraph_labels_do_not_build_functions(resources):
+    path = os.path.join(resources, 'cfg.pb')
+    cfg = user_callgraph.Callgraph.from_proto(path, lazy=True, cache_size=2)
+    code_block_names = list(cfg.code_blocks)
+    for code_block_name in code_block_names:
+        label = cfg.code_block_label_for(code_block_name)
+        assert label == f'label{code_block_name}'
+    assert not cfg.functions._cache
+    assert list(cfg._labels) == code_block_names[-2:]
+    with pytest.raises(KeyError):
+        cfg.code_block_label_for(-1)
+    for function_name in cfg.functions:
+        cfg.function_call_signature_for(function_name)
+    assert len(cfg._call_signatures) == 2
+
+
+def test_call_signatures_and_labels_are_memoized(resources):
+    cfg = user_callgraph.Callgraph.from_proto(
+        os.path.join(resources, 'onecallchain.pbtxt'))
+    function_name = next(iter(cfg.functions))
+    signature = cfg.function_call_signature_for(function_name)
+    assert signature == f'function_{function_name}'
+    assert cfg.function_call_signature_for(function_name) is signature
+    code_block = cfg.get_function(function_name).code_blocks[0]
+    label = cfg.format_code_block_label(code_block)
+    assert label == f'label{code_block.name}'
+    assert cfg.code_block_label_for(code_block.name) is label
+
+
 def test_get_formatted_headers_onecallchain(resources):
     test_file = os.path.join(resources, 'onecallchain.pbtxt')
     expected = ('void function_2();\n'
@@ -185,14 +258,243 @@ def test_indirect_branch_multitarget(resources):
     test_file = os.path.join(resources,
                              'branch_indirect_call_multitarget.pbtxt')
     blocks.Branch.set_seed(0)
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    branch = cfg.get_function(2).code_blocks[0].terminator_branch
+    paths = branch.next_target_sequence(16, blocks.Branch.random_for(1034))
+    packed = [
+        sum(index << bit
+            for bit, index in enumerate(paths[i:i + 8]))
+        for i in range(0, len(paths), 8)
+    ]
     expected = (
-        'static int index_1034 = 0;\n'
-        'static int paths_1034[16] = {1,1,0,0,1,0,1,0,0,1,1,1,0,1,1,0};\n'
+        'static unsigned int index_1034 = 0;\n'
+        f'static const unsigned char paths_1034[2] = '
+        f'{{{packed[0]},{packed[1]}}};\n'
+        'unsigned int path_1034 = index_1034++ & 15;\n'
         'static void* array_1034[] = {&function_3, &function_4};\n'
-        'void (*f_1034)(void) = array_1034[paths_1034[index_1034++ % 16]];\n'
+        'void (*f_1034)(void) = '
+        'array_1034[((paths_1034[path_1034 >> 3] >> (path_1034 & 7)) & 1)];\n'
         'f_1034();\n')
 
-    cfg = user_callgraph.Callgraph.from_proto(test_file)
-    output = cfg._format_branch_indirect_call(
-        cfg.get_function(2).code_blocks[0].terminator_branch, uuid=1034)
+    output = cfg._format_branch_indirect_call(branch, uuid=1034)
     assert output == expected
+
+
+def test_slice_stubs_referenced_functions(resources):
+    test_file = os.path.join(resources, 'onecallchain.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    sliced = cfg.slice([3])
+    assert sliced.format_function(3) == cfg.format_function(3)
+    assert sliced.get_function(4).code_blocks == []
+    assert set(sliced.functions) == {2, 3, 4}
+
+
+def test_branch_identifiers_use_code_block_name(resources):
+    test_file = os.path.join(resources, 'branch_conditional_direct.pbtxt')
+    outputs = []
+    for _ in range(2):
+        blocks.Branch.set_seed(0)
+        cfg = user_callgraph.Callgraph.from_proto(test_file)
+        outputs.append(cfg.format_function(2))
+    assert outputs[0] == outputs[1]
+    assert 'static unsigned int index_74 = 0;\n' in outputs[0]
+    assert 'unsigned int path_74 = index_74++ & 15;\n' in outputs[0]
+
+
+def test_function_frequencies_dfs(resources):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    frequencies = cfg.function_frequencies()
+    assert frequencies[cfg.entry_point] == 1.0
+    # Exactly one function is called per level of the tree.
+    assert sum(frequencies.values()) == pytest.approx(10)
+
+
+def test_function_frequencies_cycle():
+    # Function 1 calls 4 and the cycle 2 <-> 3, and 3 calls 4 too. Function 4
+    # comes first, but is only visited once both its callers were.
+    calls = {1: [4, 2], 4: [], 2: [3], 3: [2, 4]}
+    cfg = cfg_pb2.CFG(entry_point_function=1)
+    for function_id, callees in calls.items():
+        cfg.code_block_bodies.add(id=function_id,
+                                  instructions=f'void function_{function_id}')
+        function = cfg.functions.add(id=function_id)
+        function.signature.code_block_body_id = function_id
+        for index, callee in enumerate(callees):
+            branch = function.instructions.add(id=10 * function_id +
+                                               index).terminator_branch
+            branch.type = cfg_pb2.Branch.BranchType.DIRECT_CALL
+            branch.targets.append(callee)
+            branch.taken_probability.append(1)
+    frequencies = user_callgraph.Callgraph.from_cfg(cfg).function_frequencies()
+    assert frequencies == {1: 1.0, 2: 1.0, 3: 1.0, 4: 2.0}
+
+
+def _conditional_cfg(target_sequence,
+                     branch_type=cfg_pb2.Branch.BranchType.CONDITIONAL_DIRECT):
+    cfg = cfg_pb2.CFG(entry_point_function=2)
+    cfg.code_block_bodies.add(id=1, instructions='void function_2')
+    function = cfg.functions.add(id=2)
+    function.signature.code_block_body_id = 1
+    for block_id in (10, 11):
+        function.instructions.add(id=block_id)
+    branch = function.instructions.add(id=12).terminator_branch
+    branch.type = branch_type
+    branch.targets.extend([10, 11])
+    branch.target_sequence.extend(target_sequence)
+    return user_callgraph.Callgraph.from_cfg(cfg)
+
+
+def test_exact_target_sequence_in_bytes():
+    # Index 2 is the fallthrough of the conditional branch.
+    cfg = _conditional_cfg([0, 1, 2, 2, 1])
+    output = cfg.format_function(2)
+    assert ('static const unsigned char paths_12[5] = {0,1,2,2,1};\n'
+            'unsigned int path_12 = index_12;\n'
+            'if (++index_12 == 5) index_12 = 0;\n'
+            'switch (paths_12[path_12]) {\n') in output
+    assert 'case 2:\n\tbreak;\n' in output
+
+
+def test_conditional_sequence_with_probabilities():
+    cfg = cfg_pb2.CFG(entry_point_function=2)
+    cfg.code_block_bodies.add(id=1, instructions='void function_2')
+    function = cfg.functions.add(id=2)
+    function.signature.code_block_body_id = 1
+    for block_id in (10, 11):
+        function.instructions.add(id=block_id)
+    branch = function.instructions.add(id=12).terminator_branch
+    branch.type = cfg_pb2.Branch.BranchType.CONDITIONAL_INDIRECT
+    branch.targets.extend([10, 11])
+    branch.taken_probability.extend([0.5, 0.5])
+    branch.target_sequence.extend([0, 1, 2, 2])
+    output = user_callgraph.Callgraph.from_cfg(cfg).format_function(2)
+    assert 'static const unsigned char paths_12[4] = {0,1,2,2};\n' in output
+    assert ('static void* array_12[] = '
+            '{&&label10, &&label11, &&label_fallthrough_12};\n') in output
+
+
+def test_target_sequence_length(resources):
+    blocks.Branch.set_seed(0)
+    cfg = user_callgraph.Callgraph.from_proto(
+        os.path.join(resources, 'branch_conditional_direct.pbtxt'))
+    cfg.target_sequence_length = 4096
+    sliced = cfg.slice([2])
+    output = sliced.format_function(2)
+    assert 'static const unsigned char paths_74[512] = {' in output
+    assert 'unsigned int path_74 = index_74++ & 4095;\n' in output
+
+
+def _hash_pattern_outcomes(output, uuid, period):
+    salt = int(
+        re.search(rf'counter_{uuid}\+\+ & {period - 1}u\) \+ (\d+)u',
+                  output).group(1))
+    outcomes = []
+    for counter in range(period):
+        h = (counter + salt) & 0xffffffff
+        h ^= h >> 16
+        h = (h * 0x85ebca6b) & 0xffffffff
+        h ^= h >> 13
+        h = (h * 0xc2b2ae35) & 0xffffffff
+        h ^= h >> 16
+        outcomes.append(h >> 16)
+    return outcomes
+
+
+def test_hashed_branch_pattern(resources):
+    blocks.Branch.set_seed(0)
+    cfg = user_callgraph.Callgraph.from_proto(
+        os.path.join(resources, 'branch_indirect_call_multitarget.pbtxt'))
+    cfg.branch_pattern = user_callgraph.PATTERN_HASH
+    cfg.pattern_period = 4096
+    sliced = cfg.slice([2])
+    output = sliced.format_function(2)
+    assert 'paths_' not in output
+    assert 'array_8[(hash_8 < 32768u ? 0 : 1)]' in output
+    outcomes = _hash_pattern_outcomes(output, 8, 4096)
+    taken = sum(outcome < 32768 for outcome in outcomes) / len(outcomes)
+    assert taken == pytest.approx(0.5, abs=0.05)
+
+
+def test_hashed_branch_pattern_keeps_exact_sequences():
+    cfg = _conditional_cfg([0, 1, 2])
+    cfg.branch_pattern = user_callgraph.PATTERN_HASH
+    assert 'paths_12' in cfg.format_function(2)
+
+
+def test_hashed_branch_pattern_period_power_of_two(resources):
+    cfg = user_callgraph.Callgraph.from_proto(
+        os.path.join(resources, 'branch_conditional_direct.pbtxt'))
+    cfg.branch_pattern = user_callgraph.PATTERN_HASH
+    for period in (0, 1000, 2**33):
+        with pytest.raises(ValueError):
+            cfg.pattern_period = period
+    cfg.pattern_period = 2**32
+    output = cfg.format_function(2)
+    assert re.search(r'= counter_\d+\+\+ \+ ', output)
+    assert '4294967295u' not in output
+
+
+def test_indirect_jump_multitarget():
+    cfg = _conditional_cfg([0, 1, 1, 0],
+                           branch_type=cfg_pb2.Branch.BranchType.INDIRECT)
+    output = cfg.format_function(2)
+    assert ('static void* array_12[] = {&&label10, &&label11};\n'
+            'goto *array_12[((paths_12[path_12 >> 3] >> (path_12 & 7)) & 1)];'
+            '\n') in output
+    assert 'label_fallthrough_12' not in output
+
+
+def test_conditional_indirect_jump():
+    cfg = _conditional_cfg(
+        [0, 1, 2], branch_type=cfg_pb2.Branch.BranchType.CONDITIONAL_INDIRECT)
+    output = cfg.format_function(2)
+    assert ('static const unsigned char paths_12[3] = {0,1,2};\n'
+            'unsigned int path_12 = index_12;\n'
+            'if (++index_12 == 3) index_12 = 0;\n'
+            'static void* array_12[] = '
+            '{&&label10, &&label11, &&label_fallthrough_12};\n'
+            'goto *array_12[paths_12[path_12]];\n'
+            'label_fallthrough_12:;\n') in output
+
+
+def _unrolled_cfg(unroll_factor):
+    cfg = cfg_pb2.CFG(entry_point_function=2)
+    cfg.code_block_bodies.add(id=1, instructions='void function_2')
+    cfg.code_block_bodies.add(id=2, instructions='int x = 1;\n')
+    function = cfg.functions.add(id=2)
+    function.signature.code_block_body_id = 1
+    function.instructions.add(id=3,
+                              code_block_body_id=2,
+                              unroll_factor=unroll_factor)
+    return user_callgraph.Callgraph.from_cfg(cfg)
+
+
+def test_unroll_repeat():
+    cfg = _unrolled_cfg(3)
+    assert cfg.format_function(2) == ('void function_2() {\n'
+                                      'label3:;\n'
+                                      'int x = 1;\n'
+                                      '{\nint x = 1;\n}\n'
+                                      '{\nint x = 1;\n}\n'
+                                      '}\n')
+    assert cfg.estimate_function_cost(2) > _unrolled_cfg(
+        1).estimate_function_cost(2)
+
+
+def test_unroll_loop():
+    cfg = _unrolled_cfg(3)
+    cfg.unroll_mode = user_callgraph.UNROLL_LOOP
+    assert cfg.format_function(2) == (
+        'void function_2() {\n'
+        'label3:;\n'
+        'int x = 1;\n'
+        'for (int unroll_3 = 0; unroll_3 < 2; ++unroll_3) {\n'
+        'int x = 1;\n'
+        '}\n'
+        '}\n')
+
+
+def test_unroll_factor_one():
+    assert _unrolled_cfg(1).format_function(2) == _unrolled_cfg(
+        0).format_function(2)
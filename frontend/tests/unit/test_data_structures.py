@@ -1,7 +1,10 @@
 # pylint: disable=redefined-outer-name
+# pylint: disable=protected-access
 """Tests for blocks.py"""
+import tracemalloc
 import pytest
 from frontend.code_generator import blocks
+from frontend.proto import cfg_pb2
 
 
 @pytest.fixture
@@ -16,6 +19,33 @@ def test_branch():
     assert br.targets == [('A', 0.3), ('B', 0.3), ('C', 0.4)]
 
 
+def test_branch_from_proto_shares_branches_without_targets():
+    proto_branch = cfg_pb2.Branch(type=cfg_pb2.Branch.BranchType.RETURN)
+    first = blocks.Branch.from_proto(proto_branch)
+    second = blocks.Branch.from_proto(proto_branch)
+    assert first is second
+    assert first.branch_type == blocks.BranchType.RETURN
+    assert not first.targets
+
+
+def test_branch_from_proto_with_targets():
+    proto_branch = cfg_pb2.Branch(type=cfg_pb2.Branch.BranchType.DIRECT_CALL,
+                                  targets=[3],
+                                  taken_probability=[1])
+    first = blocks.Branch.from_proto(proto_branch)
+    second = blocks.Branch.from_proto(proto_branch)
+    assert first is not second
+    assert first.targets == [(3, 1.0)]
+
+
+def test_blocks_have_no_instance_dict():
+    body = blocks.CodeBlockBody(name=1, instructions='')
+    block = blocks.CodeBlock(1, body, blocks.Branch(blocks.BranchType.RETURN))
+    function = blocks.Function(2, block)
+    for obj in (body, block, block.terminator_branch, function):
+        assert not hasattr(obj, '__dict__')
+
+
 def test_branch_filter_single_true(fallthrough):
     filt = blocks.Branch.filter(blocks.BranchType.FALLTHROUGH)
     assert filt(fallthrough)
@@ -36,3 +66,76 @@ def test_branch_filter_multiple_false(fallthrough):
     filt = blocks.Branch.filter(
         [blocks.BranchType.INDIRECT, blocks.BranchType.DIRECT])
     assert not filt(fallthrough)
+
+
+def test_branch_target_sequence():
+    br = blocks.Branch(blocks.BranchType.CONDITIONAL_DIRECT,
+                       targets=[5, 6],
+                       target_sequence=[0, 0, 1, 2])
+    assert br.targets == [(5, 0.5), (6, 0.25), (None, 0.25)]
+    assert br.next_target_sequence(length=64) == [0, 0, 1, 2]
+
+
+def test_branch_target_sequence_out_of_range():
+    with pytest.raises(ValueError):
+        blocks.Branch(blocks.BranchType.INDIRECT_CALL,
+                      targets=[5, 6],
+                      target_sequence=[0, 2])
+
+
+def test_branch_target_sequence_with_probabilities():
+    br = blocks.Branch(blocks.BranchType.CONDITIONAL_DIRECT,
+                       targets=[10, 11],
+                       taken_probability=[0.5, 0.5],
+                       target_sequence=[0, 1, 2, 2])
+    assert br.get_targets() == [10, 11, None]
+
+
+def test_branch_target_sequence_length():
+    br = blocks.Branch(blocks.BranchType.INDIRECT_CALL,
+                       targets=[5, 6],
+                       taken_probability=[0.5, 0.5])
+    with pytest.raises(ValueError):
+        br.next_target_sequence(length=0)
+
+
+def test_branch_target_sequence_per_key():
+    br = blocks.Branch(blocks.BranchType.INDIRECT_CALL,
+                       targets=[5, 6],
+                       taken_probability=[0.5, 0.5])
+    blocks.Branch.set_seed(0)
+    first = br.next_target_sequence(64, blocks.Branch.random_for(1))
+    br.next_target_sequence(64, blocks.Branch.random_for(2))
+    assert br.next_target_sequence(64, blocks.Branch.random_for(1)) == first
+
+
+def test_branch_memory():
+    targets = [[1000 + i, 2000 + i] for i in range(1000)]
+    tracemalloc.start()
+    try:
+        branches = [
+            blocks.Branch(blocks.BranchType.CONDITIONAL_DIRECT,
+                          targets=branch_targets,
+                          taken_probability=[0.5, 0.5])
+            for branch_targets in targets
+        ]
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # One target object and one float object per target took about 280 bytes
+    # per branch. Now a branch is an object and a tuple of its target IDs.
+    assert size / len(branches) < 160
+    assert branches[0].targets == [(1000, 0.5), (2000, 0.5)]
+    assert branches[0].num_targets == 2
+
+
+def test_branch_probabilities_are_shared():
+    first = blocks.Branch(blocks.BranchType.CONDITIONAL_DIRECT,
+                          targets=[1],
+                          taken_probability=[0.25])
+    second = blocks.Branch(blocks.BranchType.CONDITIONAL_DIRECT,
+                           targets=[2],
+                           taken_probability=[0.25])
+    assert first.targets == [(1, 0.25), (None, 0.75)]
+    assert second.targets == [(2, 0.25), (None, 0.75)]
+    assert first._probabilities is second._probabilities
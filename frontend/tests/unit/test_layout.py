@@ -0,0 +1,79 @@
+# pylint: disable=redefined-outer-name
+"""Tests for layout.py"""
+import os
+import pytest
+from frontend.code_generator import build_profiles
+from frontend.code_generator import layout
+from frontend.code_generator import source_generator
+from frontend.code_generator import user_callgraph
+
+
+@pytest.fixture
+def resources():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.path.pardir, 'resources')
+
+
+@pytest.fixture
+def dfs_callgraph(resources):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    return user_callgraph.Callgraph.from_proto(test_file)
+
+
+def test_call_order_onecallchain(resources):
+    test_file = os.path.join(resources, 'onecallchain.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    assert layout.order_functions(cfg, layout.ORDER_CALL) == [2, 3, 4, 5, 6]
+
+
+@pytest.mark.parametrize('policy', layout.ORDER_POLICIES)
+def test_order_is_permutation(dfs_callgraph, policy):
+    order = layout.order_functions(dfs_callgraph, policy)
+    assert sorted(order) == sorted(dfs_callgraph.functions)
+
+
+def test_random_order_is_seeded(dfs_callgraph):
+    first = layout.order_functions(dfs_callgraph, layout.ORDER_RANDOM, seed=1)
+    second = layout.order_functions(dfs_callgraph, layout.ORDER_RANDOM, seed=1)
+    other = layout.order_functions(dfs_callgraph, layout.ORDER_RANDOM, seed=2)
+    assert first == second
+    assert first != other
+
+
+def test_hot_cold_order(dfs_callgraph):
+    order = layout.order_functions(dfs_callgraph, layout.ORDER_HOT_COLD)
+    frequencies = dfs_callgraph.function_frequencies()
+    assert order[0] == dfs_callgraph.entry_point
+    assert [frequencies[name] for name in order] == sorted(frequencies.values(),
+                                                           reverse=True)
+
+
+def test_write_symbol_ordering(resources, tmpdir):
+    test_file = os.path.join(resources, 'onecallchain.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_gen = source_generator.SourceGenerator(
+        tmpdir, cfg, symbol_ordering=layout.ORDER_CALL)
+    source_gen.write_files()
+    with open(os.path.join(tmpdir, source_generator.SYMBOL_ORDERING_FILE),
+              encoding='utf-8') as f:
+        assert f.read() == ('function_2\n'
+                            'function_3\n'
+                            'function_4\n'
+                            'function_5\n'
+                            'function_6\n')
+    with open(os.path.join(tmpdir, 'Makefile'), encoding='utf-8') as f:
+        makefile = f.read()
+    assert '-ffunction-sections' in makefile
+    assert '-Wl,--symbol-ordering-file=symbols.order' in makefile
+
+
+def test_symbol_ordering_rejects_linker_ordering_file(resources, tmpdir):
+    test_file = os.path.join(resources, 'onecallchain.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    profile = build_profiles.get_profile(build_profiles.DEFAULT_PROFILE)
+    with pytest.raises(ValueError):
+        source_generator.SourceGenerator(
+            tmpdir,
+            cfg,
+            build_profile=profile._replace(linker_ordering_file='my.order'),
+            symbol_ordering=layout.ORDER_CALL)
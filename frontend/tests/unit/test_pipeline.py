@@ -0,0 +1,37 @@
+"""Tests for pipeline.py"""
+import os
+from frontend import pipeline
+from frontend.cfg_generator import dfs_chase_gen
+from frontend.code_generator import blocks
+from frontend.code_generator import source_generator
+from frontend.code_generator import user_callgraph
+
+
+def _read_files(directory):
+    contents = {}
+    for filename in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, filename), 'rb') as f:
+            contents[filename] = f.read()
+    return contents
+
+
+def test_generate_sources_from_generator(tmp_path):
+    blocks.Branch.set_seed(0)
+    generator = dfs_chase_gen.DFSChaseGenerator(3, False, 0.5, False)
+    cfg_path = str(tmp_path / 'cfg.pb')
+    in_memory_dir = tmp_path / 'in_memory'
+    in_memory_dir.mkdir()
+    callgraph = pipeline.generate_sources(generator,
+                                          str(in_memory_dir),
+                                          num_files=2,
+                                          cfg_path=cfg_path)
+    assert len(callgraph.functions) == 7
+
+    # Sources match those generated from the CFG written to disk.
+    round_trip_dir = tmp_path / 'round_trip'
+    round_trip_dir.mkdir()
+    blocks.Branch.set_seed(0)
+    sg = source_generator.SourceGenerator(
+        str(round_trip_dir), user_callgraph.Callgraph.from_proto(cfg_path))
+    sg.write_files(2)
+    assert _read_files(in_memory_dir) == _read_files(round_trip_dir)
@@ -4,10 +4,13 @@ import os
 import pytest
 import platform
 import glob
+import shutil
 import re
 from typing import List
 from filecmp import dircmp
 import sh  # type: ignore[import]
+from frontend.code_generator import blocks
+from frontend.code_generator import build_profiles
 from frontend.code_generator import user_callgraph
 from frontend.code_generator import source_generator
 
@@ -202,3 +205,342 @@ def test_prefetch_on(resources, tmpdir):
                                                 ['ENABLE_PREFETCH=yes'])
     if platform.machine() == 'aarch64':
         assert result
+
+
+@pytest.mark.parametrize('write_buffer_size', [1, 4096])
+def test_write_function_file_matches_append(resources, tmpdir,
+                                            write_buffer_size):
+    test_file = os.path.join(resources, 'onecallchain.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_gen = source_generator.SourceGenerator(
+        tmpdir, cfg, write_buffer_size=write_buffer_size)
+    functions = list(cfg.functions.keys())
+    source_gen.write_function_file('buffered.c', functions)
+    source_gen.write_header_import_to_new_file('appended.c')
+    for function_name in functions:
+        source_gen.write_function_to_existing_file(function_name, 'appended.c')
+    with open(os.path.join(tmpdir, 'buffered.c'),
+              encoding='utf-8') as buffered, \
+            open(os.path.join(tmpdir, 'appended.c'),
+                 encoding='utf-8') as appended:
+        assert buffered.read() == appended.read()
+
+
+def test_write_files_parallel(resources, tmpdir):
+    depth = 10
+    test_file = os.path.join(resources, 'dfs', f'dfs_depth{depth}_cfg.pb')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_gen = source_generator.SourceGenerator(tmpdir, cfg)
+    source_gen.write_files(num_files=8, jobs=4)
+    definitions = []
+    for c_file in glob.glob(f'{tmpdir}/*.c'):
+        with open(c_file, 'r', encoding='utf-8') as f:
+            definitions.extend(
+                re.findall(r'^void (\w+)\(\) \{$', f.read(), re.MULTILINE))
+    expected = [cfg.function_call_signature_for(name) for name in cfg.functions]
+    assert sorted(definitions) == sorted(expected)
+
+
+def test_regenerated_sources_are_identical(resources, tmpdir):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    output_dirs = [tmpdir.mkdir('first'), tmpdir.mkdir('second')]
+    for output_dir in output_dirs:
+        blocks.Branch.set_seed(0)
+        cfg = user_callgraph.Callgraph.from_proto(test_file)
+        source_gen = source_generator.SourceGenerator(output_dir, cfg)
+        source_gen.write_files(num_files=4)
+    output = dircmp(*output_dirs)
+    assert output.left_list == output.right_list
+    assert not output.diff_files
+
+
+def test_sources_do_not_depend_on_jobs(resources, tmpdir):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    output_dirs = [tmpdir.mkdir('serial'), tmpdir.mkdir('parallel')]
+    for output_dir, jobs in zip(output_dirs, [1, 3]):
+        blocks.Branch.set_seed(0)
+        cfg = user_callgraph.Callgraph.from_proto(test_file)
+        source_gen = source_generator.SourceGenerator(output_dir, cfg)
+        source_gen.write_files(num_files=4, jobs=jobs)
+    output = dircmp(*output_dirs)
+    assert output.left_list == output.right_list
+    assert not output.diff_files
+
+
+@pytest.mark.parametrize('cache_size', [1, 64])
+def test_lazy_callgraph_sources_are_identical(resources, tmpdir, cache_size):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    output_dirs = [tmpdir.mkdir('eager'), tmpdir.mkdir('lazy')]
+    for output_dir, lazy in zip(output_dirs, [False, True]):
+        blocks.Branch.set_seed(0)
+        cfg = user_callgraph.Callgraph.from_proto(test_file,
+                                                  lazy=lazy,
+                                                  cache_size=cache_size)
+        source_gen = source_generator.SourceGenerator(output_dir, cfg)
+        source_gen.write_files(num_files=4, jobs=2)
+    output = dircmp(*output_dirs)
+    assert output.left_list == output.right_list
+    assert not output.diff_files
+
+
+def _generate_incremental(test_file: str, output_dir: str,
+                          num_files: int) -> None:
+    blocks.Branch.set_seed(0)
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_gen = source_generator.SourceGenerator(output_dir,
+                                                  cfg,
+                                                  incremental=True)
+    source_gen.write_files(num_files)
+
+
+def test_incremental_keeps_unchanged_files(resources, tmpdir):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    _generate_incremental(test_file, tmpdir, 4)
+    generated = glob.glob(f'{tmpdir}/*.c') + glob.glob(f'{tmpdir}/*.h')
+    for path in generated:
+        os.utime(path, (0, 0))
+    _generate_incremental(test_file, tmpdir, 4)
+    assert all(os.path.getmtime(path) == 0 for path in generated)
+    assert not glob.glob(f'{tmpdir}/*.tmp')
+
+
+def test_incremental_rewrites_changed_files(resources, tmpdir):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    incremental_dir = os.path.join(tmpdir, 'incremental')
+    expected_dir = os.path.join(tmpdir, 'expected')
+    os.mkdir(incremental_dir)
+    os.mkdir(expected_dir)
+    _generate_incremental(test_file, incremental_dir, 4)
+    os.utime(os.path.join(incremental_dir, 'main.c'), (0, 0))
+    _generate_incremental(test_file, incremental_dir, 2)
+    c_files = {
+        os.path.basename(path) for path in glob.glob(f'{incremental_dir}/*.c')
+    }
+    assert c_files == {'main.c', '0.c', '1.c'}
+    assert os.path.getmtime(os.path.join(incremental_dir, 'main.c')) == 0
+    blocks.Branch.set_seed(0)
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_generator.SourceGenerator(expected_dir, cfg).write_files(2)
+    output = dircmp(incremental_dir, expected_dir)
+    assert not output.diff_files
+    assert not output.right_only
+
+
+def test_incremental_rewrites_edited_files(resources, tmpdir):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    _generate_incremental(test_file, tmpdir, 4)
+    path = os.path.join(tmpdir, '0.c')
+    with open(path, encoding='utf-8') as f:
+        expected = f.read()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('int edited;\n')
+    _generate_incremental(test_file, tmpdir, 4)
+    with open(path, encoding='utf-8') as f:
+        assert f.read() == expected
+
+
+def test_minimal_headers(resources, tmpdir):
+    test_file = os.path.join(resources, 'onefunction_globalvars.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_gen = source_generator.SourceGenerator(tmpdir,
+                                                  cfg,
+                                                  minimal_headers=True)
+    source_gen.write_files()
+    with open(os.path.join(tmpdir, '0.c'), encoding='utf-8') as f:
+        assert f.read() == ('extern int x;\n'
+                            'extern int y;\n'
+                            'extern int z;\n'
+                            'extern int w;\n'
+                            'void function_19();\n\n'
+                            'void function_19() {\n'
+                            'label1:;\n'
+                            'x = 1;\n'
+                            'y = x*x + 3;\n'
+                            'z = y*x + 12345;\n'
+                            'w = z*z + x - y;\n'
+                            '}\n\n')
+    compile_c_files(tmpdir, [])
+
+
+def test_minimal_headers_declare_callees(resources, tmpdir):
+    depth = 10
+    test_file = os.path.join(resources, 'dfs', f'dfs_depth{depth}_cfg.pb')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_gen = source_generator.SourceGenerator(tmpdir,
+                                                  cfg,
+                                                  minimal_headers=True)
+    source_gen.write_files(num_files=8)
+    for c_file in glob.glob(f'{tmpdir}/*.c'):
+        with open(c_file, 'r', encoding='utf-8') as f:
+            text = f.read()
+        assert source_gen.get_header_import_string() not in text
+        declared = set(re.findall(r'^void (\w+)\(\);$', text, re.MULTILINE))
+        used = set(re.findall(r'(function_\d+)', text))
+        assert declared == used
+        assert len(declared) < len(cfg.functions)
+
+
+def test_partition_by_cost(resources):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    num_files = 8
+    mapper = source_generator.FileFunctionMapper(
+        cfg, source_generator.PARTITION_BY_COST)
+    mapping = mapper.create_file_to_functions_mapping(num_files)
+    assert len(mapping) == num_files
+    assigned = [name for functions in mapping.values() for name in functions]
+    assert sorted(assigned) == sorted(cfg.functions)
+    file_costs = [
+        sum(cfg.estimate_function_cost(name)
+            for name in functions)
+        for functions in mapping.values()
+    ]
+    largest_function = max(
+        cfg.estimate_function_cost(name) for name in cfg.functions)
+    assert max(file_costs) - min(file_costs) <= 2 * largest_function
+
+
+def test_partition_unknown_strategy(resources):
+    test_file = os.path.join(resources, 'onefunction.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    with pytest.raises(ValueError):
+        source_generator.FileFunctionMapper(cfg, 'unknown')
+
+
+def test_partition_by_count_keeps_layout(resources, tmpdir):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_generator.SourceGenerator(tmpdir, cfg).write_files(num_files=4)
+    # Layout written by the count strategy before other strategies existed.
+    expected = {
+        '0.c': list(range(2, 258)),
+        '1.c': [512, 513] + list(range(258, 512)),
+        '2.c': list(range(514, 770)),
+        '3.c': [1024] + list(range(770, 1024)),
+    }
+    layout = {}
+    for function_file in expected:
+        with open(os.path.join(tmpdir, function_file), encoding='utf-8') as f:
+            layout[function_file] = [
+                int(name) for name in re.findall(
+                    r'^void function_(\d+)\(\) \{$', f.read(), re.MULTILINE)
+            ]
+    assert layout == expected
+
+
+def _cut_weight(cfg: user_callgraph.Callgraph, mapping) -> float:
+    file_of = {
+        name: function_file for function_file, functions in mapping.items()
+        for name in functions
+    }
+    return sum(weight for caller, weights in cfg.affinity_weights().items()
+               for callee, weight in weights.items()
+               if file_of[caller] != file_of[callee])
+
+
+def test_partition_by_locality(resources):
+    test_file = os.path.join(resources, 'dfs', 'dfs_depth10_cfg.pb')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    num_files = 8
+    mappings = {}
+    for strategy in (source_generator.PARTITION_BY_COUNT,
+                     source_generator.PARTITION_BY_LOCALITY):
+        mapper = source_generator.FileFunctionMapper(cfg, strategy)
+        mappings[strategy] = mapper.create_file_to_functions_mapping(num_files)
+    locality = mappings[source_generator.PARTITION_BY_LOCALITY]
+    assert len(locality) == num_files
+    assigned = [name for functions in locality.values() for name in functions]
+    assert sorted(assigned) == sorted(cfg.functions)
+    assert _cut_weight(cfg, locality) < _cut_weight(
+        cfg, mappings[source_generator.PARTITION_BY_COUNT])
+    # Functions joined by heavy edges are written next to each other.
+    sorted_locality = {
+        function_file: sorted(functions)
+        for function_file, functions in locality.items()
+    }
+    adjacent_weight = _adjacent_weight(cfg, locality)
+    assert adjacent_weight > 2 * _adjacent_weight(cfg, sorted_locality)
+
+
+def _adjacent_weight(cfg: user_callgraph.Callgraph, mapping) -> float:
+    weights = cfg.affinity_weights()
+    return sum(weights[first].get(second, 0) + weights[second].get(first, 0)
+               for functions in mapping.values()
+               for first, second in zip(functions, functions[1:]))
+
+
+def test_write_ninja_file(resources, tmpdir):
+    test_file = os.path.join(resources, 'onefunction.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_gen = source_generator.SourceGenerator(tmpdir, cfg, ninja=True)
+    source_gen.write_files()
+    with open(os.path.join(tmpdir, 'build.ninja'), encoding='utf-8') as f:
+        assert f.read() == (
+            'cc = $${CC:-cc}\n'
+            'prefetch_flags = $${ENABLE_PREFETCH:+-DENABLE_CODE_PREFETCH}\n'
+            'cflags = $prefetch_flags -O0\n'
+            'ldflags =\n'
+            '\n'
+            'rule cc\n'
+            '  command = $cc -c -o $out $in $cflags\n'
+            '  description = CC $out\n'
+            '\n'
+            'rule link\n'
+            '  command = $cc -o $out $in $cflags $ldflags\n'
+            '  description = LINK $out\n'
+            '\n'
+            'build 0.o: cc 0.c\n'
+            'build main.o: cc main.c\n'
+            'build benchmark: link 0.o main.o\n'
+            'default benchmark\n')
+
+
+@pytest.mark.skipif(shutil.which('ninja') is None,
+                    reason='ninja is not installed')
+def test_prefetch_on_ninja(resources, tmpdir):
+    test_file = os.path.join(resources, 'prefetch_cb.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    source_gen = source_generator.SourceGenerator(tmpdir, cfg, ninja=True)
+    source_gen.write_files()
+    ninja = sh.Command('ninja')
+    ninja('-C', tmpdir, _env={**os.environ, 'ENABLE_PREFETCH': 'yes'})
+    result = check_for_asm(os.path.join(tmpdir, 'benchmark'), 'function_0',
+                           'prfm')
+    if platform.machine() == 'aarch64':
+        assert result
+
+
+def test_write_makefile_build_profile(resources, tmpdir):
+    test_file = os.path.join(resources, 'onefunction.pbtxt')
+    cfg = user_callgraph.Callgraph.from_proto(test_file)
+    profile = build_profiles.get_profile('O2-layout')._replace(compiler='gcc')
+    source_gen = source_generator.SourceGenerator(tmpdir,
+                                                  cfg,
+                                                  build_profile=profile)
+    source_gen.write_files()
+    cflags = ('$(DENABLE_PREFETCH) -O2 -ffunction-sections '
+              '-falign-functions=64 -fno-inline')
+    with open(os.path.join(tmpdir, 'Makefile'), encoding='utf-8') as f:
+        assert f.read() == ('CC = gcc\n\n'
+                            'ifdef ENABLE_PREFETCH\n'
+                            '\tDENABLE_PREFETCH = -DENABLE_CODE_PREFETCH\n'
+                            'endif\n\n'
+                            'benchmark: 0.o main.o\n'
+                            f'\t$(CC) -o benchmark 0.o main.o {cflags}\n\n'
+                            '0.o: 0.c\n'
+                            f'\t$(CC) -c -o 0.o 0.c {cflags}\n\n'
+                            'main.o: main.c\n'
+                            f'\t$(CC) -c -o main.o main.c {cflags}\n\n'
+                            'clean:\n\trm *.o benchmark\n')
+    compile_c_files(tmpdir, [])
+
+
+def test_build_profile_linker_ordering_file():
+    profile = build_profiles.get_profile('default')._replace(
+        linker_ordering_file='symbols.order')
+    assert profile.get_cflags() == ['-O0']
+    assert profile.get_ldflags() == [
+        '-fuse-ld=lld', '-Wl,--symbol-ordering-file=symbols.order'
+    ]
+    with pytest.raises(ValueError):
+        build_profiles.get_profile('unknown')
@@ -0,0 +1,134 @@
+# pylint: disable=redefined-outer-name
+"""Tests for validator.py"""
+import os
+import pytest
+from frontend.cfg_generator import dfs_chase_gen
+from frontend.cfg_generator import inst_pointer_chase_gen
+from frontend.code_generator import validator
+from frontend.proto import cfg_pb2
+from frontend.proto import cfg_stream
+
+
+@pytest.fixture
+def resources():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.path.pardir, 'resources')
+
+
+def _kinds(problems):
+    return sorted(problem.kind for problem in problems)
+
+
+@pytest.mark.parametrize('filename', [
+    'onefunction.pbtxt', 'onecallchain.pbtxt', 'prefetch_func.pbtxt',
+    'branch_conditional_direct.pbtxt', 'branch_indirect_call_multitarget.pbtxt'
+])
+def test_valid_cfg(resources, filename):
+    report = validator.validate_file(os.path.join(resources, filename))
+    assert report.ok, report.format()
+
+
+@pytest.mark.parametrize('filename, kind', [
+    ('missingbranchtargets.pbtxt', 'missing-target'),
+    ('missingcodeblockbody.pbtxt', 'missing-body'),
+    ('missingentry.pbtxt', 'missing-entry'),
+    ('missingsignature.pbtxt', 'missing-body'),
+])
+def test_invalid_cfg(resources, filename, kind):
+    report = validator.validate_file(os.path.join(resources, filename))
+    assert not report.ok
+    assert kind in _kinds(report.errors)
+
+
+def test_conflicting_ids_are_a_warning(resources):
+    report = validator.validate_file(
+        os.path.join(resources, 'conflictingfunction_codeblock.pbtxt'))
+    assert 'shared-id' in _kinds(report.warnings)
+
+
+def test_reports_every_problem():
+    cfg = cfg_pb2.CFG(entry_point_function=1)
+    cfg.code_block_bodies.add(id=1, instructions='void function_1')
+    cfg.code_block_bodies.add(id=2, instructions='no_signature')
+    function = cfg.functions.add(id=1)
+    function.signature.code_block_body_id = 1
+    block = function.instructions.add(id=10, code_block_body_id=3)
+    block.terminator_branch.type = cfg_pb2.Branch.BranchType.DIRECT_CALL
+    block.terminator_branch.targets.extend([2, 4])
+    block.terminator_branch.taken_probability.append(0.5)
+    unreachable = cfg.functions.add(id=5)
+    unreachable.signature.code_block_body_id = 2
+    unreachable.instructions.add(id=10)
+
+    report = validator.validate(cfg)
+
+    assert _kinds(report.errors) == [
+        'bad-probability', 'bad-probability', 'bad-signature', 'duplicate-id',
+        'missing-body', 'missing-target', 'missing-target'
+    ]
+    assert _kinds(report.warnings) == ['unreachable']
+    assert report.format().endswith('7 errors, 1 warnings\n')
+
+
+def test_generated_cfgs_are_valid():
+    dfs_cfg = dfs_chase_gen.DFSChaseGenerator(4, False, 0.5,
+                                              True).generate_cfg()
+    assert validator.validate(dfs_cfg).ok
+    ichase_cfg = inst_pointer_chase_gen.InstPointerChaseGenerator(
+        3, 4, True).generate_cfg()
+    assert validator.validate(ichase_cfg).ok
+
+
+def test_validate_stream_file(tmp_path):
+    path = str(tmp_path / 'cfg.pbstream')
+    with open(path, 'wb') as f:
+        dfs_chase_gen.DFSChaseGenerator(4, True, 0.5, False).stream_cfg(
+            cfg_stream.CFGStreamWriter(f))
+    report = validator.validate_file(path)
+    assert report.ok, report.format()
+    assert not report.problems
+
+
+def test_target_sequence():
+    cfg = cfg_pb2.CFG(entry_point_function=1)
+    cfg.code_block_bodies.add(id=1, instructions='void function_1')
+    function = cfg.functions.add(id=1)
+    function.signature.code_block_body_id = 1
+    function.instructions.add(id=2)
+    branch = function.instructions.add(id=3).terminator_branch
+    branch.type = cfg_pb2.Branch.BranchType.CONDITIONAL_DIRECT
+    branch.targets.append(2)
+    branch.target_sequence.extend([0, 1, 1])
+    assert validator.validate(cfg).ok
+
+    branch.target_sequence.append(2)
+    assert _kinds(validator.validate(cfg).errors) == ['bad-sequence']
+
+
+def test_jump_to_another_function():
+    cfg = cfg_pb2.CFG(entry_point_function=1)
+    cfg.code_block_bodies.add(id=100, instructions='void function_1')
+    cfg.code_block_bodies.add(id=101, instructions='void function_2')
+    cfg.code_block_bodies.add(id=102,
+                              code_prefetch=cfg_pb2.CodePrefetchInst(
+                                  type=cfg_pb2.CodePrefetchInst.CODE_BLOCK,
+                                  target_id=20,
+                                  degree=1))
+    caller = cfg.functions.add(id=1)
+    caller.signature.code_block_body_id = 100
+    caller.instructions.add(id=10, code_block_body_id=102)
+    jump = caller.instructions.add(id=11).terminator_branch
+    jump.type = cfg_pb2.Branch.BranchType.DIRECT
+    jump.targets.append(20)
+    jump.taken_probability.append(1)
+    call = caller.instructions.add(id=12).terminator_branch
+    call.type = cfg_pb2.Branch.BranchType.DIRECT_CALL
+    call.targets.append(2)
+    call.taken_probability.append(1)
+    callee = cfg.functions.add(id=2)
+    callee.signature.code_block_body_id = 101
+    callee.instructions.add(id=20)
+
+    report = validator.validate(cfg)
+
+    assert _kinds(report.errors) == ['cross-function', 'cross-function']